@@ -1,4 +1,4 @@
-from bare.encoder import Map, Optional, Struct, Array, ValidationError, Union
+from bare.encoder import Map, Optional, Struct, Array, ValidationError, Union, Decoder, Tagged
 from bare.types import (
     U8,
     U16,
@@ -27,6 +27,8 @@ __all__ = [
     "Array",
     "ValidationError",
     "Union",
+    "Decoder",
+    "Tagged",
     "U8",
     "U16",
     "U32",
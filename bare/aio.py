@@ -0,0 +1,138 @@
+"""
+bare.aio reads and writes BARE messages over asyncio streams. Each message is framed
+with its length as a varint, so whole messages can be read with `readexactly` and
+decoded in one go, optionally on an executor so large payloads don't block the loop.
+"""
+import asyncio
+import inspect
+import typing
+
+from .encoder import Field, Struct
+from .varint import encode_uvarint
+
+
+def _unpack(type, data: bytes, native=False, trusted=False):
+    # module level so that it can be sent to a process pool
+    return type.unpack(data, native=native, trusted=trusted)
+
+
+def _encode_frame(out: bytearray, value: typing.Union[Struct, Field]):
+    if isinstance(value, Struct):
+        encoded = value.__schema__.codec.encode(bytearray(), value)
+    else:
+        from .compiler import compile_field
+
+        encoded = compile_field(value).encode(bytearray(), value._value)
+    encode_uvarint(out, len(encoded))
+    out += encoded
+
+
+async def _read_length(reader: asyncio.StreamReader) -> typing.Optional[int]:
+    output = 0
+    shift = 0
+    while True:
+        try:
+            b = (await reader.readexactly(1))[0]
+        except asyncio.IncompleteReadError:
+            if shift == 0:
+                return None  # the stream ended on a message boundary
+            raise RuntimeError("Not enough bytes in buffer to decode")
+        output |= (b & 0x7F) << shift
+        if b < 0x80:
+            return output
+        shift += 7
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> typing.Optional[bytes]:
+    length = await _read_length(reader)
+    if length is None:
+        return None
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise RuntimeError("Not enough bytes in buffer to decode")
+
+
+async def _decode_frame(data: bytes, type, native, trusted, executor, offload_size):
+    if offload_size is not None and len(data) >= offload_size:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, _unpack, type, data, native, trusted)
+    return _unpack(type, data, native, trusted)
+
+
+def _instance(type):
+    if inspect.isclass(type) and not issubclass(type, Struct):
+        return type()
+    return type
+
+
+async def read_message(
+    reader: asyncio.StreamReader,
+    type,
+    native=False,
+    trusted=False,
+    executor=None,
+    offload_size: int = None,
+):
+    """
+    Reads one length prefixed message from `reader` and decodes it as `type`.
+
+    :param type: a `Struct` subclass, or a `Field` type or instance
+    :param bool native: see `Struct.unpack`
+    :param bool trusted: see `Struct.unpack`
+    :param executor: the executor messages of at least `offload_size` bytes are decoded
+        on, defaults to the loop's default executor. Process pools work too.
+    :param int offload_size: decode messages of at least this many bytes on `executor`
+        instead of on the event loop. By default everything is decoded on the loop.
+    :returns: the decoded message
+    :raises EOFError: if the stream has ended
+    :raises RuntimeError: if the stream ends in the middle of a message
+    """
+    data = await _read_frame(reader)
+    if data is None:
+        raise EOFError("End of stream")
+    return await _decode_frame(data, _instance(type), native, trusted, executor, offload_size)
+
+
+async def iter_messages(
+    reader: asyncio.StreamReader,
+    type,
+    native=False,
+    trusted=False,
+    executor=None,
+    offload_size: int = None,
+) -> typing.AsyncIterator:
+    """
+    Yields every length prefixed message read from `reader` until it reaches EOF. The
+    arguments are the same as for `read_message`.
+    """
+    type = _instance(type)
+    while True:
+        data = await _read_frame(reader)
+        if data is None:
+            return
+        yield await _decode_frame(data, type, native, trusted, executor, offload_size)
+
+
+async def write_message(writer: asyncio.StreamWriter, value: typing.Union[Struct, Field]):
+    """
+    Writes `value` to `writer` prefixed with its length, and waits for the writer to drain.
+    """
+    out = bytearray()
+    _encode_frame(out, value)
+    writer.write(out)
+    await writer.drain()
+
+
+async def write_messages(
+    writer: asyncio.StreamWriter, values: typing.Iterable[typing.Union[Struct, Field]]
+):
+    """
+    Writes every value in `values` to `writer` prefixed with its length, with a single
+    write, and waits for the writer to drain.
+    """
+    out = bytearray()
+    for value in values:
+        _encode_frame(out, value)
+    writer.write(out)
+    await writer.drain()
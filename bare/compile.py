@@ -0,0 +1,352 @@
+"""
+bare.compile generates a Python module from a BARE schema document (see `bare.schema`).
+The module declares a `Struct`, `Union`, `Enum` or `Field` class for every named type,
+followed by the source of their codec functions, generated ahead of time by
+`bare.compiler`. Importing the module installs those functions, so nothing is
+generated or `exec`ed at runtime:
+
+    python -m bare.compile schema.bare -o messages.py
+
+By default the `encode`, `size`, `decode`, `read` and `skip` functions of every struct
+are generated, `--kinds` picks others (e.g. `decode_native_trusted`). Any function that
+wasn't generated ahead of time is still generated on first use, as usual.
+"""
+import argparse
+import importlib
+import keyword
+import sys
+import typing
+
+from .compiler import _NAMESPACE, Codec, _Scope, _SymbolicGenerator
+from .encoder import Struct
+from .schema import (
+    EnumType,
+    ListType,
+    MapType,
+    OptionalType,
+    Primitive,
+    Reference,
+    SchemaError,
+    StructType,
+    TypeDef,
+    UnionType,
+    _references,
+    parse,
+)
+
+DEFAULT_KINDS = ("encode", "size", "decode", "read", "skip")
+
+_PRIMITIVES = {
+    "uint": "UInt",
+    "int": "Int",
+    "u8": "U8",
+    "u16": "U16",
+    "u32": "U32",
+    "u64": "U64",
+    "i8": "I8",
+    "i16": "I16",
+    "i32": "I32",
+    "i64": "I64",
+    "f32": "F32",
+    "f64": "F64",
+    "bool": "Bool",
+    "str": "Str",
+    "data": "Data",
+    "void": "Void",
+}
+
+
+def _qualified(obj) -> str:
+    """
+    Returns the import and name an object of another module is referred to by, preferring
+    public modules (e.g. `io` over `_io`).
+    """
+    module = obj.__module__
+    public = module.lstrip("_")
+    if public != module:
+        if getattr(importlib.import_module(public), obj.__name__, None) is obj:
+            module = public
+    return module
+
+
+def _imports() -> typing.List[str]:
+    # the helpers every generated function may refer to, under the names it uses
+    lines = []
+    for name, obj in _NAMESPACE.items():
+        line = f"from {_qualified(obj)} import {obj.__name__}"
+        if name != obj.__name__:
+            line += f" as {name}"
+        lines.append(line)
+    return sorted(lines)
+
+
+# names the generated module binds itself, which types can't be named
+_RESERVED = {"bare", "enum", "struct"} | set(_NAMESPACE)
+
+
+class _Classes:
+    """
+    Writes the class declarations of a schema's types. Types are declared after the
+    types they refer to, inline structs are declared as classes named after the field
+    (or union member) they're declared for.
+    """
+
+    def __init__(self, definitions: typing.List[TypeDef]):
+        self.definitions = {definition.name: definition for definition in definitions}
+        self.lines = []
+        self.declared = set()
+        self.declaring = []
+        self.inline = {}
+        # the names of the classes declared, and of those that are structs
+        self.classes = []
+        self.structs = []
+        for definition in definitions:
+            self.declare(definition.name)
+
+    def declare(self, name: str):
+        if name in self.declared:
+            return
+        definition = self.definitions[name]
+        if name in self.declaring:
+            cycle = " -> ".join(self.declaring[self.declaring.index(name) :] + [name])
+            raise SchemaError(f"recursive types aren't supported: {cycle}", definition.line)
+        if name in _RESERVED or name.startswith("_"):
+            raise SchemaError(f"{name!r} can't be used as a type name", definition.line)
+        self.declaring.append(name)
+        for reference in _references(definition.type):
+            self.declare(reference.name)
+        self.declaring.pop()
+        self.declared.add(name)
+        type = definition.type
+        if isinstance(type, StructType):
+            self.struct(name, type)
+        elif isinstance(type, UnionType):
+            self.cls(name, "bare.Union", [f"_members = {self.members(type, name)}"])
+        elif isinstance(type, EnumType):
+            values = [f"{value_name} = {value}" for value_name, value in type.values]
+            self.cls(name, "enum.IntEnum", values)
+        elif isinstance(type, Primitive):
+            if type.name == "data" and type.length:
+                body = [f"_length = {type.length}", f"_default = bytes({type.length})"]
+                self.cls(name, "bare.DataFixed", body)
+            else:
+                self.cls(name, f"bare.{_PRIMITIVES[type.name]}", [])
+        elif isinstance(type, Reference) and self.named(type.name):
+            self.lines += [f"{name} = {type.name}", "", ""]
+        # optional, list and map types have no class, they're spelled out where used
+
+    def named(self, name: str) -> bool:
+        """Whether the type `name` is declared as a class"""
+        return not isinstance(self.resolve(name), (OptionalType, ListType, MapType))
+
+    def resolve(self, name: str):
+        """The type `name` stands for, following aliases"""
+        type = self.definitions[name].type
+        if isinstance(type, Reference):
+            return self.resolve(type.name)
+        return type
+
+    def cls(self, name: str, base: str, body: typing.List[str]):
+        self.classes.append(name)
+        self.lines.append(f"class {name}({base}):")
+        self.lines += [f"    {line}" for line in body] or ["    pass"]
+        self.lines += ["", ""]
+
+    def struct(self, name: str, type: StructType):
+        body = []
+        for field_name, field in type.fields:
+            if keyword.iskeyword(field_name) or hasattr(Struct, field_name):
+                raise SchemaError(f"{field_name!r} can't be used as a field name of {name}")
+            body.append(f"{field_name} = {self.field(field, f'{name}_{field_name}')}")
+        self.cls(name, "bare.Struct", body)
+        self.structs.append(name)
+
+    def field(self, type, name: str) -> str:
+        """
+        Returns the expression of a field instance of `type`. Inline structs are
+        declared as `name`.
+        """
+        if isinstance(type, Primitive):
+            if type.name == "data" and type.length:
+                return f"bare.DataFixed(length={type.length})"
+            return f"bare.{_PRIMITIVES[type.name]}()"
+        if isinstance(type, Reference):
+            definition = self.definitions[type.name]
+            if isinstance(self.resolve(type.name), EnumType):
+                return f"bare.Enum({type.name})"
+            if not self.named(type.name):
+                return self.field(definition.type, type.name)
+            return f"{type.name}()"
+        if isinstance(type, OptionalType):
+            return f"bare.Optional({self.argument(type.type, name)})"
+        if isinstance(type, ListType):
+            length = f", length={type.length}" if type.length else ""
+            return f"bare.Array({self.argument(type.type, name)}{length})"
+        if isinstance(type, MapType):
+            key = self.argument(type.key, f"{name}_key")
+            return f"bare.Map({key}, {self.argument(type.value, f'{name}_value')})"
+        if isinstance(type, UnionType):
+            return f"bare.Union(members={self.members(type, name)})"
+        if isinstance(type, StructType):
+            declared = self.inline.get(id(type))
+            if declared is None:
+                if name in self.definitions or name in self.inline.values():
+                    raise SchemaError(f"the inline struct {name} clashes with another type")
+                self.struct(name, type)
+                declared = self.inline[id(type)] = name
+            return f"{declared}()"
+        raise SchemaError("enums must be declared as named types")
+
+    def members(self, type: UnionType, name: str) -> str:
+        members = [self.argument(member, f"{name}_{i}") for member, i in type.members]
+        return f"({members[0]},)" if len(members) == 1 else f"({', '.join(members)})"
+
+    def argument(self, type, name: str) -> str:
+        """
+        Returns the expression of `type` as an argument of `Optional`, `Array`, `Map`
+        or `Union`: its class if it's instantiated without arguments.
+        """
+        field = self.field(type, name)
+        return field[:-2] if field.endswith("()") else field
+
+
+class _Module(_Scope):
+    """
+    The module level names shared by the generators of every function of a module, and
+    the functions still to generate. Constants are expressed in terms of the classes
+    declared by the module.
+    """
+
+    def __init__(self, classes: typing.Mapping[str, type]):
+        super().__init__()
+        self.classes = {cls: name for name, cls in classes.items()}
+        self.functions = []
+        self.pending = []
+        self.generated = {}
+        for cls, name in self.classes.items():
+            if isinstance(cls, type) and issubclass(cls, Struct):
+                self.root(cls, name)
+
+    def expression(self, obj) -> str:
+        if isinstance(obj, type):
+            if obj in self.classes:
+                return self.classes[obj]
+            if getattr(importlib.import_module("bare"), obj.__name__, None) is obj:
+                return f"bare.{obj.__name__}"
+            return f"{_qualified(obj)}.{obj.__qualname__}"
+        return super().expression(obj)
+
+    def function(self, target, kind: str) -> str:
+        key = (target if isinstance(target, type) else id(target), kind)
+        name = self.generated.get(key)
+        if name is None:
+            if isinstance(target, type):
+                label = f"_{self.classes[target]}"
+            else:
+                label = self.constant(
+                    ("obj", id(target)), "_field", lambda: self.expression(target)
+                )
+            name = self.generated[key] = f"{label}_{kind}"
+            self.pending.append((target, kind, name))
+        return name
+
+    def generate(self):
+        while self.pending:
+            target, kind, name = self.pending.pop(0)
+            kind, *flags = kind.split("_")
+            generator = _SymbolicGenerator(
+                self, target, native="native" in flags, trusted="trusted" in flags, name=name
+            )
+            _, source = generator.function(kind)
+            self.functions.append(source)
+
+
+def generate(
+    schema: str, kinds: typing.Iterable[str] = DEFAULT_KINDS, source="a schema"
+) -> str:
+    """
+    Returns the source of a Python module declaring the types of the BARE schema
+    document `schema`, along with their pre-generated codec functions.
+
+    :param kinds: the codec functions to generate for every struct, see `Codec`
+    :param str source: where the schema comes from, mentioned in the module's docstring
+    :raises SchemaError: if the schema is invalid or uses recursive types
+    """
+    for kind in kinds:
+        if not Codec._valid(kind):
+            raise ValueError(f"{kind!r} isn't a kind of codec function")
+    classes = _Classes(parse(schema))
+    header = [
+        '"""',
+        f"Generated by `python -m bare.compile` from {source}, don't edit it by hand.",
+        '"""',
+        "import enum",
+        "import struct",
+        "",
+        "import bare",
+        "from bare.compiler import preload as _preload",
+        *_imports(),
+        "",
+        "",
+    ]
+    declarations = "\n".join(header + classes.lines)
+    namespace = {"__name__": "bare.compile.schema"}
+    exec(compile(declarations, "<bare schema>", "exec"), namespace)
+    module = _Module({name: namespace[name] for name in classes.classes})
+    for name in classes.structs:
+        for kind in kinds:
+            module.function(namespace[name], kind)
+    module.generate()
+    installs = []
+    for name in classes.structs:
+        cls = namespace[name]
+        installs += ["_preload(", f"    {name},"]
+        installs += [
+            f"    {kind}={function},"
+            for (target, kind), function in module.generated.items()
+            if target is cls
+        ]
+        installs.append(")")
+    return "\n".join(
+        [declarations.rstrip("\n"), "", "", "# -- codecs --", "", ""]
+        + ["\n\n".join(module.functions)]
+        + module.constants
+        + [""]
+        + installs
+        + [""]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bare.compile",
+        description="Generates a Python module of classes and codecs from a BARE schema.",
+    )
+    parser.add_argument("schema", help="the schema document, - to read it from stdin")
+    parser.add_argument("-o", "--output", help="the module to write, defaults to stdout")
+    parser.add_argument(
+        "--kinds",
+        default=",".join(DEFAULT_KINDS),
+        help="comma separated codec functions to generate for every struct "
+        f"(default: {','.join(DEFAULT_KINDS)})",
+    )
+    args = parser.parse_args(argv)
+    if args.schema == "-":
+        schema, source = sys.stdin.read(), "stdin"
+    else:
+        with open(args.schema) as f:
+            schema = f.read()
+        source = args.schema
+    try:
+        module = generate(schema, [kind for kind in args.kinds.split(",") if kind], source)
+    except (SchemaError, ValueError) as e:
+        parser.exit(1, f"{source}: {e}\n")
+    if args.output is None:
+        sys.stdout.write(module)
+    else:
+        with open(args.output, "w") as f:
+            f.write(module)
+
+
+if __name__ == "__main__":
+    main()
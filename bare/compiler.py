@@ -0,0 +1,2114 @@
+"""
+bare.compiler turns the field layout of a `Struct` into specialized Python
+functions. Rather than walking `fields()` and dispatching through every
+`Field._pack`/`Field._unpack` for each message, the compiler generates the
+source of one encode and one decode function per `Struct` subclass, with
+Array/Map/Optional/Union handling inlined, and `exec`s it once. Runs of
+consecutive fixed width fields (including nested fixed width structs) are packed
+and unpacked with a single precompiled `struct.Struct`, so a struct made only of
+fixed width members is encoded or decoded in one call.
+
+Two decoders are generated: `read`, which pulls bytes from a file-like object,
+and `decode`, which works directly on a `memoryview` with an integer cursor and
+is used for any bytes-like input (and `io.BytesIO` streams). Likewise `write`
+encodes straight into a preallocated buffer with a cursor, for `pack_into`.
+
+`Struct.pack` and `Struct.unpack` use these functions transparently. Custom
+`Field` subclasses that override `_pack` or `_unpack` are still supported:
+the generated code simply calls into them.
+
+The generated code only refers to the fields it encodes through expressions relative to
+the struct or field it's generated for, so it depends on nothing but the shape of the
+type, which `fingerprint` sums up. Code is compiled once per fingerprint and shared by
+every type of that shape, e.g. the many anonymous `Array(Str)` fields of a schema. When
+`cache_dir` (or the `PYBARE_CACHE_DIR` environment variable) is set, compiled code is
+also kept there, much like `__pycache__`, so new processes load it instead of generating
+it again.
+"""
+import enum
+import hashlib
+import importlib.util
+import io
+import itertools
+import linecache
+import marshal
+import os
+import struct
+import sys
+import tempfile
+import typing
+import weakref
+
+from .encoder import (
+    Array,
+    Field,
+    Map,
+    Optional,
+    Struct,
+    Union,
+    ValidationError,
+    _ValidatedList,
+    _ValidatedMap,
+    _frozen_encoded,
+    _frozen_new,
+    _frozen_validate,
+    _primitive_view,
+    _read_varint,
+    np,
+)
+from .types import Data, DataFixed, Enum, Int, Simple, Str, UInt, Void
+from .varint import (
+    decode_uvarint,
+    decode_varints,
+    encode_uvarint,
+    encode_uvarint_into,
+    encode_varints,
+    encode_varints_into,
+    uvarint_size,
+)
+
+
+class Codec:
+    """
+    Codec holds the generated functions for a single `Struct` subclass, or for a
+    standalone `Field` instance. Each function is generated the first time it is
+    accessed:
+
+    `encode(out, value)` appends the encoded form of `value` to the `bytearray` `out`.
+    `size(value)` returns the number of bytes `encode` would append for `value`.
+    `write(buf, offset, value)` writes the encoded form of `value` into the writable
+    `memoryview` `buf` starting at `offset`, and returns the offset just past it. `buf`
+    must have room for `size(value)` bytes.
+    `read(fp)` decodes one value from the file-like object `fp`.
+    `parse()` returns a generator decoding one value from data pushed into it: it yields
+    the number of bytes it needs next, expects to be sent exactly that many, and returns
+    the value once complete (see `bare.encoder.Decoder`).
+    `decode(buf, offset)` decodes one value from the `memoryview` `buf` starting at
+    `offset`, and returns it along with the offset just past it.
+    `skip(buf, offset)` returns the offset just past the value encoded in `buf` at
+    `offset`, without decoding it.
+
+    `read` and `decode` also come in variants selected by name suffixes, which can
+    be combined (in this order), e.g. `decode_native_trusted`:
+
+    * `_native`: Union members that are plain fields are handed back as their native
+      value rather than wrapped in their `Field` type.
+    * `_trusted`: structs are built without running `__init__` or field validation.
+      Only the checks the wire format itself requires (lengths and Union tags) are done.
+    """
+
+    _kinds = ("encode", "size", "write", "read", "parse", "decode", "skip")
+    _flags = ("native", "trusted")
+
+    def __init__(self, target):
+        self.target = target
+        self.sources = {}
+        self.projections = {}
+        self._building = set()
+        self._fingerprint = None
+        self._tracking = None
+
+    @staticmethod
+    def _valid(name: str) -> bool:
+        kind, *flags = name.split("_")
+        return (
+            kind in Codec._kinds
+            and [flag for flag in Codec._flags if flag in flags] == flags
+            and not (flags and kind in ("encode", "size", "write", "skip"))
+        )
+
+    def __getattr__(self, name):
+        if not Codec._valid(name):
+            raise AttributeError(name)
+        if name in self._building:
+            # a self referencing struct, resolve the function once it exists
+            return lambda *args: getattr(self, name)(*args)
+        self._building.add(name)
+        try:
+            func, self.sources[name] = _build(self, name)
+        finally:
+            self._building.discard(name)
+        return self._install(name, func)
+
+    def _install(self, name: str, func):
+        target = self.target
+        if isinstance(target, type) and target.__schema__.tracked:
+            # tracked structs splice in the encoded fields their instances keep around
+            kind = name.split("_")[0]
+            if self._tracking is None and kind in ("encode", "write", "decode"):
+                self._tracking = _Tracking(target)
+            if kind == "encode":
+                func = self._tracking.encode
+            elif kind == "write":
+                func = self._tracking.write
+            elif kind == "decode":
+                func = self._tracking.remembering(func)
+        elif isinstance(target, type) and target.__schema__.frozen:
+            func = _frozen(target, name, func)
+        setattr(self, name, func)
+        return func
+
+    def get(self, kind: str, native=False, trusted=False):
+        """
+        Returns the `kind` ("read", "parse" or "decode") function with the given options.
+        """
+        return getattr(
+            self, kind + ("_native" if native else "") + ("_trusted" if trusted else "")
+        )
+
+    @property
+    def source(self) -> str:
+        return "\n".join(self.sources.values())
+
+    @property
+    def fingerprint(self) -> str:
+        """The fingerprint of the target, see `fingerprint`"""
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint(self.target)
+        return self._fingerprint
+
+
+def _pack_primitives(values, fmt: str):
+    """
+    Packs a whole sequence of fixed width numbers in one call, or returns None if it
+    can't, e.g. because some items are wrapped in their `Field` type. Buffers that
+    are already laid out like `fmt` (ndarrays, `array.array`...) are used as is.
+    """
+    view = _primitive_view(values, fmt)
+    if view is not None:
+        return view if view.c_contiguous else view.tobytes()
+    if fmt == "<?" and any(isinstance(value, Field) for value in values):
+        return None  # wrapped values are truthy, they'd all pack as True
+    try:
+        return struct.pack(f"<{len(values)}{fmt[1:]}", *values)
+    except struct.error:
+        return None
+
+
+def _pack_primitives_into(buf, pos: int, values, fmt: str) -> typing.Optional[int]:
+    """
+    Like `_pack_primitives`, but writes the packed numbers into `buf` at `pos` and
+    returns the offset just past them, or None if they can't be packed in one call.
+    """
+    view = _primitive_view(values, fmt)
+    if view is not None:
+        end = pos + view.nbytes
+        buf[pos:end] = view.cast("B") if view.c_contiguous else view.tobytes()
+        return end
+    if fmt == "<?" and any(isinstance(value, Field) for value in values):
+        return None
+    fmt = f"<{len(values)}{fmt[1:]}"
+    try:
+        struct.pack_into(fmt, buf, pos, *values)
+    except struct.error:
+        return None
+    return pos + struct.calcsize(fmt)
+
+
+def _unpack_primitives(fmt: str, count: int, buf, pos: int) -> list:
+    return list(struct.unpack_from(f"<{count}{fmt[1:]}", buf, pos))
+
+
+def _decode_ndarray(fmt: str, count: int, buf, pos: int):
+    array = np.frombuffer(buf, dtype=np.dtype(fmt), count=count, offset=pos)
+    if not memoryview(buf).readonly:
+        # don't alias memory that may change under the decoded value
+        array = array.copy()
+    return array
+
+
+def _parse_varint(signed: bool):
+    output = 0
+    shift = 0
+    while True:
+        b = (yield 1)[0]
+        output |= (b & 0x7F) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    if signed:
+        return (output >> 1) ^ -(output & 1)
+    return output
+
+
+class _ExactReader:
+    """
+    _ExactReader hands the data of a custom field to its `_unpack`, raising `_truncated()`
+    instead of returning fewer bytes than were asked for, so that a value cut short by
+    the end of the data available so far isn't mistaken for a complete one.
+    """
+
+    def __init__(self, data):
+        self.fp = io.BytesIO(data)
+
+    def read(self, size=-1) -> bytes:
+        data = self.fp.read(size)
+        if size is not None and 0 <= size != len(data):
+            raise _truncated()
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+def _parse_custom(field: Field):
+    # the size of a custom field's encoding is unknown, so retry byte by byte
+    data = b""
+    while True:
+        data += yield 1
+        fp = _ExactReader(data)
+        try:
+            value = field._unpack(fp).value
+        except (IndexError, struct.error, RuntimeError, UnicodeDecodeError):
+            continue
+        if fp.tell() == len(data):
+            return value
+
+
+def _truncated():
+    return RuntimeError("Not enough bytes in buffer to decode")
+
+
+def _decode_custom(field: Field, buf, pos: int):
+    # reads past the end of the buffer are reported like any other truncated value
+    fp = _ExactReader(buf[pos:])
+    value = field._unpack(fp).value
+    return value, pos + fp.tell()
+
+
+def _overrides(field: Field, base: type) -> bool:
+    cls = type(field)
+    return cls._pack is not base._pack or cls._unpack is not base._unpack
+
+
+def _kind(field) -> str:
+    """
+    Classifies a field instance into one of the shapes the code generator knows
+    how to inline. Anything unknown, or any known type whose `_pack`/`_unpack`
+    has been overridden by a subclass, is treated as "custom".
+    """
+    if isinstance(field, Struct):
+        return "struct"
+    checks = (
+        (Optional, "optional"),
+        (Union, "union"),
+        (Array, "array"),
+        (Map, "map"),
+        (Enum, "enum"),
+        (UInt, "uint"),
+        (Int, "int"),
+        (Str, "str"),
+        (Data, "data"),
+        (DataFixed, "datafixed"),
+        (Void, "void"),
+    )
+    for base, kind in checks:
+        if isinstance(field, base):
+            return "custom" if _overrides(field, base) else kind
+    if isinstance(field, Simple) and field._fmt is not None:
+        return "custom" if _overrides(field, Simple) else "simple"
+    return "custom"
+
+
+def _primitive_format(field) -> typing.Optional[str]:
+    """
+    Returns the little endian `struct` format of a fixed width number field, for
+    which whole arrays can be packed and unpacked in one call.
+    """
+    if _kind(field) == "simple" and field._fmt.startswith("<"):
+        return field._fmt
+    return None
+
+
+def _fixed_leaves(field) -> typing.Optional[typing.List[Field]]:
+    """
+    Returns the fixed width primitives `field` is made of, flattening nested fixed
+    width structs, or None if its encoding isn't a fixed `struct` format.
+    """
+    kind = _kind(field)
+    if kind == "simple" and field._fmt.startswith("<"):
+        return [field]
+    if kind in ("datafixed", "void"):
+        return [field]
+    if kind == "struct":
+        if type(field).__schema__.interned is not None:
+            return None  # decoded by its own codec, which interns it
+        leaves = []
+        for nested in type(field).__schema__.fields.values():
+            nested_leaves = _fixed_leaves(nested)
+            if nested_leaves is None:
+                return None
+            leaves.extend(nested_leaves)
+        return leaves
+    return None
+
+
+def _fixed_format(leaves: typing.List[Field]) -> str:
+    fmt = ["<"]
+    for leaf in leaves:
+        if isinstance(leaf, Simple):
+            fmt.append(leaf._fmt[1:])
+        elif isinstance(leaf, DataFixed):
+            fmt.append(f"{leaf._length}s")
+    return "".join(fmt)
+
+
+def _runs(schema) -> typing.Iterator[typing.Tuple[typing.Optional[str], list]]:
+    """
+    Splits the fields of a struct into runs of consecutive fixed width fields, which
+    are packed with a single `struct` format, and the remaining variable width fields.
+    Yields `(format, [(name, field), ...])` for fixed runs and `(None, [(name, field)])`
+    for everything else.
+    """
+    run, leaves = [], []
+    for name, field in schema.fields.items():
+        field_leaves = _fixed_leaves(field)
+        if field_leaves is None:
+            if run:
+                yield _fixed_format(leaves), run
+                run, leaves = [], []
+            yield None, [(name, field)]
+        else:
+            run.append((name, field))
+            leaves.extend(field_leaves)
+    if run:
+        yield _fixed_format(leaves), run
+
+
+# unions with more members than this dispatch on their tag through tuples of the
+# members' functions, rather than testing every tag in turn
+DISPATCH_THRESHOLD = 8
+
+
+def _dispatched(field: Union) -> bool:
+    return len(field._members) > DISPATCH_THRESHOLD
+
+
+def _shape(field) -> tuple:
+    """
+    Returns a hashable description of everything that determines how `field` is
+    encoded. Fields with the same shape can share one codec.
+    """
+    kind = _kind(field)
+    if kind == "struct":
+        return (kind, type(field))
+    if kind == "custom":
+        return (kind, field)
+    if kind == "optional":
+        return (kind, type(field), _shape(field._wrapped))
+    if kind == "union":
+        return (kind, type(field), tuple(_shape(member) for member in field._members))
+    if kind == "array":
+        return (kind, type(field), field._length, field._numpy, _shape(field._type))
+    if kind == "map":
+        return (kind, type(field), _shape(field._keytype), _shape(field._valuetype))
+    if kind == "enum":
+        return (kind, type(field), field._enum)
+    if kind == "datafixed":
+        return (kind, type(field), field._length)
+    return (kind, type(field))
+
+
+def _setter(field) -> str:
+    # how trusted decoders store a field's value, see `_Generator.construct`
+    setter = getattr(type(field), "__set__", None)
+    if setter is Map.__set__:
+        return "map"
+    if setter in (None, Field.__set__, Optional.__set__):
+        return "plain"
+    return "custom"
+
+
+class _Description:
+    """
+    Builds the canonical description of a struct or field graph that `fingerprint`
+    hashes. Types and field instances are numbered in the order they're first reached,
+    so graphs with the same description use the same types and instances in the same
+    places, and a struct reached again (e.g. through a self reference) is only referred
+    to by its number.
+    """
+
+    def __init__(self):
+        self.types = {}
+        self.fields = {}
+
+    def type(self, cls: type) -> tuple:
+        if cls in self.types:
+            return (self.types[cls],)
+        index = self.types[cls] = len(self.types)
+        description = (index, f"{cls.__module__}.{cls.__qualname__}")
+        if issubclass(cls, Struct):
+            schema = cls.__schema__
+            fields = tuple(
+                (name, schema.attrs[name], _setter(field), self.field(field))
+                for name, field in schema.fields.items()
+            )
+            interned = schema.interned is not None
+            description += (schema.compact, schema.tracked, schema.frozen, interned, fields)
+        return description
+
+    def field(self, field) -> tuple:
+        if id(field) in self.fields:
+            return (self.fields[id(field)],)
+        self.fields[id(field)] = len(self.fields)
+        kind = _kind(field)
+        # sizes are baked into sizing and skipping code, even those of custom fields
+        description = (kind, self.type(type(field)), field._fixed_size())
+        if kind == "simple":
+            description += (field._fmt,)
+        elif kind == "datafixed":
+            description += (field._length,)
+        elif kind == "optional":
+            description += (self.field(field._wrapped),)
+        elif kind == "array":
+            description += (field._length, field._numpy, self.field(field._type))
+        elif kind == "map":
+            description += (self.field(field._keytype), self.field(field._valuetype))
+        elif kind == "union":
+            description += tuple(self.field(member) for member in field._members)
+        return description
+
+
+def fingerprint(target) -> str:
+    """
+    Returns the fingerprint of a `Struct` subclass or `Field` instance: a digest of the
+    order, names, types, lengths and Union members of its fields, recursively. Types
+    with the same fingerprint are encoded the same way by the same generated code,
+    struct class names aside.
+    """
+    description = _Description()
+    if isinstance(target, type):
+        description = description.type(target)
+    else:
+        description = description.field(target)
+    return hashlib.sha256(repr(description).encode()).hexdigest()[:32]
+
+
+# the helpers generated functions refer to, under the names they use
+_NAMESPACE = {
+    "Field": Field,
+    "Struct": Struct,
+    "ValidationError": ValidationError,
+    "_ValidatedMap": _ValidatedMap,
+    "_frozen_new": _frozen_new,
+    "_frozen_validate": _frozen_validate,
+    "_write_uvarint": encode_uvarint,
+    "_write_uvarint_into": encode_uvarint_into,
+    "_read_varint": _read_varint,
+    "_decode_uvarint": decode_uvarint,
+    "_encode_varints": encode_varints,
+    "_encode_varints_into": encode_varints_into,
+    "_decode_varints": decode_varints,
+    "_uvarint_size": uvarint_size,
+    "_decode_custom": _decode_custom,
+    "_parse_varint": _parse_varint,
+    "_parse_custom": _parse_custom,
+    "_pack_primitives": _pack_primitives,
+    "_pack_primitives_into": _pack_primitives_into,
+    "_unpack_primitives": _unpack_primitives,
+    "_decode_ndarray": _decode_ndarray,
+    "_truncated": _truncated,
+    "_BytesIO": io.BytesIO,
+    "_repeat": itertools.repeat,
+    "_chain": itertools.chain,
+}
+
+
+class _Generator:
+    """
+    Accumulates the source of a generated function along with the namespace it is
+    executed in. Constants (struct formats, nested codecs, member instances) are
+    bound as globals of the generated function so lookups stay cheap.
+    """
+
+    def __init__(self, target, native=False, trusted=False):
+        self.target = target
+        self.native = native
+        self.trusted = trusted
+        self.suffix = ("_native" if native else "") + ("_trusted" if trusted else "")
+        # generating a resumable `parse` generator rather than a stream `read`
+        self.parsing = False
+        self.lines = []
+        self.namespace = dict(_NAMESPACE)
+        self._counter = 0
+        self._consts = {}
+
+    def local(self, prefix="v") -> str:
+        self._counter += 1
+        return f"{prefix}{self._counter}"
+
+    def const(self, obj, prefix="_c") -> str:
+        key = (prefix, id(obj))
+        if key in self._consts:
+            return self._consts[key]
+        name = self.local(prefix)
+        self._consts[key] = name
+        self.namespace[name] = obj
+        return name
+
+    def alias(self, expr: str, prefix="_c") -> str:
+        """
+        Binds the value of `expr`, an expression over the constants bound so far, to a
+        new constant and returns its name.
+        """
+        name = self.local(prefix)
+        self.namespace[name] = eval(expr, self.namespace)
+        return name
+
+    def codec_function(self, target, kind: str) -> str:
+        """
+        Binds the `kind` function of the codec of `target`, a `Struct` subclass or a
+        `Field` instance, and returns the name it's bound to.
+        """
+        if isinstance(target, type):
+            function = _nested(target, kind)
+        else:
+            function = getattr(compile_field(target), kind)
+        return self.const(function, f"_{kind.split('_')[0]}")
+
+    def struct_fmt(self, fmt: str) -> str:
+        key = ("_s", fmt)
+        if key not in self._consts:
+            name = self.local("_s")
+            self._consts[key] = name
+            self.namespace[name] = struct.Struct(fmt)
+        return self._consts[key]
+
+    def emit(self, indent: int, line: str):
+        self.lines.append("    " * indent + line)
+
+    # -- encoding --
+
+    def encode(self, field, var: str, indent: int):
+        kind = _kind(field)
+        emit = self.emit
+        if kind == "struct":
+            enc = self.codec_function(type(field), "encode")
+            emit(indent, f"{enc}(out, {var})")
+        elif kind == "simple":
+            s = self.struct_fmt(field._fmt)
+            emit(indent, f"out += {s}.pack({var})")
+        elif kind in ("uint", "enum"):
+            self.encode_uvarint(var, indent)
+        elif kind == "int":
+            emit(indent, f"{var} = {var} * 2 if {var} >= 0 else -2 * {var} - 1")
+            self.encode_uvarint(var, indent)
+        elif kind == "str":
+            b = self.local("b")
+            emit(indent, f"{b} = {var}.encode('utf-8')")
+            self.encode_uvarint(f"len({b})", indent)
+            emit(indent, f"out += {b}")
+        elif kind == "data":
+            self.encode_uvarint(f"len({var})", indent)
+            emit(indent, f"out += {var}")
+        elif kind == "datafixed":
+            s = self.struct_fmt(f"<{field._length}s")
+            emit(indent, f"out += {s}.pack({var})")
+        elif kind == "void":
+            pass
+        elif kind == "optional":
+            emit(indent, f"if {var} is None:")
+            emit(indent + 1, "out.append(0)")
+            emit(indent, "else:")
+            emit(indent + 1, "out.append(1)")
+            self.encode(field._wrapped, var, indent + 1)
+        elif kind == "array":
+            self.encode_array(field, var, indent)
+        elif kind == "map":
+            k, v = self.local("k"), self.local("v")
+            self.encode_uvarint(f"len({var})", indent)
+            emit(indent, f"for {k}, {v} in {var}.items():")
+            self.encode(field._keytype, k, indent + 1)
+            self.encode(field._valuetype, v, indent + 1)
+        elif kind == "union":
+            self.encode_union(field, var, indent)
+        else:
+            f = self.const(field, "_f")
+            buf = self.local("fp")
+            emit(indent, f"{buf} = _BytesIO()")
+            emit(indent, f"{f}._pack({buf}, value={var})")
+            emit(indent, f"out += {buf}.getvalue()")
+
+    def encode_uvarint(self, expr: str, indent: int):
+        n = self.local("n")
+        self.emit(indent, f"{n} = {expr}")
+        self.emit(indent, f"if {n} < 0x80:")
+        self.emit(indent + 1, f"out.append({n})")
+        self.emit(indent, "else:")
+        self.emit(indent + 1, f"_write_uvarint(out, {n})")
+
+    def encode_array(self, field: Array, var: str, indent: int):
+        item = self.local("x")
+        element = field._type
+        fmt = _primitive_format(element)
+        if field._length == 0:
+            self.encode_uvarint(f"len({var})", indent)
+        if fmt is not None:
+            # fixed width numbers are packed in one call, falling back to the
+            # loop below for anything that can't be, e.g. wrapped values
+            b = self.local("b")
+            call = f"_pack_primitives({var}, {fmt!r})"
+            if field._length > 0:
+                call = f"{call} if len({var}) == {field._length} else None"
+            self.emit(indent, f"{b} = {call}")
+            self.emit(indent, f"if {b} is not None:")
+            self.emit(indent + 1, f"out += {b}")
+            self.emit(indent, "else:")
+            indent += 1
+        elif _kind(element) in ("uint", "enum", "int"):
+            # likewise varints are encoded in one pass over the whole sequence
+            call = f"_encode_varints(out, {var}, {_kind(element) == 'int'})"
+            if field._length > 0:
+                call = f"len({var}) == {field._length} and {call}"
+            self.emit(indent, f"if not ({call}):")
+            indent += 1
+        self.array_items(field, var, item, indent)
+        self.encode(element, item, indent + 1)
+
+    def array_items(self, field: Array, var: str, item: str, indent: int):
+        """
+        Emits the loop binding `item` to each (unwrapped) element of the array `var`.
+        """
+        element = field._type
+        if field._length == 0:
+            self.emit(indent, f"for {item} in {var}:")
+        else:
+            # fixed length arrays are padded with the element's default value
+            if isinstance(element, Struct):
+                default = f"{self.const(type(element), '_cls')}()"
+            else:
+                default = self.alias(f"{self.const(element, '_e')}._default", "_default")
+            self.emit(
+                indent,
+                f"for {item} in _chain({var}, _repeat({default}, {field._length} - len({var}))):",
+            )
+        if not isinstance(element, Struct):
+            self.emit(indent + 1, f"if isinstance({item}, Field):")
+            self.emit(indent + 2, f"{item} = {item}._value")
+
+    def encode_union(self, field: Union, var: str, indent: int):
+        tag = self.union_tag(field, var, indent)
+        if _dispatched(field):
+            encoders = self.member_table(field, "encode")
+            self.encode_uvarint(tag, indent)
+            self.emit(indent, f"{encoders}[{tag}](out, {var})")
+            return
+        for i, member in enumerate(field._members):
+            self.emit(indent, f"{'if' if i == 0 else 'elif'} {tag} == {i}:")
+            if i < 0x80:
+                self.emit(indent + 1, f"out.append({i})")
+            else:
+                self.emit(indent + 1, f"_write_uvarint(out, {i})")
+            self.encode(member, var, indent + 1)
+
+    def union_tag(self, field: Union, var: str, indent: int) -> str:
+        """
+        Emits the lookup of the member tag of the Union value `var`, unwrapping it if
+        it's a plain field, and returns the name the tag is bound to. Values that aren't
+        instances of a member type (native and `Tagged` values) go through `Union.tag`.
+        """
+        tag = self.local("tag")
+        members = field._members
+        fallback = f"{tag}, {var} = {self.const(field, '_u')}.tag({var})"
+        if _dispatched(field):
+            fields, structs, seen = [], [], set()
+            for i, member in enumerate(members):
+                if type(member) not in seen:
+                    seen.add(type(member))
+                    tags = structs if isinstance(member, Struct) else fields
+                    tags.append(f"{self.const(type(member), '_t')}: {i}")
+            fields = self.alias(f"{{{', '.join(fields)}}}", "_tags")
+            structs = self.alias(f"{{{', '.join(structs)}}}", "_tags")
+            self.emit(indent, f"{tag} = {fields}.get(type({var}))")
+            self.emit(indent, f"if {tag} is not None:")
+            self.emit(indent + 1, f"{var} = {var}._value")
+            self.emit(indent, "else:")
+            self.emit(indent + 1, f"{tag} = {structs}.get(type({var}))")
+            self.emit(indent + 1, f"if {tag} is None:")
+            self.emit(indent + 2, fallback)
+            return tag
+        first = True
+        seen = set()
+        for i, member in enumerate(members):
+            if type(member) in seen:
+                continue
+            seen.add(type(member))
+            t = self.const(type(member), "_t")
+            self.emit(indent, f"{'if' if first else 'elif'} type({var}) is {t}:")
+            self.emit(indent + 1, f"{tag} = {i}")
+            if not isinstance(member, Struct):
+                self.emit(indent + 1, f"{var} = {var}._value")
+            first = False
+        if first:
+            self.emit(indent, fallback)
+        else:
+            self.emit(indent, "else:")
+            self.emit(indent + 1, fallback)
+        return tag
+
+    def member_table(self, field: Union, kind: str) -> str:
+        """
+        Returns the name of a tuple of the `kind` functions of the members of the Union
+        `field`, indexed by tag, which large unions dispatch through.
+        """
+        functions = [
+            self.codec_function(type(member) if isinstance(member, Struct) else member, kind)
+            for member in field._members
+        ]
+        return self.alias(f"({', '.join(functions)},)", f"_{kind.split('_')[0]}s")
+
+    def union_decoded(self, field: Union, tag: str, target: str, indent: int):
+        """
+        Emits the wrapping of `target`, decoded by a member table, in its member's
+        field type unless decoding native values.
+        """
+        if self.native or all(isinstance(member, Struct) for member in field._members):
+            return
+        wraps = [
+            "None" if isinstance(member, Struct) else f"{self.const(member, '_m')}._wrap"
+            for member in field._members
+        ]
+        wraps = self.alias(f"({', '.join(wraps)},)", "_wraps")
+        w = self.local("w")
+        self.emit(indent, f"{w} = {wraps}[{tag}]")
+        self.emit(indent, f"if {w} is not None:")
+        self.emit(indent + 1, f"{target} = {w}({target})")
+
+    def invalid_tag(self, field: Union, tag: str, indent: int):
+        self.emit(indent, f"if {tag} >= {len(field._members)}:")
+        self.emit(indent + 1, f"raise ValidationError(f'Invalid tag {{{tag}}} for union')")
+
+    # -- encoding into a buffer, at the cursor `pos` --
+
+    def write(self, field, var: str, indent: int):
+        kind = _kind(field)
+        emit = self.emit
+        fixed = field._fixed_size()
+        if kind == "struct":
+            write = self.codec_function(type(field), "write")
+            emit(indent, f"pos = {write}(buf, pos, {var})")
+        elif kind == "simple":
+            s = self.struct_fmt(field._fmt)
+            emit(indent, f"{s}.pack_into(buf, pos, {var})")
+            emit(indent, f"pos += {fixed}")
+        elif kind in ("uint", "enum"):
+            self.write_uvarint(var, indent)
+        elif kind == "int":
+            emit(indent, f"{var} = {var} * 2 if {var} >= 0 else -2 * {var} - 1")
+            self.write_uvarint(var, indent)
+        elif kind in ("str", "data"):
+            b = var
+            if kind == "str":
+                b = self.local("b")
+                emit(indent, f"{b} = {var}.encode('utf-8')")
+            n = self.write_uvarint(f"len({b})", indent)
+            self.write_bytes(b, indent, n)
+        elif kind == "datafixed":
+            s = self.struct_fmt(f"<{field._length}s")
+            emit(indent, f"{s}.pack_into(buf, pos, {var})")
+            emit(indent, f"pos += {fixed}")
+        elif kind == "void":
+            pass
+        elif kind == "optional":
+            emit(indent, f"if {var} is None:")
+            emit(indent + 1, "buf[pos] = 0")
+            emit(indent + 1, "pos += 1")
+            emit(indent, "else:")
+            emit(indent + 1, "buf[pos] = 1")
+            emit(indent + 1, "pos += 1")
+            self.write(field._wrapped, var, indent + 1)
+        elif kind == "array":
+            self.write_array(field, var, indent)
+        elif kind == "map":
+            k, v = self.local("k"), self.local("v")
+            self.write_uvarint(f"len({var})", indent)
+            emit(indent, f"for {k}, {v} in {var}.items():")
+            self.write(field._keytype, k, indent + 1)
+            self.write(field._valuetype, v, indent + 1)
+        elif kind == "union":
+            tag = self.union_tag(field, var, indent)
+            if _dispatched(field):
+                writers = self.member_table(field, "write")
+                self.write_uvarint(tag, indent)
+                emit(indent, f"pos = {writers}[{tag}](buf, pos, {var})")
+                return
+            for i, member in enumerate(field._members):
+                emit(indent, f"{'if' if i == 0 else 'elif'} {tag} == {i}:")
+                if i < 0x80:
+                    emit(indent + 1, f"buf[pos] = {i}")
+                    emit(indent + 1, "pos += 1")
+                else:
+                    emit(indent + 1, f"pos = _write_uvarint_into(buf, pos, {i})")
+                self.write(member, var, indent + 1)
+        else:
+            f = self.const(field, "_f")
+            fp = self.local("fp")
+            emit(indent, f"{fp} = _BytesIO()")
+            emit(indent, f"{f}._pack({fp}, value={var})")
+            self.write_bytes(f"{fp}.getbuffer()", indent)
+
+    def write_uvarint(self, expr: str, indent: int) -> str:
+        """Emits the writing of the varint `expr`, and returns the name it's bound to"""
+        n = self.local("n")
+        self.emit(indent, f"{n} = {expr}")
+        self.emit(indent, f"if {n} < 0x80:")
+        self.emit(indent + 1, f"buf[pos] = {n}")
+        self.emit(indent + 1, "pos += 1")
+        self.emit(indent, "else:")
+        self.emit(indent + 1, f"pos = _write_uvarint_into(buf, pos, {n})")
+        return n
+
+    def write_bytes(self, expr: str, indent: int, length: str = None):
+        end = self.local("end")
+        self.emit(indent, f"{end} = pos + {length or f'len({expr})'}")
+        self.emit(indent, f"buf[pos:{end}] = {expr}")
+        self.emit(indent, f"pos = {end}")
+
+    def write_array(self, field: Array, var: str, indent: int):
+        item = self.local("x")
+        element = field._type
+        fmt = _primitive_format(element)
+        if field._length == 0:
+            self.write_uvarint(f"len({var})", indent)
+        if fmt is not None or _kind(element) in ("uint", "enum", "int"):
+            # written in one go like `encode_array` does, or by the loop below
+            end = self.local("end")
+            if fmt is not None:
+                call = f"_pack_primitives_into(buf, pos, {var}, {fmt!r})"
+            else:
+                call = f"_encode_varints_into(buf, pos, {var}, {_kind(element) == 'int'})"
+            if field._length > 0:
+                call = f"{call} if len({var}) == {field._length} else None"
+            self.emit(indent, f"{end} = {call}")
+            self.emit(indent, f"if {end} is not None:")
+            self.emit(indent + 1, f"pos = {end}")
+            self.emit(indent, "else:")
+            indent += 1
+        self.array_items(field, var, item, indent)
+        self.write(element, item, indent + 1)
+
+    # -- encoded sizes --
+
+    def size(self, field, var: str, indent: int):
+        """
+        Emits the statements adding the encoded size of `var` to the local `size`.
+        """
+        kind = _kind(field)
+        emit = self.emit
+        fixed = field._fixed_size()
+        if fixed is not None:
+            emit(indent, f"size += {fixed}")
+        elif kind == "struct":
+            size = self.codec_function(type(field), "size")
+            emit(indent, f"size += {size}({var})")
+        elif kind in ("uint", "enum"):
+            emit(indent, f"size += _uvarint_size({var})")
+        elif kind == "int":
+            emit(indent, f"size += _uvarint_size({var} * 2 if {var} >= 0 else -2 * {var} - 1)")
+        elif kind in ("str", "data"):
+            n = self.local("n")
+            if kind == "str":
+                emit(indent, f"{n} = len({var}.encode('utf-8'))")
+            else:
+                emit(indent, f"{n} = len({var})")
+            emit(indent, f"size += _uvarint_size({n}) + {n}")
+        elif kind == "optional":
+            emit(indent, "size += 1")
+            emit(indent, f"if {var} is not None:")
+            self.size(field._wrapped, var, indent + 1)
+        elif kind == "array":
+            element = field._type
+            if field._length == 0:
+                emit(indent, f"size += _uvarint_size(len({var}))")
+            fixed = element._fixed_size()
+            if fixed is not None:
+                # only variable length arrays of fixed width elements get here
+                emit(indent, f"size += len({var}) * {fixed}")
+                return
+            item = self.local("x")
+            self.array_items(field, var, item, indent)
+            self.size(element, item, indent + 1)
+        elif kind == "map":
+            k, v = self.local("k"), self.local("v")
+            emit(indent, f"size += _uvarint_size(len({var}))")
+            emit(indent, f"for {k}, {v} in {var}.items():")
+            self.size(field._keytype, k, indent + 1)
+            self.size(field._valuetype, v, indent + 1)
+        elif kind == "union":
+            tag = self.union_tag(field, var, indent)
+            if _dispatched(field):
+                sizes = self.member_table(field, "size")
+                emit(indent, f"size += _uvarint_size({tag}) + {sizes}[{tag}]({var})")
+                return
+            for i, member in enumerate(field._members):
+                emit(indent, f"{'if' if i == 0 else 'elif'} {tag} == {i}:")
+                emit(indent + 1, f"size += {uvarint_size(i)}")
+                self.size(member, var, indent + 1)
+        else:
+            f = self.const(field, "_f")
+            buf = self.local("fp")
+            emit(indent, f"{buf} = _BytesIO()")
+            emit(indent, f"{f}._pack({buf}, value={var})")
+            emit(indent, f"size += len({buf}.getvalue())")
+
+    # -- decoding from a stream, or from pushed data when parsing --
+
+    def take(self, n) -> str:
+        """
+        Returns the expression reading `n` bytes, from the stream or, when generating
+        a parser, from the bytes sent in for the count yielded.
+        """
+        return f"(yield {n})" if self.parsing else f"read({n})"
+
+    def varint(self, signed: bool) -> str:
+        if self.parsing:
+            return f"(yield from _parse_varint({signed}))"
+        return f"_read_varint(fp, signed={signed})"
+
+    def read(self, field, target: str, indent: int):
+        kind = _kind(field)
+        emit = self.emit
+        if kind == "struct":
+            if self.parsing:
+                dec = self.codec_function(type(field), "parse" + self.suffix)
+                emit(indent, f"{target} = yield from {dec}()")
+            else:
+                dec = self.codec_function(type(field), "read" + self.suffix)
+                emit(indent, f"{target} = {dec}(fp)")
+        elif kind == "simple":
+            s = self.struct_fmt(field._fmt)
+            emit(indent, f"{target}, = {s}.unpack({self.take(field._bytesize)})")
+        elif kind in ("uint", "enum"):
+            emit(indent, f"{target} = {self.varint(False)}")
+        elif kind == "int":
+            emit(indent, f"{target} = {self.varint(True)}")
+        elif kind == "str":
+            emit(indent, f"{target} = {self.take(self.varint(False))}.decode('utf-8')")
+        elif kind == "data":
+            emit(indent, f"{target} = {self.take(self.varint(False))}")
+        elif kind == "datafixed":
+            emit(indent, f"{target} = {self.take(field._length)}")
+        elif kind == "void":
+            emit(indent, f"{target} = None")
+        elif kind == "optional":
+            s = self.struct_fmt("<B")
+            emit(indent, f"if {s}.unpack({self.take(1)})[0] == 0:")
+            emit(indent + 1, f"{target} = None")
+            emit(indent, "else:")
+            self.read(field._wrapped, target, indent + 1)
+        elif kind == "array":
+            n = self.local("n")
+            item = self.local("x")
+            if field._length == 0:
+                emit(indent, f"{n} = {self.varint(False)}")
+            else:
+                emit(indent, f"{n} = {field._length}")
+            fmt = _primitive_format(field._type)
+            if fmt is not None:
+                size = field._type._bytesize
+                data = self.local("b")
+                emit(indent, f"{data} = {self.take(f'{n} * {size}')}")
+                if field._numpy:
+                    emit(indent, f"if len({data}) != {n} * {size}:")
+                    emit(indent + 1, "raise _truncated()")
+                    emit(indent, f"{target} = _decode_ndarray({fmt!r}, {n}, {data}, 0)")
+                else:
+                    emit(indent, f"{target} = _unpack_primitives({fmt!r}, {n}, {data}, 0)")
+                return
+            emit(indent, f"{target} = []")
+            emit(indent, f"for _ in range({n}):")
+            self.read(field._type, item, indent + 1)
+            emit(indent + 1, f"{target}.append({item})")
+        elif kind == "map":
+            k, v = self.local("k"), self.local("v")
+            emit(indent, f"{target} = {{}}")
+            emit(indent, f"for _ in range({self.varint(False)}):")
+            self.read(field._keytype, k, indent + 1)
+            self.read(field._valuetype, v, indent + 1)
+            emit(indent + 1, f"{target}[{k}] = {v}")
+        elif kind == "union":
+            tag = self.local("tag")
+            emit(indent, f"{tag} = {self.varint(False)}")
+            if _dispatched(field) and not self.parsing:
+                self.invalid_tag(field, tag, indent)
+                readers = self.member_table(field, "read" + self.suffix)
+                emit(indent, f"{target} = {readers}[{tag}](fp)")
+                self.union_decoded(field, tag, target, indent)
+                return
+            for i, member in enumerate(field._members):
+                emit(indent, f"{'if' if i == 0 else 'elif'} {tag} == {i}:")
+                self.read(member, target, indent + 1)
+                if not isinstance(member, Struct) and not self.native:
+                    # plain field members are handed back wrapped, so the member
+                    # type (and therefore the tag) survives a round trip
+                    m = self.const(member, "_m")
+                    emit(indent + 1, f"{target} = {m}._wrap({target})")
+            emit(indent, "else:" if field._members else "if True:")
+            emit(
+                indent + 1,
+                f"raise ValidationError(f'Invalid tag {{{tag}}} for union')",
+            )
+        else:
+            f = self.const(field, "_f")
+            if self.parsing:
+                emit(indent, f"{target} = yield from _parse_custom({f})")
+            else:
+                emit(indent, f"{target} = {f}._unpack(fp).value")
+
+    # -- decoding from a buffer --
+
+    def decode_uvarint(self, target: str, indent: int):
+        self.emit(indent, f"{target} = buf[pos]")
+        self.emit(indent, f"if {target} < 0x80:")
+        self.emit(indent + 1, "pos += 1")
+        self.emit(indent, "else:")
+        self.emit(indent + 1, f"{target}, pos = _decode_uvarint(buf, pos)")
+
+    def decode_slice(self, length: str, indent: int) -> str:
+        end = self.local("end")
+        self.emit(indent, f"{end} = pos + {length}")
+        self.emit(indent, f"if {end} > len(buf):")
+        self.emit(indent + 1, "raise _truncated()")
+        return end
+
+    def decode(self, field, target: str, indent: int):
+        kind = _kind(field)
+        emit = self.emit
+        if kind == "struct":
+            dec = self.codec_function(type(field), "decode" + self.suffix)
+            emit(indent, f"{target}, pos = {dec}(buf, pos)")
+        elif kind == "simple":
+            s = self.struct_fmt(field._fmt)
+            emit(indent, f"{target}, = {s}.unpack_from(buf, pos)")
+            emit(indent, f"pos += {field._bytesize}")
+        elif kind in ("uint", "enum"):
+            self.decode_uvarint(target, indent)
+        elif kind == "int":
+            self.decode_uvarint(target, indent)
+            emit(indent, f"{target} = ({target} >> 1) ^ -({target} & 1)")
+        elif kind in ("str", "data"):
+            n = self.local("n")
+            self.decode_uvarint(n, indent)
+            end = self.decode_slice(n, indent)
+            if kind == "str":
+                emit(indent, f"{target} = str(buf[pos:{end}], 'utf-8')")
+            else:
+                emit(indent, f"{target} = bytes(buf[pos:{end}])")
+            emit(indent, f"pos = {end}")
+        elif kind == "datafixed":
+            end = self.decode_slice(str(field._length), indent)
+            emit(indent, f"{target} = bytes(buf[pos:{end}])")
+            emit(indent, f"pos = {end}")
+        elif kind == "void":
+            emit(indent, f"{target} = None")
+        elif kind == "optional":
+            emit(indent, "pos += 1")
+            emit(indent, "if buf[pos - 1] == 0:")
+            emit(indent + 1, f"{target} = None")
+            emit(indent, "else:")
+            self.decode(field._wrapped, target, indent + 1)
+        elif kind == "array":
+            n = self.local("n")
+            item = self.local("x")
+            if field._length == 0:
+                self.decode_uvarint(n, indent)
+            else:
+                emit(indent, f"{n} = {field._length}")
+            fmt = _primitive_format(field._type)
+            if fmt is not None:
+                end = self.decode_slice(f"{n} * {field._type._bytesize}", indent)
+                if field._numpy:
+                    emit(indent, f"{target} = _decode_ndarray({fmt!r}, {n}, buf, pos)")
+                else:
+                    emit(indent, f"{target} = _unpack_primitives({fmt!r}, {n}, buf, pos)")
+                emit(indent, f"pos = {end}")
+                return
+            if _kind(field._type) in ("uint", "enum", "int"):
+                signed = _kind(field._type) == "int"
+                emit(indent, f"{target}, pos = _decode_varints(buf, pos, {n}, {signed})")
+                return
+            emit(indent, f"{target} = []")
+            emit(indent, f"for _ in range({n}):")
+            self.decode(field._type, item, indent + 1)
+            emit(indent + 1, f"{target}.append({item})")
+        elif kind == "map":
+            n = self.local("n")
+            k, v = self.local("k"), self.local("v")
+            self.decode_uvarint(n, indent)
+            emit(indent, f"{target} = {{}}")
+            emit(indent, f"for _ in range({n}):")
+            self.decode(field._keytype, k, indent + 1)
+            self.decode(field._valuetype, v, indent + 1)
+            emit(indent + 1, f"{target}[{k}] = {v}")
+        elif kind == "union":
+            tag = self.local("tag")
+            self.decode_uvarint(tag, indent)
+            if _dispatched(field):
+                self.invalid_tag(field, tag, indent)
+                decoders = self.member_table(field, "decode" + self.suffix)
+                emit(indent, f"{target}, pos = {decoders}[{tag}](buf, pos)")
+                self.union_decoded(field, tag, target, indent)
+                return
+            for i, member in enumerate(field._members):
+                emit(indent, f"{'if' if i == 0 else 'elif'} {tag} == {i}:")
+                self.decode(member, target, indent + 1)
+                if not isinstance(member, Struct) and not self.native:
+                    m = self.const(member, "_m")
+                    emit(indent + 1, f"{target} = {m}._wrap({target})")
+            emit(indent, "else:" if field._members else "if True:")
+            emit(
+                indent + 1,
+                f"raise ValidationError(f'Invalid tag {{{tag}}} for union')",
+            )
+        else:
+            f = self.const(field, "_f")
+            emit(indent, f"{target}, pos = _decode_custom({f}, buf, pos)")
+
+    # -- skipping over encoded values --
+
+    def skip(self, field, indent: int):
+        """
+        Emits the statements advancing `pos` past an encoded `field` in `buf`, without
+        building its value.
+        """
+        kind = _kind(field)
+        emit = self.emit
+        fixed = field._fixed_size()
+        if fixed is not None:
+            if fixed:
+                emit(indent, f"pos += {fixed}")
+            else:
+                emit(indent, "pass")
+        elif kind == "struct":
+            skip = self.codec_function(type(field), "skip")
+            emit(indent, f"pos = {skip}(buf, pos)")
+        elif kind in ("uint", "enum", "int"):
+            emit(indent, "while buf[pos] >= 0x80:")
+            emit(indent + 1, "pos += 1")
+            emit(indent, "pos += 1")
+        elif kind in ("str", "data"):
+            n = self.local("n")
+            self.decode_uvarint(n, indent)
+            emit(indent, f"pos += {n}")
+        elif kind == "optional":
+            emit(indent, "pos += 1")
+            emit(indent, "if buf[pos - 1] != 0:")
+            self.skip(field._wrapped, indent + 1)
+        elif kind == "array":
+            n = self.local("n")
+            if field._length == 0:
+                self.decode_uvarint(n, indent)
+            else:
+                emit(indent, f"{n} = {field._length}")
+            fixed = field._type._fixed_size()
+            if fixed is not None:
+                emit(indent, f"pos += {n} * {fixed}")
+            else:
+                emit(indent, f"for _ in range({n}):")
+                self.skip(field._type, indent + 1)
+        elif kind == "map":
+            n = self.local("n")
+            self.decode_uvarint(n, indent)
+            emit(indent, f"for _ in range({n}):")
+            self.skip(field._keytype, indent + 1)
+            self.skip(field._valuetype, indent + 1)
+        elif kind == "union":
+            tag = self.local("tag")
+            self.decode_uvarint(tag, indent)
+            if _dispatched(field):
+                self.invalid_tag(field, tag, indent)
+                emit(indent, f"pos = {self.member_table(field, 'skip')}[{tag}](buf, pos)")
+                return
+            for i, member in enumerate(field._members):
+                emit(indent, f"{'if' if i == 0 else 'elif'} {tag} == {i}:")
+                self.skip(member, indent + 1)
+            emit(indent, "else:" if field._members else "if True:")
+            emit(
+                indent + 1,
+                f"raise ValidationError(f'Invalid tag {{{tag}}} for union')",
+            )
+        else:
+            f = self.const(field, "_f")
+            emit(indent, f"_, pos = _decode_custom({f}, buf, pos)")
+
+    # -- whole functions --
+
+    def fixed_values(self, field, expr: str, indent: int) -> typing.List[str]:
+        """
+        Emits the bindings needed to pack a fixed width field with a fused format and
+        returns the expressions of its values, in format order.
+        """
+        kind = _kind(field)
+        if kind == "void":
+            return []
+        if kind != "struct":
+            return [expr]
+        var = self.local("v")
+        self.emit(indent, f"{var} = {expr}")
+        schema = type(field).__schema__
+        values = []
+        for name, nested in schema.fields.items():
+            values += self.fixed_values(nested, f"{var}.{schema.attrs[name]}", indent)
+        return values
+
+    def fixed_build(self, field, values: typing.Iterator[str]) -> str:
+        """
+        Returns the expression rebuilding a fixed width field from the names its
+        fused format was unpacked into.
+        """
+        kind = _kind(field)
+        if kind == "void":
+            return "None"
+        if kind != "struct":
+            return next(values)
+        pairs = [
+            (name, self.fixed_build(nested, values))
+            for name, nested in type(field).__schema__.fields.items()
+        ]
+        return self.construct(type(field), pairs, 1)
+
+    def fixed_unpack(self, fmt: str, run: list, source: str) -> typing.List[tuple]:
+        s = self.struct_fmt(fmt)
+        count = len(struct.Struct(fmt).unpack(bytes(struct.calcsize(fmt))))
+        names = [self.local("f") for _ in range(count)]
+        if names:
+            self.emit(1, f"{', '.join(names)}, = {s}.{source}")
+        values = iter(names)
+        return [(name, self.fixed_build(field, values)) for name, field in run]
+
+    def construct(self, cls, pairs: typing.List[tuple], indent: int, partial=False) -> str:
+        """
+        Returns an expression building an instance of the struct `cls` from
+        `(field name, value expression)` pairs. Trusted decoders bypass `__init__`
+        and validation and store each value directly. `partial` pairs only cover some
+        of the fields, the others are given their defaults, as `__init__` would.
+        """
+        c = self.const(cls, "_cls")
+        schema = cls.__schema__
+        if not self.trusted and not partial:
+            return f"{c}({', '.join(f'{name}={expr}' for name, expr in pairs)})"
+        # the values that are decoded, the other fields of partial instances are stored
+        # at their defaults, which aren't validated
+        decoded = dict(pairs)
+        if partial:
+            pairs = []
+            for name, field in schema.fields.items():
+                if name in decoded:
+                    pairs.append((name, decoded[name]))
+                elif isinstance(field, Struct):
+                    pairs.append((name, self.const(field, "_f")))
+                else:
+                    pairs.append((name, f"{self.const(field, '_f')}.value"))
+        if schema.frozen:
+            if not self.trusted:
+                for name, expr in pairs:
+                    if name in decoded:
+                        f = self.const(schema.fields[name], "_f")
+                        self.emit(indent, f"_frozen_validate({f}, {name!r}, {expr})")
+            return f"_frozen_new({c}, ({''.join(f'{expr}, ' for _, expr in pairs)}))"
+        obj = self.local("obj")
+        self.emit(indent, f"{obj} = {c}.__new__({c})")
+        for name, expr in pairs:
+            field = schema.fields[name]
+            setter = getattr(type(field), "__set__", None)
+            if not self.trusted and name in decoded:
+                self.emit(indent, f"{obj}.{name} = {expr}")
+            elif setter is Map.__set__:
+                f = self.const(field, "_f")
+                self.emit(
+                    indent,
+                    f"{obj}.{schema.attrs[name]} = _ValidatedMap({expr}, instance={f}, validate=False)",
+                )
+            elif setter in (None, Field.__set__, Optional.__set__):
+                self.emit(indent, f"{obj}.{schema.attrs[name]} = {expr}")
+            else:
+                # a field with its own __set__ still gets to see the value
+                self.emit(indent, f"{obj}.{name} = {expr}")
+        return obj
+
+    def struct_encode(self, schema):
+        self.emit(0, "def encode(out, value):")
+        for fmt, run in _runs(schema):
+            if fmt is None:
+                name, field = run[0]
+                var = self.local("v")
+                self.emit(1, f"{var} = value.{schema.attrs[name]}")
+                self.encode(field, var, 1)
+                continue
+            values = []
+            for name, field in run:
+                values += self.fixed_values(field, f"value.{schema.attrs[name]}", 1)
+            if values:
+                s = self.struct_fmt(fmt)
+                self.emit(1, f"out += {s}.pack({', '.join(values)})")
+        self.emit(1, "return out")
+
+    def struct_write(self, schema):
+        self.emit(0, "def write(buf, pos, value):")
+        for fmt, run in _runs(schema):
+            if fmt is None:
+                name, field = run[0]
+                var = self.local("v")
+                self.emit(1, f"{var} = value.{schema.attrs[name]}")
+                self.write(field, var, 1)
+                continue
+            values = []
+            for name, field in run:
+                values += self.fixed_values(field, f"value.{schema.attrs[name]}", 1)
+            if values:
+                s = self.struct_fmt(fmt)
+                self.emit(1, f"{s}.pack_into(buf, pos, {', '.join(values)})")
+            size = struct.calcsize(fmt)
+            if size:
+                self.emit(1, f"pos += {size}")
+        self.emit(1, "return pos")
+
+    def struct_size(self, schema):
+        self.emit(0, "def size(value):")
+        fixed = sum(field._fixed_size() or 0 for field in schema.fields.values())
+        self.emit(1, f"size = {fixed}")
+        for name, field in schema.fields.items():
+            if field._fixed_size() is None:
+                var = self.local("v")
+                self.emit(1, f"{var} = value.{schema.attrs[name]}")
+                self.size(field, var, 1)
+        self.emit(1, "return size")
+
+    def struct_project(self, schema, tree: dict, complete: bool):
+        """
+        Generates `project(buf, pos)`, which decodes only the fields named in `tree` (a
+        dict of field names to the tree of nested fields to decode, or None for all of
+        them) and skips the rest. Unless `complete`, nothing after the last requested
+        field is looked at, and the offset returned is that of the field after it.
+        """
+        self.emit(0, "def project(buf, pos):")
+        runs = list(_runs(schema))
+        last = max(
+            (i for i, (_, run) in enumerate(runs) if any(name in tree for name, _ in run)),
+            default=-1,
+        )
+        pairs = []
+        for i, (fmt, run) in enumerate(runs):
+            if i > last and not complete:
+                break
+            requested = any(name in tree for name, _ in run)
+            if fmt is not None:
+                if requested:
+                    unpacked = self.fixed_unpack(fmt, run, "unpack_from(buf, pos)")
+                    pairs += [(name, expr) for name, expr in unpacked if name in tree]
+                size = struct.calcsize(fmt)
+                if size:
+                    self.emit(1, f"pos += {size}")
+                continue
+            name, field = run[0]
+            if not requested:
+                self.skip(field, 1)
+                continue
+            var = self.local("v")
+            if tree[name] is None:
+                self.decode(field, var, 1)
+            else:
+                project = _project(type(field), tree[name], self.native, self.trusted)
+                project = self.const(project, "_project")
+                self.emit(1, f"{var}, pos = {project}(buf, pos)")
+            pairs.append((name, var))
+        self.emit(1, "if pos > len(buf):")
+        self.emit(2, "raise _truncated()")
+        self.emit(1, f"return {self.construct(self.target, pairs, 1, partial=True)}, pos")
+
+    def struct_read(self, schema):
+        self.read_header()
+        pairs = []
+        for fmt, run in _runs(schema):
+            if fmt is None:
+                name, field = run[0]
+                var = self.local("v")
+                self.read(field, var, 1)
+                pairs.append((name, var))
+            else:
+                pairs += self.fixed_unpack(
+                    fmt, run, f"unpack({self.take(struct.calcsize(fmt))})"
+                )
+        self.emit(1, f"return {self.construct(self.target, pairs, 1)}")
+        self.read_footer()
+
+    def struct_decode(self, schema):
+        self.emit(0, "def decode(buf, pos):")
+        pairs = []
+        # tracked structs keep the fields they decode, see `_Tracking`
+        offsets = [] if schema.tracked else None
+        for fmt, run in _runs(schema):
+            if offsets is not None:
+                start = self.local("p")
+                self.emit(1, f"{start} = pos")
+                offset = 0
+                for _, field in run:
+                    offsets.append(f"{start} + {offset}" if offset else start)
+                    offset += field._fixed_size() or 0
+            if fmt is None:
+                name, field = run[0]
+                var = self.local("v")
+                self.decode(field, var, 1)
+                pairs.append((name, var))
+            else:
+                pairs += self.fixed_unpack(fmt, run, "unpack_from(buf, pos)")
+                size = struct.calcsize(fmt)
+                if size:
+                    self.emit(1, f"pos += {size}")
+        value = self.construct(self.target, pairs, 1)
+        if offsets is None:
+            self.emit(1, f"return {value}, pos")
+        else:
+            self.emit(1, f"return {value}, pos, ({''.join(f'{o}, ' for o in offsets)}pos)")
+
+    def struct_skip(self, schema):
+        self.emit(0, "def skip(buf, pos):")
+        fixed = 0
+        for field in schema.fields.values():
+            size = field._fixed_size()
+            if size is not None:
+                # consecutive fixed width fields are skipped at once
+                fixed += size
+                continue
+            if fixed:
+                self.emit(1, f"pos += {fixed}")
+                fixed = 0
+            self.skip(field, 1)
+        if fixed:
+            self.emit(1, f"pos += {fixed}")
+        self.emit(1, "return pos")
+
+    def field_encode(self, field):
+        self.emit(0, "def encode(out, value):")
+        self.encode(field, "value", 1)
+        self.emit(1, "return out")
+
+    def field_write(self, field):
+        self.emit(0, "def write(buf, pos, value):")
+        self.write(field, "value", 1)
+        self.emit(1, "return pos")
+
+    def field_size(self, field):
+        self.emit(0, "def size(value):")
+        self.emit(1, "size = 0")
+        self.size(field, "value", 1)
+        self.emit(1, "return size")
+
+    def field_read(self, field):
+        self.read_header()
+        self.read(field, "value", 1)
+        self.emit(1, "return value")
+        self.read_footer()
+
+    def read_header(self):
+        if self.parsing:
+            self.emit(0, "def parse():")
+        else:
+            self.emit(0, "def read(fp):")
+            self.emit(1, "read = fp.read")
+
+    def read_footer(self):
+        if self.parsing:
+            # keeps parsers of zero width values generators as well
+            self.emit(1, "yield")
+
+    def field_decode(self, field):
+        self.emit(0, "def decode(buf, pos):")
+        self.decode(field, "value", 1)
+        self.emit(1, "return value, pos")
+
+    def field_skip(self, field):
+        self.emit(0, "def skip(buf, pos):")
+        self.skip(field, 1)
+        self.emit(1, "return pos")
+
+    def function(self, kind: str):
+        """
+        Generates the `kind` ("encode", "size", "write", "read", "parse", "decode" or
+        "skip") function for the target and returns it along with its source.
+        """
+        # parsers are generated by the stream reading emitters
+        self.parsing = kind == "parse"
+        emitter = "read" if self.parsing else kind
+        if isinstance(self.target, type):
+            getattr(self, f"struct_{emitter}")(self.target.__schema__)
+        else:
+            getattr(self, f"field_{emitter}")(self.target)
+        return self.build(kind)
+
+    def build(self, name: str, detail=""):
+        source = "\n".join(self.lines) + "\n"
+        if isinstance(self.target, type):
+            target = f"{self.target.__module__}.{self.target.__qualname__}"
+        else:
+            target = f"{type(self.target).__qualname__} at {id(self.target):#x}"
+        filename = f"<bare codec {target}.{name}{self.suffix}{detail}>"
+        # register the source so tracebacks through generated code are readable
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        exec(compile(source, filename, "exec"), self.namespace)
+        return self.namespace[name], source
+
+
+def _nested(cls, name: str):
+    return getattr(compile_struct(cls), name)
+
+
+def compile_struct(cls) -> Codec:
+    """
+    Returns the `Codec` for a `Struct` subclass. The codec is cached on the
+    struct's `Schema`.
+    """
+    schema = cls.__schema__
+    if schema._codec is None:
+        schema._codec = Codec(cls)
+    return schema._codec
+
+
+def preload(cls, **functions):
+    """
+    Installs codec functions of the `Struct` subclass `cls` that were generated ahead of
+    time (see `bare.compile`), so they aren't generated on first use.
+    """
+    codec = compile_struct(cls)
+    for name, function in functions.items():
+        if not Codec._valid(name):
+            raise ValueError(f"{name!r} isn't a kind of codec function")
+        codec._install(name, function)
+
+
+_SCALARS = ("simple", "uint", "int", "enum", "str", "data", "datafixed", "void")
+
+
+def _keepable(field) -> bool:
+    """
+    Whether the encoded form of `field` can be kept by a tracked struct: any change to
+    its value has to be noticed, so arrays and maps may only hold scalars.
+    """
+    kind = _kind(field)
+    if kind == "array":
+        return _kind(field._type) in _SCALARS
+    if kind == "map":
+        return _kind(field._keytype) in _SCALARS and _kind(field._valuetype) in _SCALARS
+    if kind == "optional":
+        return _keepable(field._wrapped)
+    return kind in _SCALARS or kind == "union"
+
+
+def _version(value) -> typing.Optional[int]:
+    """
+    Returns a number that changes whenever `value` is changed in place, or None if its
+    changes can't be noticed.
+    """
+    if value is None or isinstance(value, (str, bytes, int, float, enum.Enum)):
+        return 0
+    if type(value) in (_ValidatedList, _ValidatedMap):
+        return value._version
+    return None
+
+
+def _unchanged(value) -> int:
+    # frozen structs can't change
+    return 0
+
+
+class _Tracking:
+    """
+    The `encode`, `write` and `decode` functions of a struct declared with `tracked=True`.
+    Instances keep the encoded form of their fields in `__bare_cache__`, as
+    `(value, version, encoded)` entries recorded when they're decoded from a buffer or
+    packed. A kept field is spliced in as is while the instance still holds the same
+    value, unchanged in place (see `_version`), anything else is encoded again. Nested
+    tracked (or frozen) structs are kept whole, and spliced in as long as none of their
+    own fields changed, otherwise they're encoded by their own codec, which splices in
+    their kept fields in turn.
+
+    The generated `decode` of a tracked struct also returns the offsets its fields start
+    at, and the one past the last, from which the decoded fields are kept.
+    """
+
+    def __init__(self, cls):
+        schema = cls.__schema__
+        self.cls = cls
+        self.attrs = list(schema.attrs.values())
+        self.encoders = []
+        self.writers = None
+        # how a kept field's version is told, None for those that aren't kept
+        self.versions = []
+        for field in schema.fields.values():
+            if isinstance(field, Struct):
+                self.encoders.append(_nested(type(field), "encode"))
+                nested = type(field).__schema__
+                if nested.frozen:
+                    self.versions.append(_unchanged)
+                elif nested.tracked:
+                    tracking = compile_struct(type(field))._tracking
+                    complete = all(version is not None for version in tracking.versions)
+                    self.versions.append(tracking.version if complete else None)
+                else:
+                    self.versions.append(None)
+            else:
+                self.encoders.append(compile_field(field).encode)
+                self.versions.append(_version if _keepable(field) else None)
+
+    def version(self, value) -> typing.Optional[int]:
+        """
+        The version of a nested instance as a whole: 0 while every one of its fields is
+        kept and unchanged, None otherwise.
+        """
+        cache = getattr(value, "__bare_cache__", None)
+        if cache is None:
+            return None
+        for attr, entry, version in zip(self.attrs, cache, self.versions):
+            current = getattr(value, attr)
+            if entry is None or entry[0] is not current or entry[1] != version(current):
+                return None
+        return 0
+
+    def encode(self, out: bytearray, value) -> bytearray:
+        cache = getattr(value, "__bare_cache__", None)
+        if cache is None:
+            cache = [None] * len(self.attrs)
+            object.__setattr__(value, "__bare_cache__", cache)
+        for i, attr in enumerate(self.attrs):
+            current = getattr(value, attr)
+            entry = cache[i]
+            version = self.versions[i]
+            if entry is not None and entry[0] is current and entry[1] == version(current):
+                out += entry[2]
+                continue
+            start = len(out)
+            self.encoders[i](out, current)
+            if version is not None:
+                version = version(current)
+                if version is not None:
+                    cache[i] = (current, version, bytes(out[start:]))
+        return out
+
+    def write(self, buf, pos: int, value) -> int:
+        if self.writers is None:
+            self.writers = [
+                _nested(type(field), "write")
+                if isinstance(field, Struct)
+                else compile_field(field).write
+                for field in self.cls.__schema__.fields.values()
+            ]
+        cache = getattr(value, "__bare_cache__", None)
+        if cache is None:
+            cache = [None] * len(self.attrs)
+            object.__setattr__(value, "__bare_cache__", cache)
+        for i, attr in enumerate(self.attrs):
+            current = getattr(value, attr)
+            entry = cache[i]
+            version = self.versions[i]
+            if entry is not None and entry[0] is current and entry[1] == version(current):
+                end = pos + len(entry[2])
+                buf[pos:end] = entry[2]
+                pos = end
+                continue
+            start, pos = pos, self.writers[i](buf, pos, current)
+            if version is not None:
+                version = version(current)
+                if version is not None:
+                    cache[i] = (current, version, bytes(buf[start:pos]))
+        return pos
+
+    def remembering(self, decode):
+        """
+        Wraps a generated `decode` function, which also returns the offsets of the
+        fields it decoded, so that decoded instances keep the encoded form of their
+        fields, as found in the buffer.
+        """
+        count = len(self.attrs)
+        kept = [
+            (i, attr, version)
+            for i, (attr, version) in enumerate(zip(self.attrs, self.versions))
+            if version is not None
+        ]
+
+        def remember(buf, pos):
+            value, end, offsets = decode(buf, pos)
+            cache = [None] * count
+            for i, attr, version in kept:
+                current = getattr(value, attr)
+                version = version(current)
+                if version is not None:
+                    cache[i] = (current, version, bytes(buf[offsets[i] : offsets[i + 1]]))
+            object.__setattr__(value, "__bare_cache__", cache)
+            return value, end
+
+        return remember
+
+
+def _intern_table(tables: dict, mode: str) -> weakref.WeakValueDictionary:
+    table = tables.get(mode)
+    if table is None:
+        table = tables[mode] = weakref.WeakValueDictionary()
+    return table
+
+
+def _frozen(cls, name: str, func):
+    """
+    Wraps the `name` function of the codec of the frozen struct `cls`: encoding reuses
+    the encoding instances keep, and decoding records it. Interned structs are looked up
+    by their encoding before they're decoded, and only decoded if they weren't before.
+    """
+    kind, *flags = name.split("_")
+    tables = cls.__schema__.interned
+    table = validated = None
+    if tables is not None and kind in ("decode", "read"):
+        # native values differ from the others, and trusted decodes aren't validated,
+        # so every mode has a table of its own: nothing decoded without validation is
+        # ever handed to a decode that validates. Trusted decodes do reuse the
+        # instances validating decodes interned.
+        table = _intern_table(tables, "_".join(flags))
+        if "trusted" in flags:
+            validated = _intern_table(tables, "native" if "native" in flags else "")
+
+    if kind == "encode":
+
+        def encode(out, value):
+            encoded = getattr(value, "__bare_encoded__", None)
+            if encoded is None:
+                start = len(out)
+                func(out, value)
+                object.__setattr__(value, "__bare_encoded__", bytes(out[start:]))
+            else:
+                out += encoded
+            return out
+
+        return encode
+    if kind == "write":
+
+        def write(buf, pos, value):
+            encoded = getattr(value, "__bare_encoded__", None)
+            if encoded is None:
+                end = func(buf, pos, value)
+                object.__setattr__(value, "__bare_encoded__", bytes(buf[pos:end]))
+                return end
+            end = pos + len(encoded)
+            buf[pos:end] = encoded
+            return end
+
+        return write
+    if kind == "decode":
+        skip = compile_struct(cls).skip
+
+        def decode(buf, pos):
+            if table is not None:
+                end = skip(buf, pos)
+                encoded = bytes(buf[pos:end])
+                value = table.get(encoded)
+                if value is None and validated is not None:
+                    value = validated.get(encoded)
+                if value is not None:
+                    return value, end
+            value, end = func(buf, pos)
+            encoded = bytes(buf[pos:end])
+            object.__setattr__(value, "__bare_encoded__", encoded)
+            if table is not None:
+                table[encoded] = value
+            return value, end
+
+        return decode
+    if kind == "read" and table is not None:
+
+        def read(fp):
+            value = func(fp)
+            encoded = _frozen_encoded(value)
+            if validated is not None:
+                value = validated.get(encoded, value)
+            return table.setdefault(encoded, value)
+
+        return read
+    return func
+
+
+def _projection_tree(cls, fields: typing.Iterable[str]) -> dict:
+    # turns dotted paths into a tree of field names, None meaning the whole field
+    tree = {}
+    for path in fields:
+        node, schema = tree, cls.__schema__
+        names = path.split(".")
+        for depth, name in enumerate(names):
+            field = schema.fields.get(name)
+            if field is None:
+                raise ValueError(f"{cls.__name__} has no field {path!r}")
+            if depth == len(names) - 1:
+                node[name] = None
+                break
+            if not isinstance(field, Struct):
+                raise ValueError(f"Unable to project into {path!r}, it isn't a struct")
+            if name in node and node[name] is None:
+                break  # already decoded whole
+            node = node.setdefault(name, {})
+            schema = field.__schema__
+    return tree
+
+
+def _freeze(tree: dict) -> tuple:
+    return tuple(
+        sorted((name, None if sub is None else _freeze(sub)) for name, sub in tree.items())
+    )
+
+
+def _project(cls, tree: dict, native=False, trusted=False, complete=True):
+    codec = compile_struct(cls)
+    key = (_freeze(tree), native, trusted, complete)
+    project = codec.projections.get(key)
+    if project is None:
+        generator = _Generator(cls, native=native, trusted=trusted)
+        generator.struct_project(cls.__schema__, tree, complete)
+        paths = ",".join(name for name, _ in key[0])
+        project, source = generator.build("project", f"[{paths}]")
+        codec.projections[key] = project
+        codec.sources[f"project{generator.suffix}[{paths}]"] = source
+    return project
+
+
+def compile_projection(
+    cls, fields: typing.Iterable[str], native=False, trusted=False, complete=True
+):
+    """
+    Returns a function `project(buf, offset)` decoding only `fields` of the `Struct`
+    subclass `cls` encoded in `buf` at `offset`. Fields are named by dotted paths into
+    nested structs. It returns the struct and the offset just past it, unless not
+    `complete`, in which case decoding stops after the last requested field.
+    Projections are cached on the struct's codec.
+    """
+    return _project(cls, _projection_tree(cls, fields), native, trusted, complete)
+
+
+def compile_field(field: Field) -> Codec:
+    """
+    Returns the `Codec` for a standalone `Field` instance. The codec is cached on
+    the instance and shared with other fields of the same shape.
+    """
+    codec = field.__dict__.get("_codec")
+    if codec is None:
+        shape = _shape(field)
+        codec = _field_codecs.get(shape)
+        if codec is None:
+            codec = Codec(field)
+            _field_codecs[shape] = codec
+        field._codec = codec
+    return codec
+
+
+# codecs of standalone fields, shared between fields of the same shape so that
+# e.g. unpacking with a fresh `Union` instance per message doesn't recompile
+_field_codecs: typing.MutableMapping[tuple, Codec] = weakref.WeakValueDictionary()
+
+
+class _Unreachable(TypeError):
+    """Raised for constants a `_Scope` has no expression for"""
+
+
+class _Scope:
+    """
+    Binds the constants of functions generated by `_SymbolicGenerator` to expressions,
+    evaluated before the functions are defined. Fields are reached from the roots
+    through `__schema__.fields` and the members of containers, types through the first
+    field (or struct class) they're reached by.
+    """
+
+    def __init__(self, target=None):
+        self.names = {}
+        self.constants = []
+        self.counter = 0
+        self.types = {}
+        self.paths = {}
+        self.walked = set()
+        if isinstance(target, type):
+            self.root(target, "target")
+        elif target is not None:
+            self.walk(target, "target")
+
+    def root(self, cls: type, expr: str):
+        self.types.setdefault(cls, expr)
+        if cls in self.walked:
+            return
+        self.walked.add(cls)
+        for name, field in cls.__schema__.fields.items():
+            self.walk(field, f"{expr}.__schema__.fields[{name!r}]")
+
+    def walk(self, field, expr: str):
+        if id(field) in self.paths:
+            return
+        self.paths[id(field)] = expr
+        if isinstance(field, Struct):
+            self.root(type(field), f"type({expr})")
+            return
+        self.types.setdefault(type(field), f"type({expr})")
+        if isinstance(field, Array):
+            self.walk(field._type, f"{expr}._type")
+        elif isinstance(field, Optional):
+            self.walk(field._wrapped, f"{expr}._wrapped")
+        elif isinstance(field, Map):
+            self.walk(field._keytype, f"{expr}._keytype")
+            self.walk(field._valuetype, f"{expr}._valuetype")
+        elif isinstance(field, Union):
+            for i, member in enumerate(field._members):
+                self.walk(member, f"{expr}._members[{i}]")
+
+    def expression(self, obj) -> str:
+        if isinstance(obj, type):
+            expr = self.types.get(obj)
+        else:
+            expr = self.paths.get(id(obj))
+        if expr is not None:
+            return expr
+        if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+            return repr(obj)
+        raise _Unreachable(f"Unable to refer to {obj!r} from generated code")
+
+    def constant(self, key, prefix: str, expr: typing.Callable[[], str]) -> str:
+        name = self.names.get(key)
+        if name is None:
+            self.counter += 1
+            name = self.names[key] = f"{prefix}{self.counter}"
+            self.constants.append(f"{name} = {expr()}")
+        return name
+
+    def function(self, target, kind: str) -> str:
+        """
+        Binds the `kind` function of the codec of `target`, a `Struct` subclass or a
+        `Field` instance, and returns the name it's bound to.
+        """
+        if isinstance(target, type):
+            expr = f"_nested({self.expression(target)}, {kind!r})"
+        else:
+            expr = f"_compile_field({self.expression(target)}).{kind}"
+        prefix = f"_{kind.split('_')[0]}"
+        return self.constant(("function", id(target), kind), prefix, lambda: expr)
+
+
+class _SymbolicGenerator(_Generator):
+    """
+    Generates the source of a function without `exec`ing it: its constants are bound
+    to expressions of `scope` instead of objects, and nested codec functions are
+    looked up through it. The definition is renamed to `name`, if given.
+    """
+
+    def __init__(self, scope: _Scope, target, native=False, trusted=False, name=None):
+        super().__init__(target, native=native, trusted=trusted)
+        self.scope = scope
+        self.name = name
+
+    def const(self, obj, prefix="_c") -> str:
+        expr = lambda: self.scope.expression(obj)
+        return self.scope.constant(("obj", id(obj)), prefix, expr)
+
+    def alias(self, expr: str, prefix="_c") -> str:
+        return self.scope.constant(("expr", expr), prefix, lambda: expr)
+
+    def struct_fmt(self, fmt: str) -> str:
+        return self.scope.constant(("fmt", fmt), "_s", lambda: f"struct.Struct({fmt!r})")
+
+    def codec_function(self, target, kind: str) -> str:
+        return self.scope.function(target, kind)
+
+    def build(self, name: str, detail=""):
+        if self.name is not None:
+            self.lines[0] = self.lines[0].replace(f"def {name}(", f"def {self.name}(", 1)
+        return None, "\n".join(self.lines) + "\n"
+
+
+# the directory compiled codec functions are cached in, by fingerprint. Nothing is
+# cached on disk unless it's set, it defaults to the PYBARE_CACHE_DIR environment variable
+cache_dir: typing.Optional[str] = os.environ.get("PYBARE_CACHE_DIR") or None
+
+# compiled functions by (fingerprint, name), shared by every codec of that fingerprint
+_compiled: typing.Dict[typing.Tuple[str, str], typing.Tuple[str, typing.Any]] = {}
+
+_cache_version = None
+
+
+def _cache_path(key: typing.Tuple[str, str]) -> str:
+    global _cache_version
+    if _cache_version is None:
+        # generated code changes along with the generator, so is cached per version
+        digest = hashlib.sha256()
+        for module in ("compiler", "encoder", "types"):
+            path = os.path.join(os.path.dirname(__file__), f"{module}.py")
+            try:
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+            except OSError:
+                pass
+        _cache_version = f"{sys.implementation.cache_tag}-{digest.hexdigest()[:16]}"
+    fingerprint, name = key
+    return os.path.join(cache_dir, _cache_version, f"{fingerprint}.{name}.pyc")
+
+
+def _load(key: typing.Tuple[str, str]) -> typing.Optional[tuple]:
+    magic = importlib.util.MAGIC_NUMBER
+    try:
+        with open(_cache_path(key), "rb") as f:
+            data = f.read()
+        if data[: len(magic)] == magic:
+            source, code = marshal.loads(data[len(magic) :])
+            if isinstance(source, str) and hasattr(code, "co_code"):
+                return source, code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass  # a missing or broken cache entry is simply generated again
+    return None
+
+
+def _store(key: typing.Tuple[str, str], compiled: tuple):
+    path = _cache_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(importlib.util.MAGIC_NUMBER + marshal.dumps(compiled))
+            # concurrent processes each write their own file, the last one wins
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+    except OSError:
+        pass  # the cache is an optimization, an unwritable one is ignored
+
+
+def _build(codec: Codec, name: str) -> tuple:
+    """
+    Returns the `name` function of `codec` along with its source, compiled from the
+    code cached for the codec's fingerprint if there is any.
+    """
+    kind, *flags = name.split("_")
+    native, trusted = "native" in flags, "trusted" in flags
+    key = (codec.fingerprint, name)
+    compiled = _compiled.get(key)
+    if compiled is None and cache_dir is not None:
+        compiled = _load(key)
+    if compiled is None:
+        scope = _Scope(codec.target)
+        generator = _SymbolicGenerator(scope, codec.target, native=native, trusted=trusted)
+        try:
+            _, source = generator.function(kind)
+        except _Unreachable:
+            # not expressible in terms of the target, so not worth sharing either
+            return _Generator(codec.target, native=native, trusted=trusted).function(kind)
+        source = "".join(f"{line}\n" for line in scope.constants) + source
+        compiled = (source, compile(source, f"<bare codec {key[0]}.{name}>", "exec"))
+        if cache_dir is not None:
+            _store(key, compiled)
+    _compiled[key] = compiled
+    source, code = compiled
+    # register the source so tracebacks through generated code are readable
+    linecache.cache[code.co_filename] = (
+        len(source),
+        None,
+        source.splitlines(True),
+        code.co_filename,
+    )
+    namespace = dict(_NAMESPACE)
+    namespace.update(
+        target=codec.target,
+        struct=struct,
+        _nested=_nested,
+        _compile_field=compile_field,
+    )
+    exec(code, namespace)
+    return namespace[kind], source
@@ -1,15 +1,30 @@
+import concurrent.futures
+import copy
 import io
+import itertools
 import logging
+import operator
+import shutil
 import struct
+import sys
+import tempfile
 import typing
 import inspect
-from abc import ABC, abstractmethod
+from abc import ABC, ABCMeta, abstractmethod
 from collections import OrderedDict
 from enum import Enum, auto
 from functools import partial
+from types import MappingProxyType, MemberDescriptorType
 from collections.abc import Mapping
 from collections import UserDict, UserList
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, it's only needed for Array(numpy=True)
+    np = None
+
+from .varint import encode_uvarint
+
 
 class ValidationError(ValueError):
     """
@@ -87,7 +102,11 @@ class Field(ABC):
 
     def __set_name__(self, owner, name):
         self.name = name
-        setattr(owner, f"_{name}", self._value)
+        # compact and frozen structs keep the value in a slot of the same name, don't
+        # shadow it
+        slot = owner.__dict__.get(f"_{name}")
+        if not isinstance(slot, (MemberDescriptorType, _FrozenSlot)):
+            setattr(owner, f"_{name}", self._value)
 
     def __get__(self, instance, owner=None):
         if instance is None:
@@ -148,39 +167,449 @@ class Field(ABC):
         :param typing.BinaryIO fp: an optional io stream to write bytes to
         :returns: encoded bytes if fp is None
         """
-        buffered = False
+        from .compiler import compile_field
+
+        out = compile_field(self).encode(bytearray(), self._value)
         if not fp:
-            fp = io.BytesIO()
-            buffered = True
-        self._pack(fp)
-        if buffered:
-            return fp.getvalue()
+            return bytes(out)
+        fp.write(out)
+
+    def pack_into(self, buffer, offset=0) -> int:
+        """pack_into encodes this value into the writable bytes-like `buffer` (e.g. a
+        `bytearray` or `memoryview`) starting at `offset`
+        :returns: the offset just past the encoded value
+        """
+        from .compiler import compile_field
 
-    def unpack(self, fp: typing.BinaryIO):
+        return _encode_into(compile_field(self), self._value, buffer, offset)
+
+    def encoded_size(self) -> int:
+        """Returns the number of bytes `pack` would produce, without encoding"""
+        from .compiler import compile_field
+
+        return compile_field(self).size(self._value)
+
+    def unpack(self, fp: typing.BinaryIO, native=False, trusted=False):
         """unpacks bytes from fp into an instance of this class
 
+        :param bytes|BinaryIO fp: bytes or byte stream to read the value from
+        :param bool native: return the decoded native value (int, str, bytes, list, dict...)
+            instead of an instance of this class. Union members are returned as their
+            plain value as well.
+        :param bool trusted: skip validating decoded values, see `Struct.unpack`
+        """
+        from .compiler import compile_field
+
+        codec = compile_field(self)
+        # bytes-like input is decoded in place, without going through a stream
+        if _is_buffer(fp):
+            value, _ = _decode_buffer(codec.get("decode", native, trusted), fp)
+        elif type(fp) is io.BytesIO:
+            value = _decode_bytesio(codec.get("decode", native, trusted), fp)
+        else:
+            value = codec.get("read", native, trusted)(fp)
+        if native:
+            return value
+        return self._wrap(value)
+
+    def iter_unpack(
+        self, fp: typing.BinaryIO, chunk_size=1 << 16, native=False, trusted=False
+    ) -> typing.Iterator:
+        """yields every value of this type encoded back to back in fp, until the end of the
+        stream. fp is read in chunks of chunk_size bytes, see `Struct.iter_unpack`
         """
-        # If it's a bytes-like, wrap it in a io buffer
-        if hasattr(fp, "decode"):
-            fp = io.BytesIO(fp)
-        return self._unpack(fp)
+        from .compiler import compile_field
+
+        decode = compile_field(self).get("decode", native, trusted)
+        for value in _iter_decode(decode, fp, chunk_size):
+            yield value if native else self._wrap(value)
+
+    def __getstate__(self):
+        # compiled codecs can't be pickled, they're looked up again when needed
+        state = self.__dict__.copy()
+        state.pop("_codec", None)
+        return state
+
+    def _wrap(self, value) -> "Field":
+        """
+        Returns a copy of this field holding `value`, without validating it. This is
+        used to hand back decoded values that have already been checked by the decoder.
+        """
+        wrapped = copy.copy(self)
+        wrapped._value = value
+        return wrapped
 
     def to_dict(self, value=None):
         if value is None:
             value = self._value
         if isinstance(value, Field):
             return value.value
+        elif isinstance(value, Struct):
+            return value.to_dict()
         else:
             return value
 
+    def _fixed_size(self) -> typing.Optional[int]:
+        """
+        Returns the number of bytes this field always encodes to, or None if the
+        encoded size depends on the value.
+        """
+        return None
+
+
+class Schema:
+    """
+    Schema is the resolved layout of a `Struct` subclass. It is built once, when the
+    class is created, by `StructMeta` and holds:
+
+    * `fields`: the ordered field table, inherited fields first
+    * `attrs`: the attribute each field's value is stored under on an instance
+    * `sizes`: the fixed encoded size of each field, or None if it is variable
+    * `size`: the fixed encoded size of the whole struct, or None if it is variable
+    * `compact`: whether instances store their values in `__slots__`
+    * `tracked`: whether instances keep the encoded form of their fields around
+    * `frozen`: whether instances are immutable, with their values stored in a tuple
+    * `interned`: for interned frozen structs, the live instances decoded so far by
+      their encoding, in a table per decoding mode ("", "native", "trusted" and
+      "native_trusted"). None for other structs.
+    * `arrays`: the array fields of a tracked struct, by the attribute they're stored under
+    * `codec`: the compiled codec for the struct (see `bare.compiler`), resolved on first use
+    """
+
+    def __init__(
+        self,
+        cls: type,
+        fields: typing.OrderedDict,
+        compact=False,
+        tracked=False,
+        frozen=False,
+        interned=False,
+    ):
+        self.cls = cls
+        self.fields: typing.OrderedDict[str, typing.Any] = fields
+        self.compact = compact
+        self.tracked = tracked
+        self.frozen = frozen
+        self.interned = {} if interned else None
+        self.attrs = OrderedDict(
+            (name, f"_{name}" if isinstance(field, Field) or compact or frozen else name)
+            for name, field in fields.items()
+        )
+        self.arrays = {}
+        if tracked:
+            self.arrays = {
+                self.attrs[name]: field
+                for name, field in fields.items()
+                if isinstance(field, Array)
+            }
+        self.sizes = OrderedDict(
+            (name, field._fixed_size()) for name, field in fields.items()
+        )
+        if None in self.sizes.values():
+            self.size = None
+        else:
+            self.size = sum(self.sizes.values())
+        self._codec = None
+
+    @staticmethod
+    def collect(bases: typing.Tuple[type, ...], namespace: typing.Mapping) -> OrderedDict:
+        """
+        Collects the fields declared in a class body, preceded by those inherited from
+        any `Struct` bases.
+        """
+        fields = OrderedDict()
+        for base in reversed(bases):
+            schema = getattr(base, "__schema__", None)
+            if isinstance(schema, Schema):
+                fields.update(schema.fields)
+        # `Struct` itself is created through this path too, so nested structs are
+        # recognized by their metaclass rather than by `isinstance(x, Struct)`
+        fields.update(
+            filter(
+                lambda x: isinstance(x[1], Field) or isinstance(type(x[1]), StructMeta),
+                namespace.items(),
+            )
+        )
+        return fields
+
+    @property
+    def codec(self):
+        if self._codec is None:
+            from .compiler import compile_struct
+
+            self._codec = compile_struct(self.cls)
+        return self._codec
+
+
+class _StructSlot:
+    """
+    _StructSlot stands in for a nested struct field on a compact `Struct`, whose value
+    lives in the slot `_<name>`. Accessed on the class it returns the declared default,
+    like an ordinary nested struct field would.
+    """
+
+    def __init__(self, default: "Struct", attr: str):
+        self.default = default
+        self.attr = attr
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self.default
+        return getattr(instance, self.attr)
+
+    def __set__(self, instance, value):
+        setattr(instance, self.attr, value)
+
+
+class _FrozenSlot:
+    """
+    _FrozenSlot reads the value of a field of a frozen `Struct` from the tuple the
+    instance stores its values in.
+    """
+
+    __slots__ = ("index",)
+
+    def __init__(self, index: int):
+        self.index = index
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return instance.__bare_values__[self.index]
+
+
+class StructMeta(ABCMeta):
+    """
+    StructMeta builds the `Schema` of every `Struct` subclass as it is defined, so the
+    field layout isn't rediscovered on every encode, decode or validation.
+
+    Passing `compact=True` in the class definition stores field values in generated
+    `__slots__` instead of a per-instance `__dict__`:
+
+        class Point(Struct, compact=True):
+            x = I32()
+            y = I32()
+
+    Validation is unchanged. Instances of a compact struct can't be given attributes
+    that aren't fields, and only avoid a `__dict__` entirely if every `Struct` base
+    is compact as well.
+
+    Passing `tracked=True` makes instances remember the encoded form of each field,
+    from when they were decoded or last packed, so re-encoding a mostly unchanged
+    message only encodes the fields that changed since (see `bare.compiler._Tracking`).
+    Arrays assigned to a tracked struct are stored as validated lists, which keep
+    count of their changes. Subclasses of tracked structs are tracked too.
+
+    Passing `frozen=True` makes instances immutable: values are validated once, when
+    the instance is created, and stored in a tuple (arrays as tuples, maps as read-only
+    mappings). Frozen structs are hashable, they're equal to the frozen structs of the
+    same class that encode to the same bytes, and they keep their encoding once it's
+    known. They may only contain frozen structs, and only derive from frozen structs.
+    `interned=True` (which implies `frozen=True`) in addition makes decoding return one
+    shared instance for every distinct encoding of the struct, as long as it's alive.
+    """
+
+    def __new__(
+        mcs,
+        name,
+        bases,
+        namespace,
+        compact=False,
+        tracked=False,
+        frozen=False,
+        interned=False,
+        **kwargs,
+    ):
+        fields = Schema.collect(bases, namespace)
+        schemas = [
+            base.__schema__
+            for base in bases
+            if isinstance(getattr(base, "__schema__", None), Schema)
+        ]
+        tracked = tracked or any(schema.tracked for schema in schemas)
+        frozen = frozen or interned or any(schema.frozen for schema in schemas)
+        if frozen:
+            namespace = _frozen_namespace(name, schemas, fields, namespace, tracked)
+        if tracked:
+            namespace = dict(namespace)
+            namespace.setdefault("__setattr__", _tracked_setattr)
+        if compact and not frozen:
+            namespace = dict(namespace)
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(klass.__dict__.get("__slots__", ()))
+            slots = []
+            for fname, field in fields.items():
+                attr = f"_{fname}"
+                if attr not in inherited:
+                    slots.append(attr)
+                if not isinstance(field, Field) and fname in namespace:
+                    namespace[fname] = _StructSlot(field, attr)
+            if tracked and "__bare_cache__" not in inherited:
+                slots.append("__bare_cache__")
+            namespace["__slots__"] = tuple(slots)
+        cls = super().__new__(mcs, name, bases, namespace, **kwargs)
+        cls.__schema__ = Schema(
+            cls, fields, compact=compact, tracked=tracked, frozen=frozen, interned=interned
+        )
+        return cls
+
+
+def _frozen_namespace(name: str, schemas: list, fields: OrderedDict, namespace, tracked):
+    """
+    Returns the class namespace of a frozen struct: its values are read from the tuple
+    `__bare_values__` by index, and its encoding is kept in `__bare_encoded__`.
+    """
+    if tracked:
+        raise TypeError(f"{name} can't be both frozen and tracked")
+    for schema in schemas:
+        if schema.fields and not schema.frozen:
+            raise TypeError(f"{name} is frozen, but its base {schema.cls.__name__} isn't")
+    for fname, field in fields.items():
+        for nested in _nested_structs(field):
+            if not nested.__schema__.frozen:
+                raise TypeError(
+                    f"{name}.{fname} holds {nested.__name__}, which isn't frozen"
+                )
+    namespace = dict(namespace)
+    for i, (fname, field) in enumerate(fields.items()):
+        namespace[f"_{fname}"] = _FrozenSlot(i)
+        if not isinstance(field, Field) and fname in namespace:
+            namespace[fname] = _StructSlot(field, f"_{fname}")
+    if any(schema.frozen for schema in schemas):
+        namespace["__slots__"] = ()
+    else:
+        namespace["__slots__"] = ("__bare_values__", "__bare_encoded__", "__weakref__")
+        for method, function in _FROZEN_METHODS.items():
+            namespace.setdefault(method, function)
+    return namespace
+
+
+def _nested_structs(field) -> typing.Iterator[type]:
+    # the struct classes values of `field` may hold, directly or within containers
+    if isinstance(field, Struct):
+        yield type(field)
+    elif isinstance(field, Array):
+        yield from _nested_structs(field._type)
+    elif isinstance(field, Optional):
+        yield from _nested_structs(field._wrapped)
+    elif isinstance(field, Map):
+        yield from _nested_structs(field._valuetype)
+    elif isinstance(field, Union):
+        for member in field._members:
+            yield from _nested_structs(member)
+
+
+def _frozen_value(field, value):
+    """
+    Returns the immutable form `value` is stored in by a frozen struct: arrays become
+    tuples and maps read-only mappings.
+    """
+    if isinstance(field, Array):
+        if np is not None and isinstance(value, np.ndarray):
+            if value.flags.writeable:
+                value = value.copy()
+                value.flags.writeable = False
+            return value
+        if isinstance(field._type, (Array, Map, Optional)):
+            return tuple(_frozen_value(field._type, item) for item in value)
+        return value if type(value) is tuple else tuple(value)
+    if isinstance(field, Map):
+        return MappingProxyType(
+            {key: _frozen_value(field._valuetype, item) for key, item in value.items()}
+        )
+    if isinstance(field, Optional) and value is not None:
+        return _frozen_value(field._wrapped, value)
+    return value
+
+
+def _frozen_new(cls, values: typing.Iterable):
+    """
+    Creates an instance of the frozen struct `cls` from the values of its fields, in
+    order, without validating them.
+    """
+    obj = cls.__new__(cls)
+    fields = cls.__schema__.fields.values()
+    values = tuple(_frozen_value(field, value) for field, value in zip(fields, values))
+    object.__setattr__(obj, "__bare_values__", values)
+    return obj
+
+
+def _frozen_encoded(value) -> bytes:
+    encoded = getattr(value, "__bare_encoded__", None)
+    if encoded is None:
+        encoded = bytes(value.__schema__.codec.encode(bytearray(), value))
+        object.__setattr__(value, "__bare_encoded__", encoded)
+    return encoded
+
+
+def _frozen_validate(field, name: str, value):
+    if isinstance(field, Field):
+        valid, message = field.validate(value)
+        if not valid:
+            raise ValidationError(f"{name} is invalid for BARE type {field._type}: {message}")
+
+
+def _frozen_init(self, kwargs: dict):
+    values = []
+    for name, field in self.__schema__.fields.items():
+        value = kwargs[name] if name in kwargs else field.value
+        _frozen_validate(field, name, value)
+        values.append(_frozen_value(field, value))
+    object.__setattr__(self, "__bare_values__", tuple(values))
+
+
+def _frozen_setattr(self, name, value=None):
+    raise AttributeError(f"{type(self).__name__} is frozen, its fields can't be changed")
+
+
+def _frozen_eq(self, other):
+    if type(other) is not type(self):
+        return NotImplemented
+    return other is self or _frozen_encoded(self) == _frozen_encoded(other)
+
+
+def _frozen_hash(self):
+    # bytes cache their own hash
+    return hash(_frozen_encoded(self))
+
+
+def _frozen_reduce(self):
+    return type(self).unpack, (_frozen_encoded(self),)
 
-class Struct(ABC):
 
+# the methods of frozen structs, unless they define their own
+_FROZEN_METHODS = {
+    "__setattr__": _frozen_setattr,
+    "__delattr__": _frozen_setattr,
+    "__eq__": _frozen_eq,
+    "__hash__": _frozen_hash,
+    "__reduce__": _frozen_reduce,
+}
+
+
+def _tracked_setattr(self, name, value):
+    # lists assigned to array fields of tracked structs are stored as `_ValidatedList`s,
+    # so changes made to them in place are noticed
+    if type(value) is list:
+        field = self.__schema__.arrays.get(name)
+        if field is not None:
+            value = _ValidatedList(value, instance=field)
+    object.__setattr__(self, name, value)
+
+
+class Struct(ABC, metaclass=StructMeta):
+
+    __slots__ = ()
     _type = BareType.Struct
 
     def __init__(self, *args, **kwargs):
+        if self.__schema__.frozen:
+            _frozen_init(self, kwargs)
+            return
         # loop through defined fields, if they have a corresponding kwarg entry, set the value
-        for name, field in self.fields().items():
+        for name, field in self.__schema__.fields.items():
             if name in kwargs:
                 setattr(self, name, kwargs[name])
             else:
@@ -188,9 +617,15 @@ class Struct(ABC):
 
     @classmethod
     def fields(cls) -> typing.OrderedDict[str, Field]:
-        return OrderedDict(
-            filter(lambda x: isinstance(x[1], (Field, Struct)), cls.__dict__.items())
-        )
+        return cls.__schema__.fields
+
+    @classmethod
+    def bytesize(cls) -> typing.Optional[int]:
+        """
+        Returns the number of bytes every instance of this struct encodes to, or None
+        if it contains variable width fields.
+        """
+        return cls.__schema__.size
 
     def pack(self, fp=None) -> typing.Optional[bytes]:
         """
@@ -198,41 +633,226 @@ class Struct(ABC):
         All subclasses of Field are treated as struct fields. If fp is provided, the output is written to that,
         otherwise a bytes instance is returned with the encoded data.
         """
-        ret = False
+        out = self.__schema__.codec.encode(bytearray(), self)
         if not fp:
-            fp = io.BytesIO()
-            ret = True
-        self._pack(fp)
-        if ret:
-            return fp.getvalue()
+            return bytes(out)
+        fp.write(out)
+
+    def pack_into(self, buffer, offset=0) -> int:
+        """
+        pack_into encodes the struct into the writable bytes-like `buffer` (e.g. a `bytearray`
+        or `memoryview`) starting at `offset`, and returns the offset just past it.
+        Use `encoded_size` to size the buffer up front.
+        """
+        return _encode_into(self.__schema__.codec, self, buffer, offset)
+
+    def encoded_size(self) -> int:
+        """
+        Returns the number of bytes `pack` would produce, without encoding. Only variable
+        width fields are looked at, the size of everything else is known from the schema.
+        """
+        return self.__schema__.codec.size(self)
 
     def _pack(self, fp: typing.BinaryIO, value=None):
         if value is None:
             value = self
-        for name, field in value.fields().items():
-            val = getattr(value, name)  # this gets the underlying value
-            field._pack(fp, value=val)
+        fp.write(value.__schema__.codec.encode(bytearray(), value))
 
     @classmethod
-    def _unpack(cls, fp: typing.BinaryIO):
-        vals = {}
-        for field, type in cls.fields().items():
-            val = type._unpack(fp)
-            vals[field] = val.value
-        return cls(**vals)
+    def _unpack(cls, fp: typing.BinaryIO, native=False, trusted=False):
+        codec = cls.__schema__.codec
+        if type(fp) is io.BytesIO:
+            return _decode_bytesio(codec.get("decode", native, trusted), fp)
+        return codec.get("read", native, trusted)(fp)
 
     @classmethod
-    def unpack(cls, data: typing.Union[typing.BinaryIO, bytes]):
+    def unpack(
+        cls,
+        data: typing.Union[typing.BinaryIO, bytes],
+        native=False,
+        trusted=False,
+        fields: typing.Iterable[str] = None,
+    ):
         """
         unpacks data into an instance of this struct
         :param bytes|BinaryIO data: bytes or byte stream to read values from
+        :param bool native: decode Union members that are plain fields into their native
+            value instead of wrapping them in their `Field` type. Everything else is
+            always decoded into native values (or nested structs).
+        :param bool trusted: build instances directly, without running `__init__` or
+            validating field values. Only the checks the wire format itself requires
+            (lengths and Union tags) are done. Use this for data from a trusted source.
+        :param fields: only decode these fields, named by dotted paths for fields of nested
+            structs (e.g. `["userid", "address.city"]`). Everything else is skipped over
+            without being decoded, and set to the field's default. Streams other than
+            `io.BytesIO` have the whole struct read off them first, only bytes-like
+            data and `io.BytesIO` streams are projected in place.
         :returns: an instance of this class with populated fields
         """
-        if hasattr(data, "decode"):
-            fp = io.BytesIO(data)
-        else:
-            fp = data
-        return cls._unpack(fp)
+        if fields is not None:
+            from .compiler import compile_projection
+
+            if _is_buffer(data):
+                # nothing after the last requested field needs to be looked at
+                project = compile_projection(cls, fields, native, trusted, complete=False)
+                value, _ = _decode_buffer(project, data)
+                return value
+            if type(data) is io.BytesIO:
+                project = compile_projection(cls, fields, native, trusted)
+                return _decode_bytesio(project, data)
+            # the end of the struct can only be found by reading it, which the trusted
+            # reader does with the least work, the projection then decodes what's asked
+            recorder = _Recorder(data)
+            cls.__schema__.codec.read_trusted(recorder)
+            project = compile_projection(cls, fields, native, trusted, complete=False)
+            value, _ = _decode_buffer(project, bytes(recorder.data))
+            return value
+        if _is_buffer(data):
+            value, _ = _decode_buffer(
+                cls.__schema__.codec.get("decode", native, trusted), data
+            )
+            return value
+        return cls._unpack(data, native=native, trusted=trusted)
+
+    @classmethod
+    def pack_many(cls, values: typing.Iterable["Struct"], fp=None) -> typing.Optional[bytes]:
+        """
+        pack_many encodes every struct in `values` back to back into a single buffer. If fp
+        is provided, the output is written to that, otherwise a bytes instance is returned.
+        """
+        encode = cls.__schema__.codec.encode
+        out = bytearray()
+        for value in values:
+            encode(out, value)
+        if not fp:
+            return bytes(out)
+        fp.write(out)
+
+    @classmethod
+    def unpack_many(
+        cls, data: bytes, count: int = None, native=False, trusted=False
+    ) -> typing.List["Struct"]:
+        """
+        unpack_many decodes instances of this struct encoded back to back in `data`
+        :param bytes data: a bytes-like object to decode from
+        :param int count: the number of instances to decode, by default all of `data` is
+            decoded
+        :param bool native: see `unpack`
+        :param bool trusted: see `unpack`
+        :returns: a list of instances of this class
+        """
+        decode = cls.__schema__.codec.get("decode", native, trusted)
+        values, _ = _decode_buffer(partial(_decode_many, decode, count), data)
+        return values
+
+    @classmethod
+    def unpack_parallel(
+        cls,
+        buffers: typing.Iterable[bytes],
+        workers: int = None,
+        chunksize=256,
+        native=False,
+        trusted=False,
+        executor: concurrent.futures.Executor = None,
+    ) -> typing.List["Struct"]:
+        """
+        unpack_parallel decodes each buffer in `buffers` into an instance of this struct on a
+        pool of worker processes, and returns them in order. Only a reference to this class
+        is sent to the workers, which compile its codec once.
+        :param int workers: the number of worker processes, defaults to the number of CPUs
+        :param int chunksize: the number of buffers sent to a worker at once
+        :param bool native: see `unpack`
+        :param bool trusted: see `unpack`
+        :param executor: an existing executor to use instead of starting a process pool
+        """
+        # memoryviews can't be pickled
+        buffers = (bytes(b) if isinstance(b, memoryview) else b for b in buffers)
+        chunks = _chunks(buffers, chunksize)
+        task = partial(_unpack_chunk, cls, native, trusted)
+        return _run_chunks(task, chunks, workers, executor)
+
+    @classmethod
+    def pack_parallel(
+        cls,
+        values: typing.Iterable["Struct"],
+        workers: int = None,
+        chunksize=256,
+        executor: concurrent.futures.Executor = None,
+    ) -> typing.List[bytes]:
+        """
+        pack_parallel encodes each struct in `values` on a pool of worker processes, and
+        returns the encoded bytes in order. The arguments are the same as for `unpack_parallel`.
+        """
+        task = partial(_pack_chunk, cls)
+        return _run_chunks(task, _chunks(values, chunksize), workers, executor)
+
+    @classmethod
+    def iter_filter(
+        cls,
+        fp: typing.BinaryIO,
+        where: typing.Mapping[str, typing.Any],
+        raw=False,
+        chunk_size=1 << 16,
+        native=False,
+        trusted=False,
+    ) -> typing.Iterator:
+        """
+        iter_filter yields the instances of this struct encoded back to back in `fp` whose
+        fields match all of the conditions in `where`. Only the fields the conditions need
+        are decoded to check them, and messages that don't match are skipped over.
+        :param where: a mapping of field names (dotted paths for fields of nested structs) to
+            conditions. A condition is either a callable taking the field value, a set
+            (the value must be one of its items), a `range` or `slice(start, stop)` (the
+            value must be in it, `None` leaving that end open), or any other value which
+            the field value must be equal to.
+        :param bool raw: yield matching messages as encoded bytes instead of decoding them
+        See `iter_unpack` for the other arguments.
+        """
+        from .compiler import compile_projection
+
+        project = compile_projection(cls, where.keys(), native, trusted=True)
+        checks = [
+            (operator.attrgetter(path), _condition(condition)) for path, condition in where.items()
+        ]
+        decode = cls.__schema__.codec.get("decode", native, trusted)
+
+        def match(buf, pos):
+            projected, end = project(buf, pos)
+            for get, check in checks:
+                if not check(get(projected)):
+                    return _skipped, end
+            if raw:
+                return bytes(buf[pos:end]), end
+            return decode(buf, pos)
+
+        for value in _iter_decode(match, fp, chunk_size):
+            if value is not _skipped:
+                yield value
+
+    @classmethod
+    def view(cls, data, offset=0):
+        """
+        view returns a read-only view of the struct encoded in the bytes-like `data` at
+        `offset`. Fields are decoded the first time they're accessed and then memoized,
+        nested structs and arrays are returned as views in turn. `data` must not be
+        modified while the view is in use.
+        """
+        from .view import StructView
+
+        return StructView(cls, data, offset)
+
+    @classmethod
+    def iter_unpack(
+        cls, fp: typing.BinaryIO, chunk_size=1 << 16, native=False, trusted=False
+    ) -> typing.Iterator["Struct"]:
+        """
+        iter_unpack yields every instance of this struct encoded back to back in `fp`, until
+        the end of the stream. `fp` is read in chunks of `chunk_size` bytes, and values
+        are decoded from those in memory. `native` and `trusted` are the same as for `unpack`.
+        :param bytes|BinaryIO fp: bytes or byte stream to read values from
+        """
+        decode = cls.__schema__.codec.get("decode", native, trusted)
+        return _iter_decode(decode, fp, chunk_size)
 
     @property
     def value(self):
@@ -241,7 +861,7 @@ class Struct(ABC):
 
     def validate(self, s) -> typing.Tuple[bool, str]:
         try:
-            for name, field in s.fields().items():
+            for name, field in s.__schema__.fields.items():
                 valid, message = field.validate(getattr(s, name))
                 if not valid:
                     return False, message
@@ -251,7 +871,7 @@ class Struct(ABC):
 
     @property
     def valid(self) -> typing.Tuple[bool, str]:
-        for name, field in self.fields().items():
+        for name, field in self.__schema__.fields.items():
             valid, message = field.validate(getattr(self, name))
             if not valid:
                 return False, message
@@ -261,13 +881,19 @@ class Struct(ABC):
         if value is None:
             value = self
         output = {}
-        for name, field in value.fields().items():
+        for name, field in value.__schema__.fields.items():
             val = getattr(value, name)
             output[name] = field.to_dict(value=val)
         return output
 
+    def _fixed_size(self) -> typing.Optional[int]:
+        return self.__schema__.size
+
 
 class _ValidatedList(UserList):
+    # counts changes made in place, see `bare.compiler._Tracking`
+    _version = 0
+
     def __init__(self, *args, instance: "Array" = None, **kwargs):
         if instance is None:
             raise ValueError(
@@ -280,6 +906,7 @@ class _ValidatedList(UserList):
         valid, message = self._instance._validateitem(item, length=len(self.data) + 1)
         if not valid:
             raise ValidationError(message)
+        self._version += 1
         self.data.append(item)
 
     def extend(self, other):
@@ -287,11 +914,88 @@ class _ValidatedList(UserList):
         for item in other:
             self.append(item)
 
-    def __setitem__(self, i, item):
-        valid, message = self._instance.validate(i, item)
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def insert(self, i, item):
+        valid, message = self._instance._validateitem(item, length=len(self.data) + 1)
         if not valid:
             raise ValidationError(message)
-        self.data[i] = item
+        self._version += 1
+        self.data.insert(i, item)
+
+    def __setitem__(self, i, item):
+        items = list(item) if isinstance(i, slice) else [item]
+        for x in items:
+            valid, message = self._instance._validateitem(x)
+            if not valid:
+                raise ValidationError(message)
+        self._version += 1
+        self.data[i] = items if isinstance(i, slice) else item
+
+    def __getitem__(self, i):
+        # slices, like copies, aren't tied to the array
+        return self.data[i]
+
+    def copy(self) -> list:
+        return list(self.data)
+
+    def __add__(self, other) -> list:
+        return self.data + list(other)
+
+    def __radd__(self, other) -> list:
+        return list(other) + self.data
+
+    def __mul__(self, n) -> list:
+        return self.data * n
+
+    __rmul__ = __mul__
+
+
+def _changes(name: str):
+    # wraps a method of UserList that changes the list in place without validation
+    method = getattr(UserList, name)
+
+    def change(self, *args, **kwargs):
+        self._version += 1
+        return method(self, *args, **kwargs)
+
+    change.__name__ = name
+    return change
+
+
+for _name in ("__delitem__", "__imul__", "pop", "remove", "clear", "reverse", "sort"):
+    setattr(_ValidatedList, _name, _changes(_name))
+
+
+_buffer_kinds = {
+    **{code: "signed" for code in "bhilqn"},
+    **{code: "unsigned" for code in "BHILQN"},
+    **{code: "float" for code in "efd"},
+    "?": "bool",
+}
+
+
+def _primitive_view(values, fmt: str) -> typing.Optional[memoryview]:
+    """
+    Returns a memoryview of `values` if it is a one dimensional buffer (an ndarray,
+    `array.array`, memoryview...) whose items are laid out exactly like the little
+    endian `struct` format `fmt`, so its raw bytes can be written as is.
+    """
+    try:
+        view = memoryview(values)
+    except TypeError:
+        return None
+    order = view.format[0] if view.format[:1] in ("@", "=", "<", ">", "!") else "@"
+    code = view.format.lstrip("@=<>!")
+    if view.ndim != 1 or view.itemsize != struct.calcsize(fmt):
+        return None
+    if order in (">", "!") or (order in ("@", "=") and sys.byteorder != "little"):
+        return None
+    if _buffer_kinds.get(code) is None or _buffer_kinds.get(code) != _buffer_kinds.get(fmt[1:]):
+        return None
+    return view
 
 
 class Array(Field):
@@ -299,8 +1003,30 @@ class Array(Field):
     _type: typing.Type[Field] = None
     _length = 0  # zero means variable length
     _default = None
-
-    def __init__(self, type: typing.Type[Field] = None, length=0, values=None):
+    _numpy = False
+
+    def __init__(
+        self,
+        type: typing.Type[Field] = None,
+        length=0,
+        values=None,
+        validate=True,
+        numpy=None,
+    ):
+        """Array of values of a single BARE type
+
+        :param type: the type of the elements, as a `Field` (or `Struct`) type or instance
+        :param int length: a fixed length for the array, 0 means variable length
+        :param values: initial values
+        :param bool validate: whether to validate the initial values
+        :param bool numpy: decode arrays of fixed width numbers (U8..U64, I8..I64, F32,
+            F64, Bool) into a `numpy.ndarray` in one call instead of a list. Requires numpy.
+        """
+        if numpy is None:
+            numpy = self.__class__._numpy
+        if numpy and np is None:
+            raise ImportError("Array(numpy=True) requires numpy to be installed")
+        self._numpy = numpy
         if type is not None:
             if inspect.isclass(type):
                 self._type = type()
@@ -317,22 +1043,26 @@ class Array(Field):
             self._length = self.__class__._length
         else:
             self._length = length
-        if values:
-            self.validate(values)
+        if values is not None and len(values):
+            if validate:
+                self.validate(values)
             self._value = _ValidatedList(values, instance=self)
         else:
             self._value = _ValidatedList(instance=self)
 
     def _validateitem(self, item, length=0) -> typing.Tuple[bool, str]:
-        if length > self._length:
+        if self._length > 0 and length > self._length:
             return False, f"length {length} larger than array max: {self._length}"
-        if self._length > 0 and len(self._value) + 1 > self._length:
-            return False, "outside of length bounds"
         return self._type.validate(item)
 
     def validate(self, items: typing.Collection) -> typing.Tuple[bool, str]:
         if self._length > 0 and len(items) > self._length:
             return False, f"lenth {len(items)} larger than array max: {self._length}"
+        fmt = getattr(self._type, "_fmt", None)
+        if fmt is not None and not isinstance(items, (list, tuple, UserList)):
+            # buffers of matching fixed width numbers don't need checking item by item
+            if _primitive_view(items, fmt) is not None:
+                return True, None
         if self._length > 0 and len(items) > self._length:
             return False, f"length {len(items)} greater than max length {self._length}"
         for item in items:
@@ -376,9 +1106,131 @@ class Array(Field):
             values.append(val)
         return self.__class__(type=self._type, length=self._length, values=values)
 
+    def pack_iter(
+        self, values: typing.Iterable, fp: typing.BinaryIO, count: int = None, validate=True
+    ) -> int:
+        """
+        Encodes the array from the iterable `values` straight into the stream `fp`, one
+        element at a time, so the whole array never has to be held in memory. Each
+        element is validated as it's encoded.
+        :param int count: the number of elements `values` yields. If it isn't known, the
+            encoded elements are spilled to a temporary file (in memory while small)
+            until they've all been counted.
+        :returns: the number of elements written
+        """
+        encode = _element_encoder(self._type, validate)
+        if self._length == 0:
+            return _pack_stream(fp, values, encode, count)
+        written = _write_items(fp, values, encode, self._length)
+        # fixed length arrays are padded with the element's default value
+        if isinstance(self._type, Struct):
+            default = self._type.__class__()
+        else:
+            default = self._type._default
+        _write_items(fp, itertools.repeat(default, self._length - written), encode)
+        return self._length
+
+    def view(self, data, offset=0):
+        """
+        Returns a read-only sequence view of the array encoded in the bytes-like `data` at
+        `offset`, whose elements are decoded the first time they're accessed. See
+        `Struct.view`.
+        """
+        from .view import ArrayView
+
+        return ArrayView(self, data, offset)
+
+    def scan(self, data, offset=0) -> typing.List[int]:
+        """
+        Walks the array encoded in the bytes-like `data` at `offset` without decoding its
+        elements, and returns the offsets each element starts at, followed by the offset
+        just past the array.
+        """
+        from .compiler import compile_field, compile_struct
+        from .varint import decode_uvarint
+
+        element = self._type
+        if isinstance(element, Struct):
+            skip = compile_struct(type(element)).skip
+        else:
+            skip = compile_field(element).skip
+        size = element._fixed_size()
+
+        def walk(buf, pos):
+            if self._length == 0:
+                count, pos = decode_uvarint(buf, pos)
+            else:
+                count = self._length
+            if size is not None:
+                offsets = list(range(pos, pos + (count + 1) * size, size))
+            else:
+                offsets = [pos]
+                append = offsets.append
+                for _ in range(count):
+                    pos = skip(buf, pos)
+                    append(pos)
+            if offsets[-1] > len(buf):
+                raise IndexError
+            return offsets, offsets[-1]
+
+        offsets, _ = _decode_buffer(walk, data, offset)
+        return offsets
+
+    def unpack_parallel(
+        self,
+        data,
+        workers: int = None,
+        chunksize=4096,
+        native=False,
+        trusted=False,
+        executor: concurrent.futures.Executor = None,
+    ):
+        """
+        Decodes the array encoded in the bytes-like `data` on a pool of worker processes.
+        The element boundaries are found with `scan` first, then runs of `chunksize`
+        elements are decoded in parallel and joined back in order.
+        :param int workers: the number of worker processes, defaults to the number of CPUs
+        :param bool native: see `Field.unpack`
+        :param bool trusted: see `Struct.unpack`
+        :param executor: an existing executor to use instead of starting a process pool
+        """
+        offsets = self.scan(data)
+        count = len(offsets) - 1
+        view = memoryview(data).cast("B")
+        bounds = list(range(0, count, chunksize)) + [count]
+        # each chunk is sent as its element count and a copy of its bytes
+        chunks = (
+            (end - start, bytes(view[offsets[start] : offsets[end]]))
+            for start, end in zip(bounds, bounds[1:])
+        )
+        element = self._type
+        if isinstance(element, Struct):
+            element = type(element)
+        task = partial(_unpack_elements, element, native, trusted)
+        values = _run_chunks(task, chunks, workers, executor)
+        return values if native else self._wrap(values)
+
+    def _wrap(self, value) -> "Array":
+        wrapped = copy.copy(self)
+        if isinstance(value, list):
+            wrapped._value = _ValidatedList(value, instance=wrapped)
+        else:
+            wrapped._value = value  # e.g. a numpy.ndarray
+        return wrapped
+
+    def _fixed_size(self) -> typing.Optional[int]:
+        if self._length == 0:
+            return None
+        size = self._type._fixed_size()
+        if size is None:
+            return None
+        return size * self._length
+
     def to_dict(self, value=None):
         if value is None:
             value = self._value
+        if hasattr(value, "tolist"):
+            return value.tolist()  # numpy.ndarray, array.array or memoryview
         output = []
 
         for item in value:
@@ -390,26 +1242,44 @@ class Array(Field):
 
 
 class _ValidatedMap(UserDict):
-    def __init__(self, *args, instance: "Map" = None, **kwargs):
+    # counts changes made in place, see `bare.compiler._Tracking`
+    _version = 0
+
+    def __init__(self, *args, instance: "Map" = None, validate=True, **kwargs):
         if instance is None:
             raise ValueError(
                 "Must specify backreference to Map. This is likely a bug in the library."
             )
         self._instance = instance
-        super().__init__(*args, **kwargs)
+        if validate:
+            super().__init__(*args, **kwargs)
+        else:
+            # the caller vouches for the initial contents, later updates are still checked
+            initial = args[0] if args and args[0] is not None else {}
+            self.data = dict(initial, **kwargs)
 
     def __setitem__(self, key, value):
         valid, message = self._instance.validate({key: value})
         if not valid:
             raise ValidationError(message)
+        self._version += 1
         self.data[key] = value
 
+    def __delitem__(self, key):
+        self._version += 1
+        del self.data[key]
+
     def update(self, other: Mapping):
         valid, message = self._instance.validate(other)
         if not valid:
             raise ValidationError(f"Unable to update map: {message}")
+        self._version += 1
         self.data.update(other)
 
+    def __ior__(self, other: Mapping):
+        self.update(other)
+        return self
+
 
 class Map(Field):
     _type = BareType.Map
@@ -417,7 +1287,9 @@ class Map(Field):
     _valuetype: typing.Type[Field] = None
     _default = None
 
-    def __init__(self, keytype: Field = None, valuetype: Field = None, value=None):
+    def __init__(
+        self, keytype: Field = None, valuetype: Field = None, value=None, validate=True
+    ):
         if keytype is not None:
             if inspect.isclass(keytype):
                 self._keytype = keytype()
@@ -440,14 +1312,14 @@ class Map(Field):
             )
         else:
             self._valuetype = self.__class__._valuetype()
-        if value:
+        if value and validate:
             for k, v in value.items():
                 valid, message = self._validatekv(k, v)
                 if not valid:
                     raise ValidationError(
                         f"Unable to assign value to key: {k}: {message}"
                     )
-        self._value = _ValidatedMap(value, instance=self)
+        self._value = _ValidatedMap(value, instance=self, validate=validate)
 
     def __set__(self, instance, value):
         if instance is None:
@@ -487,6 +1359,27 @@ class Map(Field):
             self._keytype._pack(fp, value=k)
             self._valuetype._pack(fp, value=v)
 
+    def pack_iter(
+        self, items: typing.Iterable, fp: typing.BinaryIO, count: int = None, validate=True
+    ) -> int:
+        """
+        Encodes the map from the iterable of `(key, value)` pairs `items` (or a mapping)
+        straight into the stream `fp`, one entry at a time. See `Array.pack_iter`. Keys
+        aren't checked for duplicates.
+        :returns: the number of entries written
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        encode_key = _element_encoder(self._keytype, validate)
+        encode_value = _element_encoder(self._valuetype, validate)
+
+        def encode(out, item):
+            key, value = item
+            encode_key(out, key)
+            encode_value(out, value)
+
+        return _pack_stream(fp, items, encode, count)
+
     def _unpack(self, fp: typing.BinaryIO) -> "Map":
         count = _read_varint(fp, signed=False)
         values = {}
@@ -498,6 +1391,11 @@ class Map(Field):
             keytype=self._keytype, valuetype=self._valuetype, value=values
         )
 
+    def _wrap(self, value) -> "Map":
+        wrapped = copy.copy(self)
+        wrapped._value = _ValidatedMap(value, instance=wrapped, validate=False)
+        return wrapped
+
     def to_dict(self, value=None):
         if value is None:
             value = self._value
@@ -560,19 +1458,40 @@ class Optional(Field):
         return self.__class__(wrapped=self._wrapped, value=value)
 
 
+class Tagged(typing.NamedTuple):
+    """
+    Tagged is a `Union` value along with the tag of the member it's encoded as. Tagged
+    values skip working out the member from the value when they're validated and packed.
+    """
+
+    tag: int
+    value: typing.Any
+
+
+def _union_dispatch(members: typing.Iterable) -> typing.Tuple[list, dict]:
+    # instantiates member classes, and maps each member type to the first tag it has
+    instances = [member() if inspect.isclass(member) else member for member in members]
+    tags = {}
+    for tag, member in enumerate(instances):
+        tags.setdefault(type(member), tag)
+    return instances, tags
+
+
 class Union(Field):
 
     _members: typing.Tuple[typing.Union[Field, Struct], ...] = ()
 
     def __init__(self, members: typing.Tuple = None, value=None):
+        cls = self.__class__
         if members is None:
-            members = self.__class__._members
-        self._members = []
-        for member in members:
-            if inspect.isclass(member):
-                self._members.append(member(value=value))
-            else:
-                self._members.append(member)
+            # the member instances of a Union subclass are shared by all its instances
+            dispatch = cls.__dict__.get("_dispatch")
+            if dispatch is None:
+                dispatch = _union_dispatch(cls._members)
+                cls._dispatch = dispatch
+        else:
+            dispatch = _union_dispatch(members)
+        self._members, self._tags = dispatch
         if value is not None:
             valid, _ = self.validate(value)
             if not valid:
@@ -585,43 +1504,369 @@ class Union(Field):
     def members(self):
         return self._members
 
+    def tag(self, value) -> typing.Tuple[int, typing.Any]:
+        """
+        Returns the tag of the member `value` is encoded as, along with the value to
+        encode: a plain field is unwrapped. Field and Struct values are looked up by
+        their type, native values go to the first member they're valid for.
+        :raises TypeError: if `value` isn't valid for any of the members
+        """
+        if type(value) is Tagged:
+            tag, value = value
+            if not 0 <= tag < len(self._members):
+                raise TypeError(f"{tag} is not a tag of {self._members}")
+        else:
+            tag = self._tags.get(type(value))
+            if tag is None:
+                if isinstance(value, (Field, Struct)):
+                    raise TypeError("Unable to determine Union member type for value.")
+                for tag, member in enumerate(self._members):
+                    try:
+                        valid, _ = member.validate(value)
+                    except TypeError:  # e.g. an Array member given a number
+                        continue
+                    if valid:
+                        return tag, value
+                raise TypeError("Unable to determine Union member type for value.")
+        if isinstance(value, Field):
+            value = value._value
+        return tag, value
+
     def validate(self, value) -> typing.Tuple[bool, str]:
-        if isinstance(value, Field) and value.__class__ in [
-            x.__class__ for x in self._members
-        ]:
-            return value.validate(value.value)
-        for member in self._members:
-            valid, _ = member.validate(value)
-            if valid:
-                return True, None
-        return False, f"type {type(value)} is not valid for one of {self._members}"
+        tagged = type(value) is Tagged
+        try:
+            tag, unwrapped = self.tag(value)
+        except TypeError:
+            return False, f"type {type(value)} is not valid for one of {self._members}"
+        if tagged:
+            value = value.value
+        elif not isinstance(value, (Field, Struct)):
+            return True, None  # the member was found by validating the value
+        if isinstance(value, (Field, Struct)) and type(value) is not type(self._members[tag]):
+            return False, f"type {type(value)} is not valid for member {tag}"
+        return self._members[tag].validate(unwrapped)
 
     def _pack(self, fp: typing.BinaryIO, value=None):
         if value is None:
             value = self._value
-        for id, member in enumerate(self._members):
-            if isinstance(value, (Field, Struct)):
-                # it's a field, so we should try to check for type
-                valid = type(member) == type(value)
-            else:
-                # no idea what it might be, maybe a python native value
-                # do the less good validation check
-                valid, _ = self.validate(value)
-            if valid:
-                _write_varint(fp, id, signed=False)
-                member._pack(fp, value=value)
-                return
-        raise TypeError("Unable to determine Union member type for value.")
+        tag, value = self.tag(value)
+        _write_varint(fp, tag, signed=False)
+        self._members[tag]._pack(fp, value=value)
 
     def _unpack(self, fp: typing.BinaryIO):
         uid = _read_varint(fp, signed=False)
-        value = self._members[uid]._unpack(fp)
-        return self.__class__(members=self._members, value=value)
+        if uid >= len(self._members):
+            raise ValidationError(f"Invalid tag {uid} for union")
+        return self._wrap(self._members[uid]._unpack(fp))
 
     def to_dict(self, value=None):
         if value is None:
             value = self._value
-        return value.to_dict()
+        if type(value) is Tagged:
+            value = value.value
+        if isinstance(value, (Field, Struct)):
+            return value.to_dict()
+        return value
+
+
+class Decoder:
+    """
+    Decoder incrementally decodes consecutive values of a single type from data fed to
+    it in arbitrary chunks, e.g. as it arrives from a socket. Partially received values
+    are kept decoded as far as they go, so each byte is only ever parsed once.
+
+    :param type: a `Struct` subclass, or a `Field` type or instance
+    :param bool native: see `Struct.unpack`
+    :param bool trusted: see `Struct.unpack`
+    """
+
+    def __init__(self, type, native=False, trusted=False):
+        from .compiler import compile_field, compile_struct
+
+        if inspect.isclass(type) and issubclass(type, Struct):
+            codec = compile_struct(type)
+            size = type.bytesize()
+            self._wrap = None
+        else:
+            if inspect.isclass(type):
+                type = type()
+            codec = compile_field(type)
+            size = type._fixed_size()
+            self._wrap = None if native else type._wrap
+        if size == 0:
+            raise ValueError(f"Unable to delimit consecutive zero width values of {type}")
+        self._parse = codec.get("parse", native, trusted)
+        self._buffer = bytearray()
+        self._pos = 0
+        self._parser = None
+        self._needed = 0
+
+    def feed(self, data) -> list:
+        """
+        Buffers `data` and returns every value completed by it, in order.
+        """
+        buffer = self._buffer
+        buffer += data
+        values = []
+        while True:
+            if self._parser is None:
+                if self._pos == len(buffer):
+                    break
+                self._parser = self._parse()
+                self._needed = next(self._parser)
+            needed = self._needed
+            if len(buffer) - self._pos < needed:
+                break
+            chunk = bytes(buffer[self._pos : self._pos + needed])
+            self._pos += needed
+            try:
+                self._needed = self._parser.send(chunk)
+            except StopIteration as e:
+                self._parser = None
+                values.append(e.value if self._wrap is None else self._wrap(e.value))
+        if self._pos > len(buffer) // 2:
+            # drop consumed data, only once it's most of the buffer to keep this linear
+            del buffer[: self._pos]
+            self._pos = 0
+        return values
+
+    @property
+    def pending(self) -> int:
+        """The number of buffered bytes that haven't been parsed yet"""
+        return len(self._buffer) - self._pos
+
+    def close(self):
+        """
+        Signals the end of the data, raising a `RuntimeError` if it ended in the middle
+        of a value.
+        """
+        if self._parser is not None or self.pending:
+            raise RuntimeError("Not enough bytes in buffer to decode")
+
+
+class _Recorder:
+    """_Recorder reads from a stream, keeping a copy of everything read"""
+
+    def __init__(self, fp: typing.BinaryIO):
+        self.fp = fp
+        self.data = bytearray()
+
+    def read(self, size=-1) -> bytes:
+        data = self.fp.read(size)
+        self.data += data
+        return data
+
+
+def _is_buffer(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview))
+
+
+def _decode_buffer(decode, data, offset=0):
+    """
+    Runs a compiled buffer decoder (see `bare.compiler`) over any bytes-like object,
+    returning the decoded value and the offset just past it.
+    """
+    # the view isn't released explicitly, decoded ndarrays may still reference it
+    view = memoryview(data)
+    if view.ndim != 1 or view.format != "B":
+        view = view.cast("B")
+    try:
+        return decode(view, offset)
+    except (IndexError, struct.error) as e:
+        raise RuntimeError("Not enough bytes in buffer to decode") from e
+
+
+def _iter_decode(decode, fp, chunk_size: int):
+    """
+    Yields consecutive values decoded by a compiled buffer decoder (see `bare.compiler`)
+    from `fp`, which is read `chunk_size` bytes at a time. Stops at the end of the
+    stream, which must fall on a value boundary.
+    """
+    if _is_buffer(fp):
+        data, eof = fp, True
+    else:
+        data, eof = b"", False
+    view = memoryview(data)
+    if view.ndim != 1 or view.format != "B":
+        view = view.cast("B")
+    pos = 0
+    size = chunk_size
+    while True:
+        if pos < len(view):
+            try:
+                value, end = decode(view, pos)
+            except (IndexError, struct.error, RuntimeError):
+                # the value straddles the end of the buffered data
+                if eof:
+                    raise RuntimeError("Not enough bytes in buffer to decode")
+            else:
+                pos = end
+                size = chunk_size
+                yield value
+                continue
+            # read increasingly large chunks for values much larger than chunk_size
+            size *= 2
+        elif eof:
+            return
+        chunk = fp.read(size)
+        if not chunk:
+            eof = True
+            continue
+        data = bytes(view[pos:]) + chunk
+        view = memoryview(data)
+        pos = 0
+
+
+# stands in for the messages `Struct.iter_filter` skips
+_skipped = object()
+
+
+def _condition(condition) -> typing.Callable[[typing.Any], bool]:
+    if callable(condition):
+        return condition
+    if isinstance(condition, (set, frozenset, range)):
+        return condition.__contains__
+    if isinstance(condition, slice):
+        start, stop = condition.start, condition.stop
+        return lambda value: (start is None or start <= value) and (
+            stop is None or value < stop
+        )
+    return partial(operator.eq, condition)
+
+
+def _element_encoder(field, validate=True) -> typing.Callable:
+    # returns a function appending the encoding of a single value of `field` to a bytearray
+    from .compiler import compile_field
+
+    if isinstance(field, Struct):
+        encode = field.__schema__.codec.encode
+    else:
+        encode = compile_field(field).encode
+
+    def encode_element(out, value):
+        if isinstance(value, Field):
+            value = value._value
+        if validate:
+            valid, message = field.validate(value)
+            if not valid:
+                raise ValidationError(f"Invalid element: {message}")
+        encode(out, value)
+
+    return encode_element
+
+
+def _write_items(fp, items, encode, limit: int = None) -> int:
+    # encodes `items` into fp, buffering writes, and returns how many there were
+    out = bytearray()
+    written = 0
+    for item in items:
+        written += 1
+        if limit is not None and written > limit:
+            raise ValueError(f"Expected at most {limit} items")
+        encode(out, item)
+        if len(out) >= 1 << 16:
+            fp.write(out)
+            out.clear()
+    fp.write(out)
+    return written
+
+
+def _pack_stream(fp, items, encode, count=None, spill_size=1 << 22) -> int:
+    # writes a count prefixed sequence of items, spilling them while they're counted
+    if count is None:
+        with tempfile.SpooledTemporaryFile(max_size=spill_size) as spill:
+            count = _write_items(spill, items, encode)
+            spill.seek(0)
+            _write_varint(fp, count, signed=False)
+            shutil.copyfileobj(spill, fp)
+        return count
+    _write_varint(fp, count, signed=False)
+    written = _write_items(fp, items, encode, count)
+    if written != count:
+        raise ValueError(f"Expected {count} items, got {written}")
+    return count
+
+
+def _encode_into(codec, value, buffer, offset=0) -> int:
+    """
+    Encodes `value` with the compiled `write` function of `codec` (see `bare.compiler`)
+    directly into `buffer` at `offset`, returning the offset just past it. The buffer is
+    checked to be large enough up front, with the codec's `size`.
+    """
+    view = memoryview(buffer)
+    if view.ndim != 1 or view.format != "B":
+        view = view.cast("B")
+    size = codec.size(value)
+    end = offset + size
+    if offset < 0 or end > len(view):
+        raise ValueError(
+            f"pack_into requires a buffer of at least {end} bytes for packing "
+            f"{size} bytes at offset {offset} (actual buffer size is {len(view)})"
+        )
+    return codec.write(view, offset, value)
+
+
+def _decode_many(decode, count, buf, pos):
+    # decodes `count` consecutive values, or all of them up to the end of the buffer
+    values = []
+    append = values.append
+    if count is None:
+        end = len(buf)
+        while pos < end:
+            value, pos = decode(buf, pos)
+            append(value)
+    else:
+        for _ in range(count):
+            value, pos = decode(buf, pos)
+            append(value)
+    return values, pos
+
+
+def _chunks(iterable: typing.Iterable, size: int) -> typing.Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _run_chunks(task, chunks, workers=None, executor=None) -> list:
+    # runs `task` over every chunk on a process pool and flattens the results, in order
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            return _run_chunks(task, chunks, executor=executor)
+    return list(itertools.chain.from_iterable(executor.map(task, chunks)))
+
+
+def _unpack_chunk(cls, native, trusted, buffers):
+    decode = cls.__schema__.codec.get("decode", native, trusted)
+    return [_decode_buffer(decode, data)[0] for data in buffers]
+
+
+def _unpack_elements(element, native, trusted, chunk):
+    from .compiler import compile_field
+
+    if isinstance(element, type):
+        decode = element.__schema__.codec.get("decode", native, trusted)
+    else:
+        decode = compile_field(element).get("decode", native, trusted)
+    count, data = chunk
+    values, _ = _decode_buffer(partial(_decode_many, decode, count), data)
+    return values
+
+
+def _pack_chunk(cls, values):
+    encode = cls.__schema__.codec.encode
+    return [bytes(encode(bytearray(), value)) for value in values]
+
+
+def _decode_bytesio(decode, fp: io.BytesIO):
+    # decode straight out of the BytesIO's buffer and advance the stream past the value
+    with fp.getbuffer() as view:
+        value, offset = _decode_buffer(decode, view, fp.tell())
+    fp.seek(offset)
+    return value
 
 
 def _write_string(fp: typing.BinaryIO, val: str):
@@ -644,11 +1889,9 @@ def _write_varint(fp: typing.BinaryIO, val: int, signed=True):
             val = (2 * abs(val)) - 1
         else:
             val = 2 * val
-    while val >= 0x80:
-        fp.write(struct.pack("<B", (val & 0xFF) | 0x80))
-        val >>= 7
-
-    fp.write(struct.pack("<B", val))
+    out = bytearray()
+    encode_uvarint(out, val)
+    fp.write(out)
 
 
 def _read_varint(fp: typing.BinaryIO, signed=True) -> int:
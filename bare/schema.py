@@ -0,0 +1,409 @@
+"""
+bare.schema parses BARE schema documents (see https://baremessages.org/) into a list of
+type definitions. Both the original syntax (`[]T`, `map[K]V`, `(A | B)`) and the
+current one (`list<T>`, `map<K><V>`, `union {A | B}`, `struct {...}`) are accepted:
+
+    type PublicKey data<128>
+
+    enum Department {
+      ACCOUNTING
+      DEVELOPMENT = 99
+    }
+
+    type Customer {
+      name: str
+      keys: map[str]PublicKey
+      orders: []{
+        orderId: i64
+        quantity: i32
+      }
+    }
+
+    type Person (Customer | Employee)
+
+See `bare.compile` for turning the definitions into Python classes and codecs.
+"""
+import re
+import typing
+
+PRIMITIVES = (
+    "uint",
+    "int",
+    "u8",
+    "u16",
+    "u32",
+    "u64",
+    "i8",
+    "i16",
+    "i32",
+    "i64",
+    "f32",
+    "f64",
+    "bool",
+    "str",
+    "data",
+    "void",
+)
+
+# map keys may be any primitive except these
+_INVALID_KEYS = ("f32", "f64", "data", "void")
+
+_KEYWORDS = PRIMITIVES + ("string", "optional", "list", "map", "union", "struct", "enum")
+
+
+class SchemaError(ValueError):
+    """
+    SchemaError is raised for invalid schema documents, with the offending line.
+    """
+
+    def __init__(self, message: str, line: int = None):
+        if line is not None:
+            message = f"line {line}: {message}"
+        super().__init__(message)
+        self.line = line
+
+
+class Primitive(typing.NamedTuple):
+    """A primitive type, `length` is the length of fixed length `data`"""
+
+    name: str
+    length: int = 0
+
+
+class Reference(typing.NamedTuple):
+    """A reference to a user defined type"""
+
+    name: str
+    line: int = None
+
+
+class OptionalType(typing.NamedTuple):
+    type: typing.Any
+
+
+class ListType(typing.NamedTuple):
+    """A list, of a fixed length unless `length` is 0"""
+
+    type: typing.Any
+    length: int = 0
+
+
+class MapType(typing.NamedTuple):
+    key: typing.Any
+    value: typing.Any
+
+
+class UnionType(typing.NamedTuple):
+    """A union, `members` holds `(type, tag)` pairs"""
+
+    members: typing.Tuple[typing.Tuple[typing.Any, int], ...]
+
+
+class StructType(typing.NamedTuple):
+    """A struct, `fields` holds `(name, type)` pairs in order"""
+
+    fields: typing.Tuple[typing.Tuple[str, typing.Any], ...]
+
+
+class EnumType(typing.NamedTuple):
+    """An enum, `values` holds `(name, value)` pairs in order"""
+
+    values: typing.Tuple[typing.Tuple[str, int], ...]
+
+
+class TypeDef(typing.NamedTuple):
+    """A named, user defined type"""
+
+    name: str
+    type: typing.Any
+    line: int = None
+
+
+_TOKEN = re.compile(r"(?P<space>[ \t\r]+|#[^\n]*)|(?P<newline>\n)|(?P<token>\w+|[^\w\s])")
+
+
+def _tokenize(text: str) -> typing.List[typing.Tuple[str, int]]:
+    tokens = []
+    line = 1
+    for match in _TOKEN.finditer(text):
+        if match.lastgroup == "newline":
+            line += 1
+        elif match.lastgroup == "token":
+            tokens.append((match.group(), line))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, text: str):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    @property
+    def line(self) -> int:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][1]
+        return self.tokens[-1][1] if self.tokens else 1
+
+    def peek(self) -> typing.Optional[str]:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def next(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise SchemaError("unexpected end of schema", self.line)
+        self.pos += 1
+        return token
+
+    def expect(self, expected: str):
+        token = self.next()
+        if token != expected:
+            line = self.tokens[self.pos - 1][1]
+            raise SchemaError(f"expected {expected!r}, got {token!r}", line)
+
+    def accept(self, token: str) -> bool:
+        if self.peek() == token:
+            self.pos += 1
+            return True
+        return False
+
+    def name(self) -> str:
+        line = self.line
+        token = self.next()
+        if not re.match(r"[A-Za-z_]\w*$", token):
+            raise SchemaError(f"expected a name, got {token!r}", line)
+        return token
+
+    def integer(self) -> int:
+        line = self.line
+        token = self.next()
+        if not token.isdigit():
+            raise SchemaError(f"expected an integer, got {token!r}", line)
+        return int(token)
+
+    def schema(self) -> typing.List[TypeDef]:
+        definitions = []
+        while self.peek() is not None:
+            line = self.line
+            keyword = self.next()
+            if keyword == "type":
+                name = self.type_name()
+                if self.accept("enum"):
+                    definition = TypeDef(name, self.enum(), line)
+                else:
+                    definition = TypeDef(name, self.type(), line)
+            elif keyword == "enum":
+                definition = TypeDef(self.type_name(), self.enum(), line)
+            else:
+                raise SchemaError(f"expected 'type' or 'enum', got {keyword!r}", line)
+            definitions.append(definition)
+        return definitions
+
+    def type_name(self) -> str:
+        line = self.line
+        name = self.name()
+        if name in _KEYWORDS:
+            raise SchemaError(f"{name!r} can't be used as a type name", line)
+        return name
+
+    def type(self):
+        line = self.line
+        token = self.next()
+        if token == "string":
+            return Primitive("str")
+        if token == "data":
+            if self.accept("<"):
+                length = self.integer()
+                self.expect(">")
+                return Primitive("data", length)
+            if self.accept("["):
+                length = self.integer()
+                self.expect("]")
+                return Primitive("data", length)
+            return Primitive("data")
+        if token in PRIMITIVES:
+            return Primitive(token)
+        if token == "optional":
+            self.expect("<")
+            wrapped = self.type()
+            self.expect(">")
+            return OptionalType(wrapped)
+        if token == "[":
+            length = 0 if self.peek() == "]" else self.integer()
+            self.expect("]")
+            return ListType(self.type(), length)
+        if token == "list":
+            self.expect("<")
+            element = self.type()
+            self.expect(">")
+            length = 0
+            if self.accept("["):
+                length = self.integer()
+                self.expect("]")
+            return ListType(element, length)
+        if token == "map":
+            if self.accept("["):
+                key = self.type()
+                self.expect("]")
+            else:
+                self.expect("<")
+                key = self.type()
+                self.expect(">")
+                self.expect("<")
+                value = self.type()
+                self.expect(">")
+                return self.map(key, value, line)
+            return self.map(key, self.type(), line)
+        if token == "(":
+            return self.union(")")
+        if token == "union":
+            self.expect("{")
+            return self.union("}")
+        if token == "{":
+            return self.struct()
+        if token == "struct":
+            self.expect("{")
+            return self.struct()
+        if token == "enum":
+            raise SchemaError("enums must be declared as named types", line)
+        if re.match(r"[A-Za-z_]\w*$", token):
+            return Reference(token, line)
+        raise SchemaError(f"expected a type, got {token!r}", line)
+
+    def map(self, key, value, line: int) -> MapType:
+        if not isinstance(key, (Primitive, Reference)) or (
+            isinstance(key, Primitive) and (key.name in _INVALID_KEYS)
+        ):
+            raise SchemaError(
+                "map keys must be primitive types other than f32, f64, data and void", line
+            )
+        return MapType(key, value)
+
+    def union(self, end: str) -> UnionType:
+        members = []
+        self.accept("|")
+        while True:
+            line = self.line
+            member = self.type()
+            tag = len(members)
+            if self.accept("="):
+                tag = self.integer()
+                if tag != len(members):
+                    # members are addressed by their position in `Union._members`
+                    raise SchemaError(
+                        f"union tag {tag} is out of order, tags must count up from 0",
+                        line,
+                    )
+            members.append((member, tag))
+            if self.accept(end):
+                break
+            self.expect("|")
+            if self.accept(end):
+                break
+        return UnionType(tuple(members))
+
+    def struct(self) -> StructType:
+        fields = []
+        names = set()
+        while not self.accept("}"):
+            line = self.line
+            name = self.name()
+            if name in names:
+                raise SchemaError(f"duplicate field {name!r}", line)
+            names.add(name)
+            self.expect(":")
+            fields.append((name, self.type()))
+            self.accept(",")
+        if not fields:
+            line = self.tokens[self.pos - 1][1]
+            raise SchemaError("structs must have at least one field", line)
+        return StructType(tuple(fields))
+
+    def enum(self) -> EnumType:
+        self.expect("{")
+        values = []
+        value = 0
+        seen = set()
+        while not self.accept("}"):
+            line = self.line
+            name = self.name()
+            if self.accept("="):
+                value = self.integer()
+            if value in seen or name in (n for n, _ in values):
+                raise SchemaError(f"duplicate enum value {name} = {value}", line)
+            seen.add(value)
+            values.append((name, value))
+            value += 1
+            self.accept(",")
+        return EnumType(tuple(values))
+
+
+def _references(type) -> typing.Iterator[Reference]:
+    if isinstance(type, Reference):
+        yield type
+    elif isinstance(type, (OptionalType, ListType)):
+        yield from _references(type.type)
+    elif isinstance(type, MapType):
+        yield from _references(type.key)
+        yield from _references(type.value)
+    elif isinstance(type, UnionType):
+        for member, _ in type.members:
+            yield from _references(member)
+    elif isinstance(type, StructType):
+        for _, field in type.fields:
+            yield from _references(field)
+
+
+def _map_keys(type) -> typing.Iterator[typing.Any]:
+    if isinstance(type, MapType):
+        yield type.key
+        yield from _map_keys(type.value)
+    elif isinstance(type, (OptionalType, ListType)):
+        yield from _map_keys(type.type)
+    elif isinstance(type, UnionType):
+        for member, _ in type.members:
+            yield from _map_keys(member)
+    elif isinstance(type, StructType):
+        for _, field in type.fields:
+            yield from _map_keys(field)
+
+
+def _valid_key(reference: Reference, names: typing.Mapping[str, TypeDef]) -> bool:
+    # follows aliases down to the primitive or enum they stand for
+    seen = set()
+    type = reference
+    while isinstance(type, Reference):
+        if type.name in seen:
+            return False
+        seen.add(type.name)
+        type = names[type.name].type
+    if isinstance(type, Primitive):
+        return type.name not in _INVALID_KEYS
+    return isinstance(type, EnumType)
+
+
+def parse(text: str) -> typing.List[TypeDef]:
+    """
+    Parses the schema document `text` and returns its type definitions, in order.
+    :raises SchemaError: if the document is invalid or refers to undefined types
+    """
+    definitions = _Parser(text).schema()
+    names = {}
+    for definition in definitions:
+        if definition.name in names:
+            raise SchemaError(f"type {definition.name!r} is defined twice", definition.line)
+        names[definition.name] = definition
+    for definition in definitions:
+        for reference in _references(definition.type):
+            if reference.name not in names:
+                raise SchemaError(f"undefined type {reference.name!r}", reference.line)
+    for definition in definitions:
+        for key in _map_keys(definition.type):
+            if isinstance(key, Reference) and not _valid_key(key, names):
+                raise SchemaError(
+                    "map keys must be primitive types other than f32, f64, data and void, "
+                    f"or enums, {key.name!r} is neither",
+                    key.line,
+                )
+    return definitions
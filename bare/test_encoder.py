@@ -1,13 +1,34 @@
 from .types import *
 
 # TODO: fix import structure, structs should be somewhere else
-from .encoder import Struct, Map, Array, _ValidatedMap, ValidationError, Optional, Union
+from .encoder import (
+    Struct,
+    Map,
+    Array,
+    _ValidatedMap,
+    ValidationError,
+    Optional,
+    Union,
+    Decoder,
+    Tagged,
+)
+from . import varint
 from collections import OrderedDict
 import pytest
 import enum
 import io
 import os
 import inspect
+import struct
+import array
+import asyncio
+import concurrent.futures
+import pickle
+from . import aio
+from . import compiler
+from .compile import generate, main as compile_main
+from .schema import SchemaError
+import types
 
 
 class Nested(Struct):
@@ -239,6 +260,7 @@ def test_people(file):
         for person in people:
             person.pack(buf)
         assert buf.getvalue() == f
+        assert sum(person.encoded_size() for person in people) == len(f)
 
 
 def test_varint():
@@ -327,3 +349,926 @@ def test_map():
     expected = b"\x02\x04\x74\x65\x73\x74\x04\x74\x65\x73\x74\x07\x61\x6e\x6f\x74\x68\x65\x72\x04\x63\x61\x73\x65"
     m = Map(Str, Str, value={"test": "test", "another": "case"})
     assert m.pack() == expected
+
+
+class CompiledStruct(Struct):
+    o = Optional(Str)
+    m = Map(Str, U8)
+    a = Array(Int)
+    f = Array(U8, length=3)
+    u = Union(members=(Str, Int))
+    n = Nested()
+
+
+def test_compiled_codec():
+    s = CompiledStruct(o="hi", m={"a": 1}, a=[1, -2], f=[1], u=5, n=Nested(s="n"))
+    packed = s.pack()
+    assert packed == b"\x01\x02hi\x01\x01a\x01\x02\x02\x03\x01\x00\x00\x01\x0a\x01n"
+    assert CompiledStruct.__schema__.codec is CompiledStruct.__schema__.codec
+    unpacked = CompiledStruct.unpack(packed)
+    assert unpacked.o == "hi"
+    assert unpacked.m == {"a": 1}
+    assert unpacked.a == [1, -2]
+    assert unpacked.f == [1, 0, 0]
+    assert isinstance(unpacked.u, Int) and unpacked.u.value == 5
+    assert unpacked.n.s == "n"
+    assert unpacked.pack() == packed
+
+
+class FixedBase(Struct):
+    a = U8()
+    b = I32()
+
+
+class FixedChild(FixedBase):
+    c = F64()
+    d = DataFixed(length=3)
+    e = Array(U16, length=2)
+
+
+def test_schema():
+    schema = FixedChild.__schema__
+    assert list(schema.fields) == ["a", "b", "c", "d", "e"]
+    assert FixedChild.fields() is schema.fields
+    assert schema.attrs["a"] == "_a"
+    assert schema.sizes == OrderedDict(a=1, b=4, c=8, d=3, e=4)
+    assert schema.size == 20
+    assert Example.__schema__.size is None
+    assert Example.__schema__.attrs["n"] == "n"
+    child = FixedChild(a=1, b=-2, c=1.5, d=b"abc", e=[1, 2])
+    assert FixedChild.unpack(child.pack()).to_dict() == child.to_dict()
+
+
+class CompactNested(Struct, compact=True):
+    s = Str()
+
+
+class CompactStruct(Struct, compact=True):
+    i = Int()
+    o = Optional(Str)
+    n = CompactNested()
+    a = Array(U8)
+
+
+def test_compact_struct():
+    c = CompactStruct(i=1, o="o", n=CompactNested(s="s"), a=[1, 2])
+    assert not hasattr(c, "__dict__")
+    assert CompactStruct.__schema__.compact
+    assert CompactStruct.__schema__.attrs["n"] == "_n"
+    assert isinstance(CompactStruct.n, CompactNested)
+    assert c.n.s == "s"
+    with pytest.raises(ValidationError):
+        c.i = "1"
+    with pytest.raises(AttributeError):
+        c.other = 1
+    c.o = None
+    unpacked = CompactStruct.unpack(c.pack())
+    assert unpacked.to_dict() == c.to_dict()
+    assert CompactStruct().to_dict() == {"i": 0, "o": None, "n": {"s": ""}, "a": []}
+
+
+def test_buffer_decode():
+    s = CompiledStruct(o=None, m={"a": 1}, a=[300], f=[1, 2, 3], u="u", n=Nested(s="n"))
+    packed = s.pack()
+    for data in (packed, bytearray(packed), memoryview(packed)):
+        assert CompiledStruct.unpack(data).to_dict() == s.to_dict()
+    fp = io.BytesIO(packed * 2)
+    CompiledStruct.unpack(fp)
+    assert fp.tell() == len(packed)
+    assert CompiledStruct.unpack(fp).pack() == packed
+    with pytest.raises(RuntimeError):
+        CompiledStruct.unpack(packed[:-1])
+    assert Array(U16).unpack(b"\x02\x01\x00\x02\x00").value == [1, 2]
+    assert Str().unpack(memoryview(b"\x02hi")).value == "hi"
+    assert Map(Str, Int).unpack(b"\x01\x01a\x03").value == {"a": -2}
+
+
+class Point(Struct):
+    x = I32()
+    y = I32()
+
+
+class FixedRecord(Struct):
+    p = Point()
+    flag = Bool()
+    key = DataFixed(length=2)
+    nothing = Void()
+    weight = F64()
+
+
+def test_fixed_struct():
+    assert Point.bytesize() == 8
+    assert FixedRecord.bytesize() == 8 + 1 + 2 + 8
+    assert Example.bytesize() is None
+    r = FixedRecord(p=Point(x=1, y=-1), flag=True, key=b"ab", weight=0.5)
+    packed = r.pack()
+    assert packed == struct.pack("<ii?2sd", 1, -1, True, b"ab", 0.5)
+    assert FixedRecord.unpack(packed).to_dict() == r.to_dict()
+    assert FixedRecord.unpack(io.BufferedReader(io.BytesIO(packed))).to_dict() == r.to_dict()
+
+
+def test_native_decode():
+    s = UnionTest(e=1, b="b", c=OptionalStruct(i=2, s="s"))
+    packed = s.pack()
+    wrapped = UnionTest.unpack(packed)
+    assert isinstance(wrapped.e, Int)
+    native = UnionTest.unpack(packed, native=True)
+    assert native.e == 1 and native.b == "b"
+    assert native.c.s == "s"
+    assert UnionTest.unpack(io.BufferedReader(io.BytesIO(packed)), native=True).e == 1
+    assert Array(Int).unpack(b"\x02\x02\x03", native=True) == [1, -2]
+    assert Union(members=(Str, Int)).unpack(b"\x01\x04", native=True) == 2
+    assert Optional(Str).unpack(io.BufferedReader(io.BytesIO(b"\x00")), native=True) is None
+    p1, p2 = Person(), Person()
+    assert p1.unpack(b"\x02").value.__class__ is TerminatedEmployee
+    p2.unpack(b"\x02")
+    assert p1._codec is p2._codec
+
+
+class TrustedStruct(Struct):
+    i = U8()
+    m = Map(Str, Int)
+    p = Point()
+    u = Union(members=(Str, Int))
+    n = Optional(Nested)
+
+
+def test_trusted_decode():
+    s = TrustedStruct(i=1, m={"a": -1}, p=Point(x=1, y=2), u=3, n=Nested(s="n"))
+    packed = s.pack()
+    for data in (packed, io.BufferedReader(io.BytesIO(packed))):
+        t = TrustedStruct.unpack(data, trusted=True)
+        assert t.to_dict() == s.to_dict()
+        assert isinstance(t.m, _ValidatedMap)
+        with pytest.raises(ValidationError):
+            t.m["b"] = "not an int"
+        assert t.pack() == packed
+    # trusted decoding doesn't re-check values, only the wire format
+    assert TrustedStruct.unpack(b"\xff" + packed[1:], trusted=True).i == 0xFF
+    with pytest.raises(ValidationError):
+        TrustedStruct.unpack(packed.replace(b"\x01\x06", b"\x07\x06"), trusted=True)
+    m = Map(Str, Int, value={"a": "b"}, validate=False)
+    assert m.value["a"] == "b"
+    assert Array(Int, values=["a"], validate=False).value == ["a"]
+
+
+class Samples(Struct):
+    values = Array(U32)
+    fixed = Array(I16, length=3)
+    flags = Array(Bool)
+
+
+def test_primitive_arrays():
+    s = Samples(values=array.array("I", [1, 2, 3]), fixed=[1, -2], flags=[True, False])
+    packed = s.pack()
+    expected = b"\x03" + struct.pack("<3I", 1, 2, 3) + struct.pack("<3h", 1, -2, 0) + b"\x02\x01\x00"
+    assert packed == expected
+    assert Samples(values=[1, 2, 3], fixed=[1, -2, 0], flags=[True, False]).pack() == expected
+    assert Samples(values=memoryview(array.array("I", [1, 2, 3])), fixed=[1, -2], flags=[True, False]).pack() == expected
+    wrapped = Samples(values=[U32(value=1), 2, 3], fixed=[1, -2], flags=[Bool(value=True), False])
+    assert wrapped.pack() == expected
+    unpacked = Samples.unpack(packed)
+    assert unpacked.values == [1, 2, 3]
+    assert unpacked.fixed == [1, -2, 0]
+    assert unpacked.flags == [True, False]
+    assert Samples.unpack(io.BufferedReader(io.BytesIO(packed))).to_dict() == unpacked.to_dict()
+    with pytest.raises(RuntimeError):
+        Samples.unpack(packed[:5])
+
+
+def test_varint_arrays():
+    values = [0, 1, 127, 128, 300, 2 ** 35, 2 ** 70]
+    packed = Array(UInt, values=values).pack()
+    assert packed == b"\x07" + b"".join(UInt(value=v).pack() for v in values)
+    assert Array(UInt).unpack(packed, native=True) == values
+    assert Array(UInt).unpack(io.BytesIO(packed), native=True) == values
+    signed = [0, -1, 1, -64, 64, -(2 ** 40), 2 ** 40]
+    packed = Array(Int, values=signed).pack()
+    assert packed == b"\x07" + b"".join(Int(value=v).pack() for v in signed)
+    assert Array(Int, values=[Int(value=v) for v in signed]).pack() == packed
+    assert Array(Int).unpack(packed, native=True) == signed
+    small = list(range(100))
+    assert Array(UInt).unpack(Array(UInt, values=small).pack(), native=True) == small
+    big = list(range(0, 2 ** 20, 997)) * 3  # enough to go through numpy when it's installed
+    assert Array(Int).unpack(Array(Int, values=[-v for v in big]).pack(), native=True) == [-v for v in big]
+    assert Array(UInt).unpack(Array(UInt, values=big).pack(), native=True) == big
+    with pytest.raises(RuntimeError):
+        Array(UInt).unpack(packed[:-1])
+
+
+def test_encoded_size():
+    values = [
+        CompiledStruct(o="hé", m={"a": 1, "b": 200}, a=[1, -2], f=[1], u="x", n=Nested(s="n")),
+        UnionTest(e=1, b=-70, c=ArrayTest(a=[2 ** 40], n=[Nested(s="s")])),
+        FixedChild(a=1, b=2, c=0.5, d=b"abc", e=[1, 2]),
+        Samples(values=array.array("I", [1, 2, 3]), fixed=[1], flags=[True]),
+        Array(Str, values=["a", "b" * 200]),
+        Map(Int, Optional(Str), value={-1: None, 1: "x"}),
+        Person(value=TerminatedEmployee()),
+    ]
+    for value in values:
+        packed = value.pack()
+        assert value.encoded_size() == len(packed)
+        buffer = bytearray(len(packed) + 3)
+        assert value.pack_into(buffer, 2) == len(packed) + 2
+        assert buffer[2:-1] == packed
+        assert value.pack_into(memoryview(buffer)) == len(packed)
+        with pytest.raises(ValueError):
+            value.pack_into(buffer, 4)
+    # the encoding is written in place, not built up elsewhere and copied over
+    shaped = _shaped()(names=["a", "b" * 200], counts={"c": 1 << 40}, nested=None, value=-9)
+    buffer = bytearray(shaped.encoded_size())
+    assert shaped.pack_into(buffer) == len(buffer)
+    assert "encode" not in type(shaped).__schema__.codec.sources
+    assert buffer == shaped.pack()
+    for value in (Message(id=1, body=Point(x=1, y=2)), Message(id=2, body=Tagged(6, -3))):
+        buffer = bytearray(value.encoded_size())
+        value.pack_into(buffer)
+        assert buffer == value.pack()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+def test_iter_unpack(chunk_size):
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "people.bin"), "br") as f:
+        data = f.read()
+    people = list(Person().iter_unpack(io.BytesIO(data), chunk_size=chunk_size))
+    assert len(people) > 1
+    assert b"".join(person.pack() for person in people) == data
+    assert [person.pack() for person in Person().iter_unpack(data)] == [person.pack() for person in people]
+    points = [Point(x=i, y=-i) for i in range(10)]
+    packed = b"".join(point.pack() for point in points)
+    decoded = list(Point.iter_unpack(io.BufferedReader(io.BytesIO(packed)), chunk_size=chunk_size))
+    assert [(p.x, p.y) for p in decoded] == [(p.x, p.y) for p in points]
+    assert list(Point.iter_unpack(io.BytesIO(b""))) == []
+    with pytest.raises(RuntimeError):
+        list(Point.iter_unpack(io.BytesIO(packed[:-1]), chunk_size=chunk_size))
+    # custom fields straddling the end of a chunk are decoded once it's refilled
+    custom = _custom_sized(5)
+    packed = custom(a=1, raw=b"wxyzq").pack()
+    for trusted in (False, True):
+        stream = io.BytesIO(packed * 3)
+        decoded = custom.iter_unpack(stream, chunk_size=chunk_size, trusted=trusted)
+        assert [(value.a, value.raw) for value in decoded] == [(1, b"wxyzq")] * 3
+        with pytest.raises(RuntimeError):
+            custom.unpack(packed[:-2], trusted=trusted)
+
+
+def test_decoder():
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "people.bin"), "br") as f:
+        data = f.read()
+    expected = [person.pack() for person in Person().iter_unpack(data)]
+    for size in (1, 5, len(data)):
+        decoder = Decoder(Person)
+        people = []
+        for i in range(0, len(data), size):
+            people += decoder.feed(data[i : i + size])
+        decoder.close()
+        assert [person.pack() for person in people] == expected
+    s = CompiledStruct(o=None, m={"a": 1}, a=[1, -2], f=[1], u="x", n=Nested(s="n"))
+    decoder = Decoder(CompiledStruct, trusted=True)
+    assert decoder.feed(s.pack()[:-1]) == []
+    with pytest.raises(RuntimeError):
+        decoder.close()
+    (unpacked,) = decoder.feed(s.pack()[-1:] + s.pack()[:3])
+    assert unpacked.pack() == s.pack()
+    assert [v for v in Decoder(Array(Int), native=True).feed(b"\x02\x01\x03\x00")] == [[-1, -2], []]
+    with pytest.raises(ValueError):
+        Decoder(Void)
+    # custom fields fed byte by byte wait for the rest of their encoding
+    custom = _custom_sized(5)
+    packed = custom(a=1, raw=b"wxyzq").pack() * 3
+    for trusted in (False, True):
+        decoder = Decoder(custom, trusted=trusted)
+        decoded = [value for i in range(len(packed)) for value in decoder.feed(packed[i : i + 1])]
+        assert [(value.a, value.raw) for value in decoded] == [(1, b"wxyzq")] * 3
+
+
+def test_pack_many():
+    points = [Point(x=i, y=-i) for i in range(5)]
+    packed = Point.pack_many(points)
+    assert packed == b"".join(point.pack() for point in points)
+    buf = io.BytesIO()
+    Point.pack_many(iter(points), buf)
+    assert buf.getvalue() == packed
+    assert [(p.x, p.y) for p in Point.unpack_many(packed)] == [(i, -i) for i in range(5)]
+    assert len(Point.unpack_many(bytearray(packed), count=2, trusted=True)) == 2
+    assert Point.unpack_many(b"") == []
+    with pytest.raises(RuntimeError):
+        Point.unpack_many(packed[:-1])
+    with pytest.raises(RuntimeError):
+        Point.unpack_many(packed, count=6)
+    nested = [Nested(s="a"), Nested(s="bc")]
+    assert [n.s for n in Nested.unpack_many(memoryview(Nested.pack_many(nested)))] == ["a", "bc"]
+
+
+def test_parallel():
+    points = [Point(x=i, y=-i) for i in range(50)]
+    packed = Point.pack_parallel(points, workers=2, chunksize=8)
+    assert packed == [point.pack() for point in points]
+    decoded = Point.unpack_parallel(packed, workers=2, chunksize=8, trusted=True)
+    assert [(p.x, p.y) for p in decoded] == [(p.x, p.y) for p in points]
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        nested = Nested.unpack_parallel(
+            [memoryview(Nested(s=str(i)).pack()) for i in range(10)], chunksize=3, executor=executor
+        )
+    assert [n.s for n in nested] == [str(i) for i in range(10)]
+    with pytest.raises(RuntimeError):
+        Point.unpack_parallel([packed[0][:-1]], workers=1)
+
+
+def test_array_scan():
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "people.bin"), "br") as f:
+        people = list(Person().iter_unpack(f))
+    people = Array(Person)._wrap(people * 10)
+    packed = people.pack()
+    offsets = Array(Person).scan(packed)
+    assert len(offsets) == len(people.value) + 1 and offsets[-1] == len(packed)
+    assert [packed[a:b] for a, b in zip(offsets, offsets[1:])] == [p.pack() for p in people.value]
+    assert Array(Point, length=3).scan(b"\x00" * 24) == [0, 8, 16, 24]
+    with pytest.raises(RuntimeError):
+        Array(Person).scan(packed[:-1])
+    decoded = Array(Person).unpack_parallel(packed, workers=2, chunksize=7)
+    assert decoded.pack() == packed
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        ints = Array(Int).unpack_parallel(Array(Int, values=list(range(-50, 50))).pack(), chunksize=9, native=True, executor=executor)
+    assert ints == list(range(-50, 50))
+
+
+def test_view():
+    s = CompiledStruct(o="hi", m={"a": 1}, a=[1, -2], f=[1], u=5, n=Nested(s="n"))
+    view = CompiledStruct.view(b"\x00" + s.pack(), 1)
+    assert view.n.s == "n"
+    assert view.m == {"a": 1}
+    assert list(view.a) == [1, -2] and view.a[-1] == -2 and view.a[:1] == [1]
+    assert view.u.value == 5
+    assert view.o == "hi"
+    assert view.end == len(s.pack()) + 1
+    assert view.unpack().pack() == s.pack()
+    with pytest.raises(AttributeError):
+        view.o = "x"
+    with pytest.raises(AttributeError):
+        view.missing
+    points = Array(Point, values=[Point(x=i, y=-i) for i in range(100)])
+    array = Array(Point).view(bytearray(points.pack()))
+    assert len(array) == 100 and array[57].y == -57 and array._offsets == [1]
+    assert array.unpack(native=True)[3].x == 3
+    with pytest.raises(IndexError):
+        array[100]
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "people.bin"), "br") as f:
+        people = list(Person().iter_unpack(f))
+    packed = Array(Person)._wrap(people).pack()
+    view = Array(Person).view(packed)
+    expected = Array(Person).unpack(packed).value
+    assert [person.pack() for person in view] == [person.pack() for person in expected]
+    assert view.end == len(packed)
+    with pytest.raises(RuntimeError):
+        CompiledStruct.view(s.pack()[:4]).n
+
+
+def test_projection():
+    s = CompiledStruct(o="hi", m={"a": 1}, a=[1, -2], f=[1], u=5, n=Nested(s="n"))
+    packed = s.pack()
+    projected = CompiledStruct.unpack(packed, fields=["a", "n.s"])
+    assert projected.a == [1, -2]
+    assert projected.n.s == "n"
+    assert projected.o is None
+    trusted = CompiledStruct.unpack(packed, fields=["u"], trusted=True)
+    assert trusted.u.value == 5
+    buf = io.BytesIO(packed + packed)
+    assert CompiledStruct.unpack(buf, fields=["o"]).o == "hi"
+    assert buf.tell() == len(packed)
+    stream = io.BufferedReader(io.BytesIO(packed + packed))
+    assert CompiledStruct.unpack(stream, fields=["u", "n.s"]).n.s == "n"
+    projected = CompiledStruct.unpack(stream, fields=["o"])
+    assert projected.o == "hi" and projected.m == {} and stream.read() == b""
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "employee.bin"), "br") as f:
+        data = f.read()
+    employee = Person().unpack(data).value
+    projected = Employee.unpack(data[1:], fields=["address.city", "department", "address"])
+    assert projected.address.city == employee.address.city
+    assert projected.address.address == employee.address.address
+    assert projected.department == employee.department
+    assert projected.name == ""
+    assert Employee.unpack(data[1:], fields=["publicKey"]).publicKey == employee.publicKey
+    with pytest.raises(ValueError):
+        Employee.unpack(data[1:], fields=["address.missing"])
+    with pytest.raises(ValueError):
+        Employee.unpack(data[1:], fields=["name.length"])
+    with pytest.raises(RuntimeError):
+        Employee.unpack(data[1:40], fields=["department"])
+    # the fields that weren't decoded hold their defaults, slots included
+    compact = CompactStruct(i=1, o="o", n=CompactNested(s="s"), a=[1, 2]).pack()
+    for trusted in (False, True):
+        projected = CompactStruct.unpack(compact, fields=["n"], trusted=trusted)
+        assert (projected.i, projected.o, projected.n.s, projected.a) == (0, None, "s", [])
+
+
+def test_iter_filter():
+    points = [Point(x=i % 10, y=i) for i in range(100)]
+    packed = Point.pack_many(points)
+    found = list(Point.iter_filter(io.BytesIO(packed), {"x": 3, "y": slice(20, None)}, chunk_size=16))
+    assert [(p.x, p.y) for p in found] == [(3, y) for y in range(23, 100, 10)]
+    raw = list(Point.iter_filter(packed, {"x": {1, 2}, "y": range(0, 20)}, raw=True))
+    assert raw == [points[i].pack() for i in (1, 2, 11, 12)]
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "employee.bin"), "br") as f:
+        employee = f.read()[1:]
+    data = employee * 3 + Employee.unpack(employee).pack()
+    city = Employee.unpack(employee).address.city
+    assert len(list(Employee.iter_filter(data, {"address.city": city}))) == 4
+    assert list(Employee.iter_filter(data, {"address.city": lambda c: c != city})) == []
+    with pytest.raises(RuntimeError):
+        list(Employee.iter_filter(data[:-1], {"department": 0}))
+
+
+def test_pack_iter():
+    values = list(range(-300, 300))
+    expected = Array(Int, values=values).pack()
+    for count in (None, len(values)):
+        fp = io.BytesIO()
+        assert Array(Int).pack_iter(iter(values), fp, count=count) == len(values)
+        assert fp.getvalue() == expected
+    fp = io.BytesIO()
+    Array(Nested).pack_iter((Nested(s=str(i)) for i in range(3)), fp)
+    assert fp.getvalue() == Array(Nested, values=[Nested(s=str(i)) for i in range(3)]).pack()
+    fp = io.BytesIO()
+    Array(Str, length=3).pack_iter(iter(["a"]), fp)
+    assert fp.getvalue() == Array(Str, length=3, values=["a"]).pack()
+    fp = io.BytesIO()
+    items = {"a": 1, "b": -2}
+    assert Map(Str, Int).pack_iter(iter(items.items()), fp) == 2
+    assert fp.getvalue() == Map(Str, Int, value=items).pack()
+    with pytest.raises(ValidationError):
+        Array(UInt).pack_iter(iter([1, -1]), io.BytesIO())
+    with pytest.raises(ValueError):
+        Array(UInt).pack_iter(iter([1, 2, 3]), io.BytesIO(), count=2)
+    with pytest.raises(ValueError):
+        Map(Str, Int).pack_iter(items, io.BytesIO(), count=3)
+
+
+class Envelope(Union):
+    _members = (Str, U8, Nested, Point, Array(Int), Optional(Str), I16, Data, F64, Bool, Nested)
+
+
+class Message(Struct):
+    id = UInt()
+    body = Envelope()
+
+
+def test_union_dispatch():
+    assert len(Envelope._members) > compiler.DISPATCH_THRESHOLD
+    assert Envelope().members is Envelope().members
+    values = [Nested(s="n"), Point(x=1, y=2), "s", 3, [-1, 2], 1.5, Tagged(6, -3), Str("w")]
+    messages = [Message(id=i, body=value) for i, value in enumerate(values)]
+    packed = [m.pack() for m in messages]
+    assert packed[0][1] == 2 and packed[1][1] == 3
+    assert packed[4][1:] == b"\x04\x02\x01\x04"  # inferred as Array(Int)
+    assert packed[6][1:] == b"\x06" + struct.pack("<h", -3)
+    assert sum(m.encoded_size() for m in messages) == sum(map(len, packed))
+    fp = io.BytesIO()
+    Envelope(value=Tagged(1, 7))._pack(fp)
+    assert fp.getvalue() == b"\x01\x07"
+    for data in packed:
+        for source in (data, io.BufferedReader(io.BytesIO(data))):
+            m = Message.unpack(source)
+            assert m.pack() == data
+        assert Decoder(Message).feed(data)[0].pack() == data
+        assert Message.view(data).id == data[0]
+    wrapped = Message.unpack(packed[6])
+    assert isinstance(wrapped.body, I16) and wrapped.body.value == -3
+    assert Message.unpack(packed[6], native=True, trusted=True).body == -3
+    assert Message.unpack(packed[0]).body.s == "n"
+    with pytest.raises(ValidationError):
+        Message.unpack(b"\x00\x0b")
+    with pytest.raises(ValidationError):
+        Message(id=0, body=Tagged(2, "s"))
+    with pytest.raises(ValidationError):
+        Message(id=0, body=Tagged(11, 1))
+    m = Message(id=0, body="s")
+    m._body = Int(1)  # bypasses validation, Int isn't a member
+    with pytest.raises(TypeError):
+        m.pack()
+
+
+PEOPLE_SCHEMA = """
+type PublicKey data<128>
+type Time str # ISO 8601
+
+enum Department {
+  ACCOUNTING
+  ADMINISTRATION
+  CUSTOMER_SERVICE
+  DEVELOPMENT
+
+  # Reserved for the CEO
+  JSMITH = 99
+}
+
+type Customer {
+  name: str
+  email: str
+  address: Address
+  orders: []{
+    orderID: i64
+    quantity: i32
+  }
+  metadata: map[str]data
+}
+
+type Employee {
+  name: str
+  email: str
+  address: Address
+  department: Department
+  hireDate: Time
+  publicKey: optional<PublicKey>
+  metadata: map[str]data
+}
+
+type TerminatedEmployee void
+
+type Person (Customer | Employee | TerminatedEmployee)
+
+type Address {
+  address: [4]str
+  city: str
+  state: str
+  country: str
+}
+"""
+
+EVENTS_SCHEMA = """
+type Ids list<u32>[3]
+type Point struct { x: i32 y: i32 }
+type Event union {
+  | Point | str | uint | int | bool | f64 | data | Ids | map<str><int> | optional<Point>
+}
+type Envelope struct {
+  id: uint
+  kind: Kind
+  event: Event
+  tags: list<str>
+}
+enum Kind { A B = 5 }
+"""
+
+
+def _generated(schema, **kwargs):
+    module = types.ModuleType("generated")
+    exec(generate(schema, **kwargs), module.__dict__)
+    return module
+
+
+@pytest.mark.parametrize(
+    "file", ["customer.bin", "employee.bin", "people.bin", "terminated.bin"]
+)
+def test_compile_schema(file):
+    people = _generated(PEOPLE_SCHEMA)
+    assert people.Department.JSMITH == 99
+    assert people.Customer.orders._type.__class__.__name__ == "Customer_orders"
+    with open(os.path.join(os.path.dirname(__file__), "_examples", file), "br") as f:
+        data = f.read()
+    fp = io.BytesIO(data)
+    decoded = []
+    while fp.tell() < len(data):
+        handwritten = Person().unpack(data[fp.tell() :])
+        decoded.append((people.Person().unpack(fp), handwritten))
+    for generated, handwritten in decoded:
+        assert generated.to_dict() == handwritten.to_dict()
+    assert b"".join(generated.pack() for generated, _ in decoded) == data
+    for cls in (people.Customer, people.Employee, people.Address):
+        # everything was generated ahead of time
+        assert cls.__schema__.codec.sources == {}
+
+
+def test_compile_schema_dispatch(tmp_path):
+    schema = tmp_path / "events.bare"
+    schema.write_text(EVENTS_SCHEMA)
+    output = tmp_path / "events.py"
+    compile_main([str(schema), "-o", str(output), "--kinds", "encode,decode,read_native"])
+    module = types.ModuleType("events")
+    exec(output.read_text(), module.__dict__)
+    assert len(module.Event._members) > compiler.DISPATCH_THRESHOLD
+    values = [module.Point(x=1, y=-1), "s", 3, -3, True, 0.5, b"d", [1, 2], {"a": -1}, None]
+    for value in values:
+        e = module.Envelope(id=1, kind=module.Kind.B, event=value, tags=["t"])
+        packed = e.pack()
+        assert module.Envelope.unpack(packed).pack() == packed
+        native = module.Envelope.unpack(io.BufferedReader(io.BytesIO(packed)), native=True)
+        assert native.pack() == packed and native.kind == 5
+    assert module.Envelope(event=Tagged(3, 5)).pack()[2:4] == b"\x03\x0a"
+    assert module.Envelope.__schema__.codec.sources == {}
+    assert e.encoded_size() == len(packed)
+    assert set(module.Envelope.__schema__.codec.sources) == {"size"}  # generated on use
+    with pytest.raises(SchemaError, match="line 3: undefined type 'Missing'"):
+        generate("type A {\n  b: str\n  c: Missing\n}")
+    with pytest.raises(SchemaError, match="recursive types"):
+        generate("type A { b: optional<B> }\ntype B { a: []A }")
+    with pytest.raises(SchemaError, match="out of order"):
+        generate("type A (str | int = 2)")
+    with pytest.raises(SchemaError, match="line 2: map keys .* 'Key' is neither"):
+        generate("type Key f64\ntype A { m: map[Key]str }")
+    with pytest.raises(SchemaError, match="'Id' is neither"):
+        generate("type Id Hash\ntype Hash data<32>\ntype A { m: optional<map[Id]str> }")
+    with pytest.raises(SchemaError, match="'Point' is neither"):
+        generate("type A { m: map[Point]str }\ntype Point { x: i32 }")
+    module = types.ModuleType("keys")
+    exec(generate("type Id Kind\nenum Kind { A B }\ntype A { m: map[Id]str }"), module.__dict__)
+    assert module.A.unpack(module.A(m={module.Kind.B: "b"}).pack()).m == {1: "b"}
+
+
+def _shaped():
+    # a new class of the same shape every call
+    class Shaped(Struct):
+        names = Array(Str)
+        counts = Map(Str, U64)
+        nested = Optional(Nested)
+        value = Union(members=(Str, Int))
+
+    return Shaped
+
+
+def test_fingerprint(tmp_path, monkeypatch):
+    fingerprint = compiler.fingerprint
+    assert fingerprint(_shaped()) == fingerprint(_shaped())
+    assert fingerprint(Array(Str)) == fingerprint(Array(Str()))
+    assert fingerprint(Array(Str)) != fingerprint(Array(Str, length=2))
+    assert fingerprint(Array(Str)) != fingerprint(Array(UInt))
+    assert fingerprint(Union(members=(Str, Int))) != fingerprint(Union(members=(Int, Str)))
+    assert fingerprint(Nested) != fingerprint(_shaped())
+    a, b = _shaped(), _shaped()
+    make = lambda cls: cls(names=["x"], counts={"y": 1}, nested=Nested(s="z"), value=-1)
+    packed = make(a).pack()
+    assert b.unpack(packed).pack() == packed
+    # the code is generated once, and shared by both classes
+    assert a.__schema__.codec.encode.__code__ is b.__schema__.codec.encode.__code__
+    assert b.unpack(packed).names == ["x"]
+
+    monkeypatch.setattr(compiler, "cache_dir", str(tmp_path))
+    monkeypatch.setattr(compiler, "_compiled", {})
+    assert make(_shaped()).pack() == packed
+    cached = list(tmp_path.glob("*/*.encode.pyc"))
+    assert len(cached) == 1
+    # a new process loads the code from the cache instead of generating it
+    monkeypatch.setattr(compiler, "_compiled", {})
+    with monkeypatch.context() as m:
+        m.setattr(compiler._SymbolicGenerator, "function", None)
+        assert make(_shaped()).pack() == packed
+    for path in cached:
+        path.write_bytes(b"broken")
+    monkeypatch.setattr(compiler, "_compiled", {})
+    assert make(_shaped()).pack() == packed
+
+
+class CustomFixed(DataFixed):
+    def _pack(self, fp, value=None):
+        fp.write(self._value if value is None else value)
+
+    def _unpack(self, fp):
+        return CustomFixed(length=self._length, value=fp.read(self._length))
+
+
+def _custom_sized(length):
+    # classes of the same name, differing only in the width of a custom field
+    class CustomSized(Struct):
+        a = U16()
+        raw = CustomFixed(length=length)
+
+    return CustomSized
+
+
+def test_fingerprint_custom_sizes():
+    narrow, wide = _custom_sized(2), _custom_sized(5)
+    assert compiler.fingerprint(narrow) != compiler.fingerprint(wide)
+    packed = narrow(a=1, raw=b"xy").pack()
+    assert narrow(a=1, raw=b"xy").encoded_size() == 4
+    assert narrow.__schema__.codec.skip(memoryview(packed), 0) == 4
+    packed = wide(a=1, raw=b"hello").pack()
+    assert wide(a=1, raw=b"hello").encoded_size() == len(packed) == 7
+    assert wide.__schema__.codec.skip(memoryview(packed), 0) == 7
+    assert wide.view(packed).end == 7
+
+
+class TrackedAddress(Struct, tracked=True):
+    city = Str()
+    lines = Array(Str)
+
+
+class TrackedOrder(Struct, tracked=True):
+    id = U64()
+    tags = Array(Str)
+    counts = Map(Str, UInt)
+    address = TrackedAddress()
+    note = Optional(Str)
+    value = Union(members=(Str, Int))
+
+
+class TrackedPoint(Struct, compact=True, tracked=True):
+    x = I32()
+    tags = Array(UInt, length=3)
+
+
+def _repacked(value):
+    # encodes `value` from scratch, without any of the fields it kept
+    for cls in (value, getattr(value, "address", None)):
+        if cls is not None:
+            object.__setattr__(cls, "__bare_cache__", None)
+    return value.pack()
+
+
+def test_tracked():
+    order = TrackedOrder(
+        id=1,
+        tags=["a"],
+        counts={"x": 1},
+        address=TrackedAddress(city="c", lines=["l"]),
+        note=None,
+        value="s",
+    )
+    packed = order.pack()
+    for trusted in (False, True):
+        decoded = TrackedOrder.unpack(packed, trusted=trusted)
+        assert decoded.__bare_cache__[1][2] == b"\x01\x01a"
+        # the address is kept whole, while none of its own fields change
+        address = decoded.__bare_cache__[3]
+        assert address[0] is decoded.address and address[2] == order.address.pack()
+        assert decoded.pack() == packed
+        decoded.tags.append("b")
+        decoded.counts["y"] = 2
+        decoded.address.lines[0] = "m"
+        decoded.note = "n"
+        decoded.value = -5
+        assert decoded.pack() == _repacked(decoded) != packed
+        decoded.tags.pop(0)
+        del decoded.counts["x"]
+        decoded.address.city = "z"
+        decoded.tags += ["q"]
+        assert decoded.pack() == _repacked(decoded)
+        decoded.tags.sort(reverse=True)
+        assert decoded.pack() == _repacked(decoded)
+        decoded.address = TrackedAddress.unpack(order.address.pack())
+        assert decoded.pack() == _repacked(decoded)
+        with pytest.raises(ValidationError):
+            decoded.tags.append(1)
+    point = TrackedPoint.unpack(TrackedPoint(x=1, tags=[1, 2, 3]).pack())
+    assert not hasattr(point, "__dict__")
+    point.tags[1:] = [5, 6]
+    assert point.pack() == _repacked(point) == b"\x01\x00\x00\x00\x01\x05\x06"
+    with pytest.raises(ValidationError):
+        point.tags.append(4)
+
+
+class FrozenAddress(Struct, interned=True):
+    city = Str()
+    zip = U32()
+
+
+class FrozenPoint(Struct, frozen=True):
+    x = I32()
+    y = I32()
+
+
+class FrozenRecord(Struct, frozen=True):
+    name = Str()
+    tags = Array(Str)
+    meta = Map(Str, Array(UInt))
+    address = FrozenAddress()
+    point = FrozenPoint()
+    value = Union(members=(FrozenAddress, Str))
+
+
+class Percent(U8):
+    def validate(self, value):
+        if isinstance(value, int) and value > 100:
+            return False, f"{value} is over 100"
+        return super().validate(value)
+
+
+class FrozenScore(Struct, frozen=True):
+    name = Str()
+    score = Percent()
+
+
+class InternedScore(Struct, interned=True):
+    score = Percent()
+
+
+class ScoreCard(Struct, frozen=True):
+    score = InternedScore()
+
+
+def test_frozen():
+    address = FrozenAddress(city="c", zip=5)
+    record = FrozenRecord(
+        name="n", tags=["a"], meta={"k": [1, 2]}, address=address, value=address
+    )
+    assert record.tags == ("a",) and record.meta["k"] == (1, 2)
+    with pytest.raises(AttributeError):
+        record.name = "m"
+    with pytest.raises(AttributeError):
+        record.point.x = 1
+    with pytest.raises(TypeError):
+        record.meta["q"] = (1,)
+    with pytest.raises(ValidationError):
+        FrozenPoint(x="a")
+    packed = record.pack()
+    a, b = FrozenRecord.unpack(packed), FrozenRecord.unpack(packed, trusted=True)
+    assert a == b == record and a is not b
+    assert {record: 1}[a] == 1 and hash(b) == hash(record)
+    assert a.__bare_encoded__ == packed
+    # byte identical sub-messages decode to one shared instance
+    assert a.address is b.address is a.value is b.value
+    assert FrozenRecord.unpack(io.BufferedReader(io.BytesIO(packed))).address is a.address
+    assert pickle.loads(pickle.dumps(record)) == record
+    assert FrozenRecord.unpack(packed, fields=["name"]).tags == ()
+    # projections only skip validating the values they didn't decode
+    scored = FrozenScore(name="n", score=100).pack()[:-1] + b"\x65"
+    with pytest.raises(ValidationError):
+        FrozenScore.unpack(scored, fields=["score"])
+    assert FrozenScore.unpack(scored, fields=["score"], trusted=True).score == 101
+    # instances interned by trusted decodes are never handed to validating ones
+    trusted = InternedScore.unpack(b"\x65", trusted=True)
+    assert trusted.score == 101
+    with pytest.raises(ValidationError):
+        InternedScore.unpack(b"\x65")
+    with pytest.raises(ValidationError):
+        ScoreCard.unpack(b"\x65")
+    with pytest.raises(ValidationError):
+        ScoreCard.unpack(io.BufferedReader(io.BytesIO(b"\x65")))
+    assert ScoreCard.unpack(b"\x65", trusted=True).score is trusted
+    with pytest.raises(TypeError, match="isn't frozen"):
+
+        class Thawed(Struct, frozen=True):
+            nested = Array(Nested)
+
+
+class _Writer:
+    def __init__(self):
+        self.data = bytearray()
+        self.writes = 0
+
+    def write(self, data):
+        self.data += data
+        self.writes += 1
+
+    async def drain(self):
+        pass
+
+
+def test_aio():
+    with open(os.path.join(os.path.dirname(__file__), "_examples", "people.bin"), "br") as f:
+        people = list(Person().iter_unpack(f))
+
+    async def run():
+        writer = _Writer()
+        await aio.write_messages(writer, people)
+        await aio.write_message(writer, Nested(s="last"))
+        assert writer.writes == 2
+        reader = asyncio.StreamReader()
+        reader.feed_data(bytes(writer.data))
+        reader.feed_eof()
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            decoded = []
+            for _ in people:
+                decoded.append(await aio.read_message(reader, Person, executor=executor, offload_size=100))
+        assert [p.pack() for p in decoded] == [p.pack() for p in people]
+        assert (await aio.read_message(reader, Nested)).s == "last"
+        with pytest.raises(EOFError):
+            await aio.read_message(reader, Nested)
+        reader = asyncio.StreamReader()
+        reader.feed_data(bytes(writer.data[:-1]))
+        reader.feed_eof()
+        with pytest.raises(RuntimeError):
+            async for person in aio.iter_messages(reader, Person()):
+                pass
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"\x02\x01a\x02\x01b")
+        reader.feed_eof()
+        assert [n.s async for n in aio.iter_messages(reader, Nested)] == ["a", "b"]
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    # fields are pickled without their compiled codec, e.g. to decode on a process pool
+    union = Person()
+    union.unpack(people[0].pack())
+    union = pickle.loads(pickle.dumps(union))
+    assert union.unpack(people[0].pack()).pack() == people[0].pack()
+
+
+def test_numpy_arrays():
+    np = pytest.importorskip("numpy")
+    a = Array(F64, numpy=True)
+    packed = Array(F64, values=[0.5, 1.5]).pack()
+    decoded = a.unpack(packed, native=True)
+    assert isinstance(decoded, np.ndarray) and decoded.dtype == np.dtype("<f8")
+    assert decoded.tolist() == [0.5, 1.5]
+    assert a.unpack(bytearray(packed), native=True).flags.writeable
+    assert Array(F64, values=np.array([0.5, 1.5])).pack() == packed
+    assert Array(F64, values=np.array([0.5, 1.5], dtype=np.float32)).pack() == packed
+    ints = np.arange(-5000, 5000, 3, dtype=np.int64)
+    out = bytearray()
+    assert varint.encode_varints(out, ints, signed=True)
+    assert bytes(out) == Array(Int, values=ints.tolist()).pack()[2:]
+    assert varint.decode_varints(out, 0, len(ints), signed=True) == (ints.tolist(), len(out))
@@ -29,6 +29,9 @@ class Simple(Field):
         buf = fp.read(self._bytesize)
         return self.__class__(value=(struct.unpack(self._fmt, buf)[0]))
 
+    def _fixed_size(self) -> typing.Optional[int]:
+        return self._bytesize
+
 
 class U8(Simple):
     """
@@ -220,6 +223,9 @@ class Void(Field):
     def _unpack(self, fp: typing.BinaryIO):
         return self.__class__(value=None)
 
+    def _fixed_size(self) -> typing.Optional[int]:
+        return 0
+
     def validate(self, value):
         if value is not None:
             return False, f"type: {type(value)} must be <None>"
@@ -360,6 +366,9 @@ class DataFixed(Field):
         val = fp.read(length)
         return self.__class__(value=val)
 
+    def _fixed_size(self) -> typing.Optional[int]:
+        return self._length
+
 
 class Enum(UInt):
     def __init__(self, enum, *args, **kwargs):
@@ -0,0 +1,210 @@
+"""
+bare.varint implements the variable length integer encoding used by BARE for
+`UInt`, `Int` and all length prefixes, working directly on `bytearray`s and
+`memoryview`s.
+
+Besides single values, whole sequences (e.g. `Array(UInt)`) can be encoded and
+decoded in one pass. If numpy is installed, large sequences are handled with
+vectorized operations instead of a Python loop.
+"""
+import typing
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, without it everything goes through the scalar loops
+    np = None
+
+# below this many values the overhead of going through numpy isn't worth it
+NUMPY_THRESHOLD = 512
+
+
+def encode_uvarint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_uvarint_into(buf, pos: int, value: int) -> int:
+    """
+    Writes the varint encoding of `value` into the writable buffer `buf` at `pos`, and
+    returns the offset just past it.
+    """
+    while value >= 0x80:
+        buf[pos] = (value & 0x7F) | 0x80
+        pos += 1
+        value >>= 7
+    buf[pos] = value
+    return pos + 1
+
+
+def decode_uvarint(buf, pos: int) -> typing.Tuple[int, int]:
+    output = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        output |= (b & 0x7F) << shift
+        if b < 0x80:
+            return output, pos
+        shift += 7
+
+
+def uvarint_size(value: int) -> int:
+    """
+    Returns the number of bytes the varint encoding of the unsigned `value` takes.
+    """
+    if value < 0x80:
+        return 1
+    return (value.bit_length() + 6) // 7
+
+
+def _zigzag(values) -> list:
+    return [value * 2 if value >= 0 else -2 * value - 1 for value in values]
+
+
+def encode_varints(out: bytearray, values: typing.Sequence[int], signed=False) -> bool:
+    """
+    Appends the varint encoding of every value in `values` to `out`, zigzag encoding
+    them first if `signed`. Returns False, leaving `out` untouched, if the values
+    can't be encoded in bulk (e.g. some are wrapped in their `Field` type).
+    """
+    start = len(out)
+    try:
+        if np is not None and len(values) >= NUMPY_THRESHOLD:
+            packed = _encode_numpy(values, signed)
+            if packed is not None:
+                out += packed
+                return True
+        if not isinstance(values, (list, tuple)):
+            # e.g. an ndarray or array.array, whose bytes() would be its raw buffer
+            values = values.tolist() if hasattr(values, "tolist") else list(values)
+        if signed:
+            values = _zigzag(values)
+        try:
+            packed = bytes(values)
+        except (TypeError, ValueError):
+            packed = None
+        if packed is not None and (not packed or max(packed) < 0x80):
+            # the common case of only small values, one byte each
+            out += packed
+            return True
+        append = out.append
+        for value in values:
+            while value >= 0x80:
+                append((value & 0x7F) | 0x80)
+                value >>= 7
+            append(value)
+        return True
+    except (TypeError, ValueError):
+        del out[start:]
+        return False
+
+
+def encode_varints_into(buf, pos: int, values: typing.Sequence[int], signed=False):
+    """
+    Like `encode_varints`, but writes the encoding into the writable buffer `buf` at `pos`
+    and returns the offset just past it, or None if the values can't be encoded in bulk.
+    """
+    out = bytearray()
+    if not encode_varints(out, values, signed):
+        return None
+    end = pos + len(out)
+    buf[pos:end] = out
+    return end
+
+
+def decode_varints(buf, pos: int, count: int, signed=False) -> typing.Tuple[list, int]:
+    """
+    Decodes `count` consecutive varints from `buf` starting at `pos`, zigzag decoding
+    them if `signed`. Returns a list of the values and the offset just past the last one.
+    """
+    if np is not None and count >= NUMPY_THRESHOLD:
+        decoded = _decode_numpy(buf, pos, count, signed)
+        if decoded is not None:
+            values, pos = decoded
+            return values.tolist(), pos
+    end = pos + count
+    chunk = buf[pos:end]
+    if len(chunk) == count and (not count or max(chunk) < 0x80):
+        # only small values, one byte each
+        values = list(chunk)
+        pos = end
+    else:
+        values = []
+        append = values.append
+        for _ in range(count):
+            b = buf[pos]
+            pos += 1
+            if b < 0x80:
+                append(b)
+                continue
+            value = b & 0x7F
+            shift = 7
+            while True:
+                b = buf[pos]
+                pos += 1
+                value |= (b & 0x7F) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+            append(value)
+    if signed:
+        values = [(value >> 1) ^ -(value & 1) for value in values]
+    return values, pos
+
+
+def _encode_numpy(values, signed: bool) -> typing.Optional[bytes]:
+    try:
+        v = np.asarray(values)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    # anything else (wrapped values, ints too large for 64 bits) takes the scalar path
+    if v.ndim != 1 or v.dtype.kind not in "iu":
+        return None
+    if signed:
+        if v.dtype.kind == "u" and v.max() > np.iinfo(np.int64).max:
+            return None
+        v = v.astype(np.int64)
+        u = (v.astype(np.uint64) << np.uint64(1)) ^ (v >> 63).astype(np.uint64)
+    else:
+        if v.dtype.kind == "i" and v.min() < 0:
+            return None
+        u = v.astype(np.uint64)
+    # number of 7 bit groups in each value
+    lengths = np.ones(len(u), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += u >= np.uint64(1 << (7 * k))
+    offsets = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        mask = lengths > k
+        group = ((u[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)).astype(np.uint8)
+        group[lengths[mask] > k + 1] |= 0x80
+        out[offsets[mask] + k] = group
+    return out.tobytes()
+
+
+def _decode_numpy(buf, pos: int, count: int, signed: bool):
+    window = min(len(buf) - pos, count * 10)
+    if window <= 0:
+        return None
+    data = np.frombuffer(buf, dtype=np.uint8, count=window, offset=pos)
+    ends = np.flatnonzero(data < 0x80)[:count]
+    if len(ends) < count:
+        return None  # truncated, let the scalar path report it
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    if lengths.max() > 10 or (lengths.max() == 10 and data[ends[lengths == 10]].max() > 1):
+        return None  # doesn't fit in 64 bits
+    size = int(ends[-1]) + 1
+    shifts = (np.arange(size) - np.repeat(starts, lengths)) * 7
+    groups = (data[:size] & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    u = np.bitwise_or.reduceat(groups, starts)
+    if signed:
+        values = (u >> np.uint64(1)).astype(np.int64) ^ -(u & np.uint64(1)).astype(np.int64)
+    else:
+        values = u
+    return values, pos + size
@@ -0,0 +1,193 @@
+"""
+bare.view provides read-only views of encoded structs and arrays. A view is backed by
+the buffer it was created from and decodes each field or element only when it's first
+accessed, skipping over everything before it without building any values.
+"""
+import typing
+import weakref
+from collections.abc import Sequence
+
+from .compiler import compile_field, compile_struct
+from .encoder import Array, Struct, _decode_buffer
+from .varint import decode_uvarint
+
+
+def _buffer(data) -> memoryview:
+    view = memoryview(data)
+    if view.ndim != 1 or view.format != "B":
+        view = view.cast("B")
+    return view
+
+
+def _decoder(field) -> typing.Callable:
+    # returns a function decoding `field` at an offset, as a view for structs and arrays
+    if isinstance(field, Struct):
+        cls = type(field)
+        return lambda buf, pos: StructView(cls, buf, pos)
+    if isinstance(field, Array):
+        return lambda buf, pos: ArrayView(field, buf, pos)
+    decode = compile_field(field).decode
+    return lambda buf, pos: _decode_buffer(decode, buf, pos)[0]
+
+
+def _skipper(field) -> typing.Callable:
+    # returns a function returning the offset just past `field` encoded at an offset
+    size = field._fixed_size()
+    if size is not None:
+        return lambda buf, pos: pos + size
+    if isinstance(field, Struct):
+        skip = compile_struct(type(field)).skip
+    else:
+        skip = compile_field(field).skip
+    return lambda buf, pos: _decode_buffer(skip, buf, pos)
+
+
+class _Layout:
+    """
+    The per field decoders and skippers of a `Struct` subclass, shared by its views.
+    """
+
+    def __init__(self, cls):
+        fields = cls.__schema__.fields
+        self.index = {name: i for i, name in enumerate(fields)}
+        self.decoders = [_decoder(field) for field in fields.values()]
+        self.skippers = [_skipper(field) for field in fields.values()]
+
+
+_layouts: typing.MutableMapping[type, _Layout] = weakref.WeakKeyDictionary()
+
+
+def _layout(cls) -> _Layout:
+    layout = _layouts.get(cls)
+    if layout is None:
+        layout = _layouts[cls] = _Layout(cls)
+    return layout
+
+
+_missing = object()
+
+
+class StructView:
+    """
+    StructView is a read-only view of a struct encoded in a buffer, see `Struct.view`.
+    Fields are read as attributes, like on the struct itself. Nested structs and arrays
+    are returned as views in turn.
+    """
+
+    __slots__ = ("_cls", "_layout", "_buf", "_offsets", "_values")
+
+    def __init__(self, cls, data, offset=0):
+        self._cls = cls
+        self._layout = _layout(cls)
+        self._buf = _buffer(data)
+        # offsets of the fields found so far, they're filled in as fields are accessed
+        self._offsets = [offset]
+        self._values = [_missing] * len(self._layout.decoders)
+
+    def __getattr__(self, name):
+        try:
+            index = self._layout.index[name]
+        except KeyError:
+            raise AttributeError(
+                f"'{self._cls.__name__}' view has no attribute '{name}'"
+            ) from None
+        value = self._values[index]
+        if value is _missing:
+            value = self._layout.decoders[index](self._buf, self._offset(index))
+            self._values[index] = value
+        return value
+
+    def _offset(self, index: int) -> int:
+        offsets = self._offsets
+        skippers = self._layout.skippers
+        while len(offsets) <= index:
+            i = len(offsets) - 1
+            offsets.append(skippers[i](self._buf, offsets[i]))
+        return offsets[index]
+
+    @property
+    def end(self) -> int:
+        """The offset just past the viewed struct"""
+        return self._offset(len(self._values))
+
+    def unpack(self, native=False, trusted=False) -> Struct:
+        """Decodes the whole struct, see `Struct.unpack`"""
+        decode = self._cls.__schema__.codec.get("decode", native, trusted)
+        value, _ = _decode_buffer(decode, self._buf, self._offsets[0])
+        return value
+
+    def __repr__(self):
+        return f"<{self._cls.__name__} view at {self._offsets[0]}>"
+
+
+class ArrayView(Sequence):
+    """
+    ArrayView is a read-only sequence view of an array encoded in a buffer, see
+    `Array.view`. Elements are decoded when first accessed. Indexing is O(1) for
+    elements of a fixed width, otherwise the elements before are skipped over once.
+    """
+
+    __slots__ = (
+        "_field",
+        "_buf",
+        "_start",
+        "_count",
+        "_size",
+        "_offsets",
+        "_values",
+        "_decode",
+        "_skip",
+    )
+
+    def __init__(self, field: Array, data, offset=0):
+        self._field = field
+        self._buf = _buffer(data)
+        self._start = offset
+        if field._length == 0:
+            self._count, offset = _decode_buffer(decode_uvarint, self._buf, offset)
+        else:
+            self._count = field._length
+        element = field._type
+        self._size = element._fixed_size()
+        self._offsets = [offset]
+        self._values = {}
+        self._decode = _decoder(element)
+        self._skip = _skipper(element)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("array view index out of range")
+        value = self._values.get(index, _missing)
+        if value is _missing:
+            value = self._decode(self._buf, self._offset(index))
+            self._values[index] = value
+        return value
+
+    def _offset(self, index: int) -> int:
+        if self._size is not None:
+            return self._offsets[0] + index * self._size
+        offsets = self._offsets
+        while len(offsets) <= index:
+            offsets.append(self._skip(self._buf, offsets[-1]))
+        return offsets[index]
+
+    @property
+    def end(self) -> int:
+        """The offset just past the viewed array"""
+        return self._offset(self._count)
+
+    def unpack(self, native=False, trusted=False):
+        """Decodes the whole array, see `Field.unpack`"""
+        decode = compile_field(self._field).get("decode", native, trusted)
+        value, _ = _decode_buffer(decode, self._buf, self._start)
+        return value if native else self._field._wrap(value)
+
+    def __repr__(self):
+        return f"<{type(self._field).__name__} view of {self._count} at {self._start}>"